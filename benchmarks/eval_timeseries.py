@@ -0,0 +1,63 @@
+"""
+Compare decoding timeseries with pandas (flavor='native', the previous default in collect_source_data) with decoding
+them directly to numpy arrays (flavor='numpy'). Each path includes converting the result to the list of values that
+goes into the Pywr model (see utils.create_variable).
+
+Usage (from the repository root):
+
+    python benchmarks/eval_timeseries.py [--years 60] [--n 100]
+"""
+
+import os
+import sys
+import json
+import argparse
+from time import perf_counter
+
+import numpy as np
+import pandas
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from waterlp.models.evaluator import eval_timeseries, json_loads
+from waterlp.models.utils import timeseries_values
+
+date_format = '%Y-%m-%d %H:%M:%S'
+
+
+def make_timeseries(dates, seed):
+    # as stored in Hydra: {column: {ISO date: value}}
+    values = np.random.RandomState(seed).rand(len(dates)) * 100
+    return json.dumps({'0': {d: v for d, v in zip(dates.strftime('%Y-%m-%dT%H:%M:%S.000Z'), values)}})
+
+
+def run(timeseries, dates, flavor):
+    start = perf_counter()
+    results = []
+    for ts in timeseries:
+        value = eval_timeseries(ts, dates, fill_value=0, flavor=flavor, date_format=date_format)
+        results.append(timeseries_values(value))
+    return perf_counter() - start, results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark timeseries decoding')
+    parser.add_argument('--years', dest='years', type=int, default=60, help='''Years of daily data per timeseries.''')
+    parser.add_argument('--n', dest='n', type=int, default=100, help='''Number of timeseries (resource attributes).''')
+    args = parser.parse_args()
+
+    dates = pandas.date_range('1950-10-01', periods=args.years * 365, freq='D')
+    dates_as_string = list(dates.strftime(date_format))
+    dates64 = np.array(dates_as_string, dtype='datetime64[s]')
+    timeseries = [make_timeseries(dates, i) for i in range(args.n)]
+
+    native, native_results = run(timeseries, dates_as_string, 'native')
+    fast, numpy_results = run(timeseries, dates64, 'numpy')
+
+    assert np.allclose(np.array(native_results), np.array(numpy_results))
+
+    print('{} timeseries x {} days (JSON decoder: {})'.format(args.n, len(dates), json_loads.__module__))
+    print('{:<10}{:>12}'.format('flavor', 'time (s)'))
+    print('{:<10}{:>12.3f}'.format('native', native))
+    print('{:<10}{:>12.3f}'.format('numpy', fast))
+    print('speedup: {:.1f}x'.format(native / fast))
@@ -0,0 +1,115 @@
+"""
+Compare calling Hydra with a new connection for each call (requests.post, as before) with the pooled client in
+connection.call, against a local stand-in Hydra server. The stand-in supports keep-alive connections, gzip requests
+and responses, and can fail some calls (503) to exercise retries.
+
+Usage (from the repository root):
+
+    python benchmarks/hydra_client.py [--n 500] [--kb 50] [--fail-every 0]
+"""
+
+import os
+import sys
+import json
+import gzip
+import argparse
+import threading
+from time import perf_counter
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from waterlp.connection import connection
+
+
+class StandInHydra(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive
+    disable_nagle_algorithm = True  # as in production servers; otherwise keep-alive responses are delayed
+    payload = b'{}'
+    fail_every = 0
+    count = 0
+    lock = threading.Lock()
+
+    def log_message(self, *args):
+        pass
+
+    def send(self, status, body, headers=()):
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = gzip.compress(body, compresslevel=5)
+            headers = list(headers) + [('Content-Encoding', 'gzip')]
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for header in headers:
+            self.send_header(*header)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+        func, args = list(json.loads(body).items())[0]
+
+        with self.lock:
+            type(self).count += 1
+            count = self.count
+        if self.fail_every and count % self.fail_every == 0:
+            return self.send(503, json.dumps({'faultcode': 'Server', 'faultstring': 'Unavailable'}).encode())
+
+        if func == 'login':
+            return self.send(200, b'{}', headers=[('Set-Cookie', 'beaker.session.id=abc; Path=/')])
+        self.send(200, self.payload)
+
+
+def legacy_call(url, func, args):
+    # the previous connection.call
+    data = json.dumps({func: args})
+    headers = {'Content-Type': 'application/json', 'appname': 'waterlp'}
+    cookie = {'beaker.session.id': 'abc', 'appname:': 'waterlp'}
+    response = requests.post(url, data=data, headers=headers, cookies=cookie, timeout=500)
+    return json.loads(response.content.decode())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark calls to a stand-in Hydra server')
+    parser.add_argument('--n', dest='n', type=int, default=500, help='''Number of calls.''')
+    parser.add_argument('--kb', dest='kb', type=int, default=50, help='''Size of each response, in kB.''')
+    parser.add_argument('--fail-every', dest='fail_every', type=int, default=0,
+                        help='''Fail every nth call with a 503 (0 for never).''')
+    args = parser.parse_args()
+
+    values = {'2000-01-{:02}'.format(i % 28 + 1): i * 0.5 for i in range(args.kb * 1000 // 20)}
+    StandInHydra.payload = json.dumps({'id': 1, 'value': json.dumps(values)}).encode()
+    StandInHydra.fail_every = args.fail_every
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StandInHydra)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = 'http://127.0.0.1:{}/json'.format(server.server_port)
+
+    conn = connection.__new__(connection)  # without downloading a network
+    conn.url, conn.app_name, conn.session_id, conn.metrics = url, 'waterlp', None, {}
+    conn.call('login', {'username': 'user', 'password': 'password'})
+    assert conn.session_id == 'abc'
+
+    StandInHydra.fail_every = 0
+    start = perf_counter()
+    for i in range(args.n):
+        legacy_call(url, 'get_scenario', {'scenario_id': i})
+    legacy = perf_counter() - start
+
+    StandInHydra.fail_every = args.fail_every
+    start = perf_counter()
+    for i in range(args.n):
+        conn.call('get_scenario', {'scenario_id': i})
+    pooled = perf_counter() - start
+
+    server.shutdown()
+
+    print('{} calls, {} kB responses'.format(args.n, args.kb))
+    print('{:<10}{:>12}{:>16}'.format('client', 'time (s)', 'per call (ms)'))
+    print('{:<10}{:>12.3f}{:>16.2f}'.format('legacy', legacy, legacy / args.n * 1000))
+    print('{:<10}{:>12.3f}{:>16.2f}'.format('pooled', pooled, pooled / args.n * 1000))
+    print(json.dumps(conn.stats(), indent=2))
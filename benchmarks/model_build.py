@@ -0,0 +1,99 @@
+"""
+Compare the time it takes to build a Pywr model from a JSON file in a temporary folder (the default) with building it
+directly from the model dictionary in memory (--inmem).
+
+Usage (from the repository root):
+
+    python benchmarks/model_build.py [--n 10]
+"""
+
+import os
+import sys
+import json
+import argparse
+from copy import deepcopy
+from time import perf_counter
+from tempfile import mkdtemp
+from shutil import rmtree
+from importlib import import_module
+
+from pywr.core import Model
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+examples = {
+    'Merced': os.path.join(here, '..', 'examples', 'Merced_Model', 'merced'),
+    'Stanislaus': os.path.join(here, '..', 'examples', 'Stan_Model', 'Stan_Model'),
+}
+
+
+def register_policies(root_dir):
+    # this is the same as in the examples' load_model, and is not part of the timing
+    for name in list(sys.modules):
+        if name.split('.')[0] in ['_parameters', 'policies', 'domains', 'parameters', 'utilities']:
+            del sys.modules[name]
+    os.chdir(root_dir)
+    sys.path.insert(0, root_dir)
+    for filename in os.listdir('_parameters'):
+        if '__init__' in filename or not filename.endswith('.py'):
+            continue
+        import_module('.{}'.format(os.path.splitext(filename)[0]), '_parameters')
+    for name, package in [('.IFRS', 'policies'), ('.domains', 'domains')]:
+        try:
+            import_module(name, package)
+        except:
+            pass
+    sys.path.remove(root_dir)
+
+
+def build_from_file(pywr_model):
+    cwd = os.getcwd()
+    start = perf_counter()
+    root_dir = mkdtemp()
+    os.chdir(root_dir)
+    model_filename = os.path.join(root_dir, 'pywr_model.json')
+    with open(model_filename, 'w') as f:
+        json.dump(pywr_model, f, indent=4)
+    Model.load(model_filename, path=model_filename)
+    elapsed = perf_counter() - start
+    os.chdir(cwd)
+    rmtree(root_dir)
+    return elapsed
+
+
+def build_in_memory(pywr_model):
+    start = perf_counter()
+    Model.load(pywr_model)
+    return perf_counter() - start
+
+
+def benchmark(name, root_dir, n):
+    root_dir = os.path.abspath(root_dir)
+    register_policies(root_dir)
+    with open(os.path.join(root_dir, 'pywr_model.json')) as f:
+        pywr_model = json.load(f)
+
+    results = {}
+    for method, build in [('file', build_from_file), ('in memory', build_in_memory)]:
+        times = []
+        for i in range(n):
+            model = deepcopy(pywr_model)  # Pywr may modify the dictionary while loading
+            os.chdir(root_dir)  # policies may read data relative to the model folder
+            times.append(build(model))
+        results[method] = sorted(times)[len(times) // 2]
+
+    print('{:<12}{:>8}{:>14}{:>14}{:>10}'.format(
+        name, len(pywr_model['nodes']), results['file'] * 1000, results['in memory'] * 1000,
+        results['file'] / results['in memory']
+    ))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark Pywr model building')
+    parser.add_argument('--n', dest='n', type=int, default=10, help='''Number of builds per method.''')
+    args = parser.parse_args()
+
+    print('Median build time (ms)')
+    print('{:<12}{:>8}{:>14}{:>14}{:>10}'.format('model', 'nodes', 'file', 'in memory', 'speedup'))
+    for name, root_dir in examples.items():
+        benchmark(name, root_dir, args.n)
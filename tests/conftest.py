@@ -0,0 +1,28 @@
+import os
+import collections
+import collections.abc
+from tempfile import mkdtemp
+
+import pytest
+
+# attrdict, used by waterlp.models.system, still imports these from collections (removed in Python 3.10)
+for name in ['Mapping', 'MutableMapping', 'Sequence']:
+    if not hasattr(collections, name):
+        setattr(collections, name, getattr(collections.abc, name))
+
+# keep the caches created when waterlp.models is imported out of the source tree
+_cache_root = mkdtemp(prefix='waterlp-tests-')
+os.environ.setdefault('WATERLP_MODEL_CACHE_DIR', os.path.join(_cache_root, 'models'))
+os.environ.setdefault('WATERLP_SOURCE_DATA_CACHE_DIR', os.path.join(_cache_root, 'source_data'))
+os.environ.setdefault('WATERLP_DATA_CACHE_DIR', os.path.join(_cache_root, 'data'))
+
+
+_cwd = os.getcwd()
+
+
+@pytest.fixture(autouse=True)
+def restore_cwd():
+    # models change the working directory to their temporary folders, which are removed when they finish
+    os.chdir(_cwd)
+    yield
+    os.chdir(_cwd)
@@ -0,0 +1,125 @@
+"""A small network, as exported from Hydra, for tests that need a connection and a WaterSystem"""
+
+import json
+from argparse import Namespace
+
+import numpy as np
+
+TEMPLATE_ID = 1
+TYPES = {1: 'Test Network', 2: 'Inflow Node', 3: 'Urban Demand', 4: 'Conveyance', 5: 'Outflow Node'}
+
+
+def timeseries(values, start='2000-01-01'):
+    dates = np.arange(np.datetime64(start), np.datetime64(start) + len(values))
+    return json.dumps({'0': {'{}T00:00:00.000Z'.format(d): v for d, v in zip(dates, values)}})
+
+
+def dataset(id, type, value, **metadata):
+    return {'id': id, 'type': type, 'value': value, 'metadata': json.dumps(metadata), 'dimension': 'dimensionless'}
+
+
+def typeattr(attr_id, attr_name, is_var='N', **properties):
+    return {'attr_id': attr_id, 'attr_name': attr_name, 'is_var': is_var, 'properties': properties,
+            'unit': None, 'dimension': None}
+
+
+def resource(id, name, type_id, attributes):
+    return {
+        'id': id,
+        'name': name,
+        'description': '',
+        'types': [{'template_id': TEMPLATE_ID, 'id': type_id, 'name': TYPES[type_id]}],
+        'attributes': [{'id': ra_id, 'attr_id': attr_id, 'attr_name': attr_name, 'attr_is_var': 'N'}
+                       for ra_id, attr_id, attr_name in attributes],
+    }
+
+
+def export(resource_scenarios, folder=None):
+    """
+    A network with an inflow supplying a demand, with any surplus leaving through an outflow, with the given data
+    (resource attribute id: dataset) in its only scenario. Resource attributes are: 1 network Description,
+    11 Inflow Runoff, 21 Demand Demand, 22 Demand Value, 23 Demand Description and 24 Demand Priority (an intermediary
+    attribute that isn't used by the model). Runoff and Demand are saved.
+    """
+    template = {
+        'id': TEMPLATE_ID,
+        'name': 'Test Template',
+        'types': [
+            {'id': 1, 'name': 'Test Network', 'resource_type': 'NETWORK', 'typeattrs': [typeattr(1, 'Description')]},
+            {'id': 2, 'name': 'Inflow Node', 'resource_type': 'NODE', 'typeattrs': [typeattr(2, 'Runoff', save=True)]},
+            {'id': 3, 'name': 'Urban Demand', 'resource_type': 'NODE', 'typeattrs': [
+                typeattr(3, 'Demand', save=True), typeattr(4, 'Value'), typeattr(1, 'Description'),
+                typeattr(5, 'Priority', intermediary=True),
+            ]},
+            {'id': 4, 'name': 'Conveyance', 'resource_type': 'LINK', 'typeattrs': []},
+            {'id': 5, 'name': 'Outflow Node', 'resource_type': 'NODE', 'typeattrs': []},
+        ],
+    }
+
+    layout = {'storage': {'location': 'AmazonS3', 'folder': folder} if folder else {'location': 'local'}}
+    network = resource(1, 'Test Network', 1, [(1, 1, 'Description')])
+    network.update({
+        'layout': layout,
+        'nodes': [
+            resource(1, 'Inflow', 2, [(11, 2, 'Runoff')]),
+            resource(2, 'Demand', 3, [(21, 3, 'Demand'), (22, 4, 'Value'), (23, 1, 'Description'),
+                                      (24, 5, 'Priority')]),
+            resource(3, 'Outflow', 5, []),
+        ],
+        'links': [
+            dict(resource(4, 'To Demand', 4, []), node_1_id=1, node_2_id=2),
+            dict(resource(5, 'To Outflow', 4, []), node_1_id=1, node_2_id=3),
+        ],
+        'scenarios': [{
+            'id': 1,
+            'name': 'Baseline',
+            'layout': {},
+            'resourcescenarios': [{'resource_attr_id': ra_id, 'dataset_id': value['id'], 'value': value}
+                                  for ra_id, value in resource_scenarios.items()],
+        }],
+    })
+
+    return {'network': network, 'template': template, 'template_attributes': []}
+
+
+def args(filename, **kwargs):
+    kwargs = dict(dict(
+        filename=filename, data_url=None, app_name='test', session_id=None, user_id=1, network_id=1, template_id=None,
+        run_name='test', foresight='zero', suppress_input=False, debug=False, debug_ts=None, debug_start=None,
+        verbose=False, warm=False, in_memory=True, precompute=False,
+    ), **kwargs)
+    return Namespace(**kwargs)
+
+
+def create_connection(tmpdir, resource_scenarios, folder=None, **kwargs):
+    """Create a connection to the network, exported to a file"""
+    from waterlp.connection import connection
+
+    path = str(tmpdir.join('network.json'))
+    with open(path, 'w') as f:
+        json.dump(export(resource_scenarios, folder=folder), f)
+
+    return connection(args=args(path, **kwargs))
+
+
+def create_system(tmpdir, resource_scenarios, folder=None, start='2000-01-01', end='2000-01-10', **kwargs):
+    """Create a connection and a WaterSystem with the network's only scenario, ready to collect source data"""
+    from waterlp.models.system import WaterSystem
+
+    conn = create_connection(tmpdir, resource_scenarios, folder=folder, **kwargs)
+    run_args = args(conn.filename, **kwargs)
+    system = WaterSystem(conn=conn, name='test', network=conn.network, all_scenarios=conn.network.scenarios,
+                         template=conn.template, args=run_args)
+
+    source = conn.network.scenarios[0]
+    system.scenario = Namespace(
+        source_ids=[source.id],
+        source_scenarios={source.id: source},
+        subscenarios={'options': [], 'scenarios': []},
+        start_time=start,
+        end_time=end,
+        time_step='day',
+    )
+    system.initialize_time_steps()
+
+    return system
@@ -0,0 +1,238 @@
+import os
+import json
+from copy import deepcopy
+
+import numpy as np
+import pytest
+
+from waterlp.models import cache as cache_module
+from waterlp.models.cache import ModelCache, SourceDataCache, ArtifactStore, model_key, source_data_context, \
+    MODEL_FILENAME, POLICIES_FILENAME
+
+
+def resource(id, name, template_id=1, type_name='Junction', attributes=()):
+    return {
+        'id': id,
+        'name': name,
+        'types': [{'template_id': template_id, 'id': 10, 'name': type_name}],
+        'attributes': [{'id': ra_id, 'attr_id': attr_id, 'attr_name': attr_name}
+                       for ra_id, attr_id, attr_name in attributes],
+    }
+
+
+@pytest.fixture
+def network():
+    network = resource(1, 'Network')
+    network.update(description='', layout={})
+    network['nodes'] = [resource(1, 'A', attributes=[(1, 1, 'Runoff')]), resource(2, 'B')]
+    network['links'] = [dict(resource(1, 'A to B'), node_1_id=1, node_2_id=2)]
+    return network
+
+
+def key(network, **kwargs):
+    kwargs.setdefault('constants', {('node', 1, 1): 5.0})
+    kwargs.setdefault('parameters', {('node', 2, 1): {'type': 'parameter', 'value': {'code': 'return 1'}}})
+    return model_key(network, {'id': 1}, start='2000-01-01', end='2000-12-31', step=1, **kwargs)
+
+
+def test_model_key_is_stable(network):
+    assert key(network) == key(deepcopy(network))
+    constants = {('node', 2, 1): 2.0, ('node', 1, 1): 1.0}
+    reordered = {('node', 1, 1): 1.0, ('node', 2, 1): 2.0}
+    assert key(network, constants=constants) == key(network, constants=reordered)
+
+
+def test_model_key_ignores_scenario_data(network):
+    changed = deepcopy(network)
+    changed['nodes'][0]['x'] = 100  # e.g., the layout of the node
+    changed['nodes'][0]['attributes'][0]['value'] = 'data'
+    assert key(network) == key(changed)
+
+
+def test_model_key_changes_with_model_content(network):
+    keys = [
+        key(network),
+        key(network, constants={('node', 1, 1): 6.0}),
+        key(network, parameters={('node', 2, 1): {'type': 'parameter', 'value': {'code': 'return 2'}}}),
+        key(network, patchable=[('node', 1, 1)]),
+        key(network, scenarios=[{'name': 'variations', 'size': 2}]),
+        model_key(network, {'id': 1}, start='2000-01-01', end='2001-12-31', step=1),
+    ]
+    renamed = deepcopy(network)
+    renamed['nodes'][1]['name'] = 'C'
+    keys.append(key(renamed))
+    assert len(set(keys)) == len(keys)
+
+
+def test_model_key_hashes_arrays_by_content(network):
+    values = np.arange(10.0)
+    same = key(network, constants={('node', 1, 1): values})
+    assert same == key(network, constants={('node', 1, 1): values.copy()})
+    values[0] = -1
+    assert same != key(network, constants={('node', 1, 1): values})
+
+
+def test_model_cache_get_and_put(tmpdir):
+    cache = ModelCache(root=str(tmpdir))
+    assert cache.get('abc') is None
+
+    path = cache.put('abc', {'nodes': []}, '# policies')
+    assert cache.get('abc') == path
+    assert os.path.exists(os.path.join(path, MODEL_FILENAME))
+    with open(os.path.join(path, POLICIES_FILENAME)) as f:
+        assert f.read() == '# policies'
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    # another worker adding the same model doesn't fail
+    assert cache.put('abc', {'nodes': []}, '# policies') == path
+    assert cache.stats()['entries'] == 1
+
+
+def test_model_cache_evicts_least_recently_used(tmpdir):
+    cache = ModelCache(root=str(tmpdir))
+    for i, key in enumerate(['a', 'b', 'c']):
+        cache.put(key, {'nodes': ['x' * 1000]}, '')
+        os.utime(cache.path(key, 'cache.json'), (i, i))
+    cache.get('a')  # a is now the most recently used
+
+    size = sum([size for key, last_used, size in cache.entries()])
+    cache.max_size = size * 2 / 3 + 1
+    cache.evict()
+
+    assert [key for key, last_used, size in cache.entries()] == ['c', 'a']
+    assert cache.get('b') is None
+    assert cache.evictions == 1
+
+
+def test_model_cache_evicts_old_entries(tmpdir):
+    cache = ModelCache(root=str(tmpdir), max_age=3600)
+    cache.put('old', {}, '')
+    cache.put('new', {}, '')
+    os.utime(cache.path('old', 'cache.json'), (0, 0))
+    cache.evict()
+    assert [key for key, last_used, size in cache.entries()] == ['new']
+
+
+def dataset_value(value, **metadata):
+    return {'type': 'timeseries', 'value': value, 'metadata': json.dumps(metadata)}
+
+
+def test_source_data_cache_get_and_put(tmpdir):
+    cache = SourceDataCache(root=str(tmpdir))
+    context = source_data_context(['2000-01-01'], fill_value=0)
+    content_hash = cache.content_hash(dataset_value('[1, 2]'))
+    assert cache.get(1, context, content_hash) == (False, None)
+
+    cache.put(1, context, content_hash, {0: np.arange(2.0)})
+    found, value = cache.get(1, context, content_hash)
+    assert found and list(value[0]) == [0.0, 1.0]
+
+    # a cached value of None is still found
+    cache.put(2, context, content_hash, None)
+    assert cache.get(2, context, content_hash) == (True, None)
+
+    # a different evaluation context (e.g., other dates) is a different entry
+    assert cache.get(1, source_data_context(['2000-01-02'], fill_value=0), content_hash) == (False, None)
+    assert (cache.hits, cache.misses, cache.updates) == (2, 2, 0)
+
+
+def test_source_data_cache_replaces_changed_datasets(tmpdir):
+    cache = SourceDataCache(root=str(tmpdir))
+    context = source_data_context([])
+    old = cache.content_hash(dataset_value('[1, 2]'))
+    new = cache.content_hash(dataset_value('[1, 3]'))
+    assert new != old != cache.content_hash(dataset_value('[1, 2]', input_method='function'))
+    assert old == cache.content_hash(dict(dataset_value('[1, 2]'), id=10, name='other'))
+
+    cache.put(1, context, old, 'old')
+    assert cache.get(1, context, new) == (False, None)
+    assert cache.updates == 1
+    cache.put(1, context, new, 'new')
+    assert cache.get(1, context, new) == (True, 'new')
+    assert cache.stats()['entries'] == 1
+
+
+def test_source_data_cache_bad_entries(tmpdir):
+    cache = SourceDataCache(root=str(tmpdir))
+    context = source_data_context([])
+    with open(cache.path(1, context), 'wb') as f:
+        f.write(b'incomplete')
+    assert cache.get(1, context, 'abc') == (False, None)
+
+    # values that can't be pickled aren't cached
+    cache.put(2, context, 'abc', lambda: None)
+    assert cache.get(2, context, 'abc') == (False, None)
+    assert sorted(os.listdir(str(tmpdir))) == [os.path.basename(cache.path(1, context))]
+
+
+def test_source_data_cache_evicts_least_recently_used(tmpdir):
+    cache = SourceDataCache(root=str(tmpdir))
+    context = source_data_context([])
+    for i in range(3):
+        cache.put(i, context, 'abc', 'x' * 1000)
+        os.utime(cache.path(i, context), (i, i))
+    cache.get(0, context, 'abc')  # 0 is now the most recently used
+
+    cache.max_size = cache.stats()['size'] * 2 / 3 + 1
+    cache.evict()
+
+    assert cache.get(1, context, 'abc') == (False, None)
+    assert cache.get(0, context, 'abc')[0] and cache.get(2, context, 'abc')[0]
+    assert cache.evictions == 1
+
+
+def test_artifact_store_folder(tmpdir):
+    store = ArtifactStore(root=str(tmpdir))
+    system = {'name': 'system', 'values': np.arange(3.0)}
+    key = store.put(system)
+    same = deepcopy(system)
+    assert store.put(same) == key  # published once, by content
+    assert store.published == 1
+    assert store.get(key) is same  # kept in this process
+    assert store.hits == 1
+
+    # e.g., a worker
+    worker = ArtifactStore(root=str(tmpdir), size=1)
+    loaded = worker.get(key)
+    assert loaded['name'] == 'system' and list(loaded['values']) == [0.0, 1.0, 2.0]
+    assert worker.get(key) is loaded
+    other_key = store.put('other')
+    assert worker.get(other_key) == 'other'
+    worker.get(key)  # no longer kept in the worker
+    assert (worker.loads, worker.hits) == (3, 1)
+
+
+def test_artifact_store_folder_expires(tmpdir):
+    store = ArtifactStore(root=str(tmpdir), ttl=3600)
+    old = store.put('old')
+    os.utime(store.path(old), (0, 0))
+    new = store.put('new')  # old artifacts are removed when new ones are published
+    assert os.listdir(str(tmpdir)) == [os.path.basename(store.path(new))]
+    with pytest.raises(FileNotFoundError):
+        ArtifactStore(root=str(tmpdir)).get(old)
+
+
+def test_artifact_store_redis():
+    fakeredis = pytest.importorskip('fakeredis')
+    redis = fakeredis.FakeRedis()
+    store = ArtifactStore(redis=redis, ttl=60)
+    key = store.put({'name': 'system'})
+    assert store.put({'name': 'system'}) == key and store.published == 1
+    assert 0 < redis.ttl(ArtifactStore.prefix + key) <= 60
+
+    assert ArtifactStore(redis=redis).get(key) == {'name': 'system'}
+    with pytest.raises(Exception, match='may have expired'):
+        ArtifactStore(redis=redis).get('missing')
+
+
+def test_get_artifact_store(tmpdir, monkeypatch):
+    monkeypatch.setattr(cache_module, 'artifact_store', None)
+    monkeypatch.setenv('WATERLP_ARTIFACT_STORE', 'N')
+    assert cache_module.get_artifact_store() is None
+
+    monkeypatch.setenv('WATERLP_ARTIFACT_STORE', 'Y')
+    monkeypatch.setenv('WATERLP_ARTIFACT_DIR', str(tmpdir))
+    monkeypatch.setenv('WATERLP_ARTIFACT_TTL_HOURS', '1')
+    store = cache_module.get_artifact_store()
+    assert (store.root, store.ttl, store.size) == (str(tmpdir), 3600, 2)
+    assert cache_module.get_artifact_store() is store  # one per process
@@ -0,0 +1,54 @@
+import time
+
+import pytest
+
+fakeredis = pytest.importorskip('fakeredis')
+
+from waterlp.utils import cancellation
+from waterlp.utils.cancellation import CancellationListener
+from waterlp.utils.states import ProcessState
+
+
+@pytest.fixture
+def listener(monkeypatch):
+    redis = fakeredis.FakeRedis()
+    listener = CancellationListener(redis)
+    monkeypatch.setattr(cancellation, 'local_redis', redis)
+    monkeypatch.setattr(cancellation, 'listener', listener)
+    return listener
+
+
+def wait_for(condition, timeout=2):
+    start = time.time()
+    while not condition() and time.time() - start < timeout:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_is_canceled(listener):
+    cancellation.set_state('a', ProcessState.CANCELED)
+    assert cancellation.is_canceled('a')
+    assert not cancellation.is_canceled('b')
+
+    # published states are seen without checking Redis again
+    cancellation.set_state('b', ProcessState.CANCELED)
+    assert wait_for(lambda: cancellation.is_canceled('b'))
+    cancellation.set_state('b', ProcessState.RUNNING)
+    assert wait_for(lambda: not cancellation.is_canceled('b'))
+
+
+def test_watched_runs_are_bounded(listener, monkeypatch):
+    monkeypatch.setattr(cancellation, 'MAX_WATCHED', 2)
+    cancellation.set_state('a', ProcessState.CANCELED)
+    for sid in ['a', 'b', 'a', 'c']:
+        cancellation.is_canceled(sid)
+    assert list(listener.watched) == ['a', 'c']
+    assert listener.canceled == {'a'}
+
+    cancellation.forget('a')
+    assert list(listener.watched) == ['c'] and not listener.canceled
+
+    # states of runs that aren't watched are ignored
+    cancellation.set_state('d', ProcessState.CANCELED)
+    time.sleep(0.1)
+    assert not listener.canceled
@@ -0,0 +1,145 @@
+import json
+from time import sleep
+
+import pytest
+from requests import Response
+from requests.exceptions import ConnectionError, ConnectTimeout
+
+from waterlp import connection as connection_module
+from tests.networks import create_connection
+
+
+def response(status_code=200, content=None):
+    r = Response()
+    r.status_code = status_code
+    r._content = json.dumps(content if content is not None else {'id': 1}).encode()
+    r._content_consumed = True
+    return r
+
+
+class Hydra(object):
+    """Responses (or errors) to the calls made, in order"""
+
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.calls = []
+
+    def post(self, url, data=None, headers=None, **kwargs):
+        self.calls.append((data, headers))
+        result = self.responses.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+
+@pytest.fixture
+def conn(tmpdir):
+    return create_connection(tmpdir, {})
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(connection_module, 'sleep', sleeps.append)
+    return sleeps
+
+
+def hydra(monkeypatch, *responses):
+    hydra = Hydra(*responses)
+    monkeypatch.setattr(connection_module, 'http_session', hydra)
+    return hydra
+
+
+def test_retry_idempotent_calls(conn, sleeps, monkeypatch):
+    server = hydra(monkeypatch, response(503), ConnectionError('reset'), response(200, {'id': 5}))
+    assert conn.call('get_scenario', {'scenario_id': 5}) == {'id': 5}
+    assert len(server.calls) == 3
+    assert sleeps == [connection_module.BACKOFF, connection_module.BACKOFF * 2]
+    assert conn.stats()['get_scenario']['retries'] == 2
+
+
+def test_no_retries_for_other_calls(conn, sleeps, monkeypatch):
+    fault = {'faultcode': 'Server', 'faultstring': 'Bad gateway'}
+    server = hydra(monkeypatch, response(503, fault))
+    assert conn.call('add_scenario', {}) == fault
+    assert len(server.calls) == 1
+
+    # the request may have reached Hydra, which may have added the scenario
+    server = hydra(monkeypatch, ConnectionError('reset'))
+    with pytest.raises(ConnectionError):
+        conn.call('add_scenario', {})
+    assert len(server.calls) == 1 and not sleeps
+    assert conn.stats()['add_scenario']['errors'] == 2
+
+
+def test_retry_calls_that_were_not_sent(conn, sleeps, monkeypatch):
+    server = hydra(monkeypatch, ConnectTimeout('timed out'), response(200, {'id': 7}))
+    assert conn.call('add_scenario', {}) == {'id': 7}
+    assert len(server.calls) == 2 and len(sleeps) == 1
+
+
+def test_give_up_after_retries(conn, sleeps, monkeypatch):
+    errors = [ConnectionError('reset')] * (connection_module.MAX_RETRIES + 1)
+    server = hydra(monkeypatch, *errors)
+    with pytest.raises(ConnectionError):
+        conn.call('get_network', {})
+    assert len(server.calls) == connection_module.MAX_RETRIES + 1
+    assert conn.stats()['get_network']['errors'] == 1
+
+    server = hydra(monkeypatch, *[response(504)] * (connection_module.MAX_RETRIES + 1))
+    assert conn.call('get_network', {}) is not None
+    assert len(server.calls) == connection_module.MAX_RETRIES + 1
+
+
+def test_large_and_compressed_calls(conn, monkeypatch):
+    monkeypatch.setattr(connection_module, 'GZIP_REQUESTS', True)
+    server = hydra(monkeypatch, response(200, {'id': 1, 'scenarios': [{'id': 2, 'layout': {}}]}), response(200))
+
+    network = conn.call('get_network', {'names': ['x' * connection_module.GZIP_MIN_BYTES]}, large=True)
+    assert network.scenarios[0].id == 2
+    assert server.calls[0][1]['Content-Encoding'] == 'gzip'
+
+    conn.call('get_network', {})  # too small to compress
+    assert 'Content-Encoding' not in server.calls[1][1]
+
+
+def scenario(id, parent=None):
+    return connection_module.JSONObject({'id': id, 'layout': {'parent': parent} if parent else {}})
+
+
+ALL_SCENARIOS = [scenario(1), scenario(2, parent=1), scenario(3, parent=2), scenario(4), scenario(5, parent=2)]
+
+
+def test_prefetch_scenarios(conn, monkeypatch):
+    # scenario 1 is downloaded with the network
+    calls = []
+
+    def call(func, args, large=False):
+        calls.append((func, args['scenario_id']))
+        if args['scenario_id'] == 4:
+            return {'faultcode': 'Server', 'faultstring': 'Permission denied'}
+        return [s for s in ALL_SCENARIOS if s.id == args['scenario_id']][0]
+
+    monkeypatch.setattr(conn, 'call', call)
+
+    assert conn.prefetch_scenarios([3], ALL_SCENARIOS) == [2, 3]
+    assert sorted(calls) == [('get_scenario', 2), ('get_scenario', 3)]
+    assert sorted(conn.scenarios) == [1, 2, 3]
+
+    # already downloaded, so not downloaded again
+    assert conn.prefetch_scenarios([5], ALL_SCENARIOS) == [5]
+    assert conn.get_scenario(2).id == 2
+    assert len(calls) == 3
+
+    # errors are not kept, so the scenario can be downloaded again
+    assert conn.prefetch_scenarios([4], ALL_SCENARIOS) == [4]
+    assert 4 not in conn.scenarios
+
+
+def test_call_many_in_order(conn, monkeypatch):
+    def call(func, args, large=False):
+        sleep(0.01 * (5 - args['i']))  # the first calls finish last
+        return args['i']
+
+    monkeypatch.setattr(conn, 'call', call)
+    assert conn.call_many('get_scenario', [{'i': i} for i in range(5)]) == list(range(5))
@@ -0,0 +1,94 @@
+import os
+
+import numpy as np
+import pandas as pd
+from pandas.testing import assert_frame_equal
+
+from waterlp.models.base.parameters.datastore import DataStore
+
+
+def write_csv(tmpdir, name, rows=10, **columns):
+    columns = columns or {'flow': np.arange(rows, dtype=float)}
+    data = pd.DataFrame(columns, index=pd.date_range('2000-01-01', periods=rows, name='date'))
+    path = str(tmpdir.join(name))
+    data.to_csv(path)
+    return path
+
+
+def memory_mapped(values):
+    while values is not None:
+        if isinstance(values, np.memmap):
+            return True
+        values = getattr(values, 'base', None)
+    return False
+
+
+def test_read_csv_from_memory_and_disk(tmpdir):
+    path = write_csv(tmpdir, 'flow.csv', label=['a', 'b'] * 5, flow=np.arange(10.0))
+    root = str(tmpdir.join('cache'))
+
+    store = DataStore(root=root)
+    data = store.read_csv(path, index_col=0, parse_dates=True)
+    assert store.read_csv(path, index_col=0, parse_dates=True) is data
+    assert (store.misses, store.hits) == (1, 1)
+
+    # e.g., another worker process
+    other = DataStore(root=root)
+    assert_frame_equal(other.read_csv(path, index_col=0, parse_dates=True), data)
+    assert (other.misses, other.disk_hits) == (0, 1)
+
+    # different arguments are different data
+    other.read_csv(path)
+    assert other.misses == 1
+
+
+def test_memory_mapped_copy_on_write(tmpdir):
+    path = write_csv(tmpdir, 'flow.csv')
+    root = str(tmpdir.join('cache'))
+    DataStore(root=root).read_csv(path, index_col=0)
+
+    data = DataStore(root=root).read_csv(path, index_col=0)
+    assert memory_mapped(data.values)
+    data.iloc[0, 0] = 100.0  # callers can modify the data...
+    assert data.iloc[0, 0] == 100.0
+
+    # ...without changing it on disk
+    assert DataStore(root=root).read_csv(path, index_col=0).iloc[0, 0] == 0.0
+
+
+def test_changed_source(tmpdir):
+    path = write_csv(tmpdir, 'flow.csv')
+    store = DataStore(root=str(tmpdir.join('cache')))
+    store.read_csv(path, index_col=0)
+
+    write_csv(tmpdir, 'flow.csv', rows=20)
+    assert len(store.read_csv(path, index_col=0)) == 10  # sources are checked once per run
+
+    store.reset()
+    assert len(store.read_csv(path, index_col=0)) == 20
+    assert store.misses == 2
+    assert len(DataStore(root=str(tmpdir.join('cache'))).read_csv(path, index_col=0)) == 20
+
+
+def test_least_recently_used_evicted(tmpdir):
+    paths = [write_csv(tmpdir, '{}.csv'.format(name)) for name in 'abc']
+    size = DataStore().read_csv(paths[0], index_col=0).memory_usage(index=True).sum()
+
+    store = DataStore(max_bytes=size * 2)
+    a = store.read_csv(paths[0], index_col=0)
+    store.read_csv(paths[1], index_col=0)
+    store.read_csv(paths[0], index_col=0)
+    store.read_csv(paths[2], index_col=0)
+
+    assert len(store.data) == 2 and store.nbytes == size * 2
+    assert store.read_csv(paths[0], index_col=0) is a
+    store.read_csv(paths[1], index_col=0)
+    assert store.misses == 4  # b was evicted, not a
+
+
+def test_without_disk(tmpdir):
+    path = write_csv(tmpdir, 'flow.csv')
+    store = DataStore()
+    store.read_csv(path, index_col=0)
+    assert sorted(os.listdir(str(tmpdir))) == ['flow.csv']
+    assert DataStore().read_csv(path, index_col=0) is not None
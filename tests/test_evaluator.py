@@ -0,0 +1,50 @@
+import json
+
+import numpy as np
+from numpy.testing import assert_array_equal
+
+from waterlp.models.evaluator import decode_timeseries
+
+DATES = np.arange('2000-01-01', '2000-01-06', dtype='datetime64[D]')
+
+
+def timeseries(**columns):
+    return json.dumps({column: {'{}T00:00:00.000Z'.format(date): value for date, value in values.items()}
+                       for column, values in columns.items()})
+
+
+def test_decode_timeseries():
+    # keys are not necessarily sorted, and dates can be missing
+    ts = timeseries(**{'0': {'2000-01-03': 3, '2000-01-01': 1, '2000-01-02': None, '2000-01-05': 5}})
+    result = decode_timeseries(ts, DATES)
+    assert list(result) == [0]
+    assert result[0].dtype == np.float64
+    assert_array_equal(result[0], [1, np.nan, 3, np.nan, 5])
+
+    assert_array_equal(decode_timeseries(ts, DATES, fill_value=0)[0], [1, 0, 3, 0, 5])
+
+
+def test_decode_timeseries_ignores_other_dates():
+    ts = timeseries(**{'0': {'1999-12-31': -1, '2000-01-02': 2, '2000-02-01': -1}})
+    assert_array_equal(decode_timeseries(ts, DATES, fill_value=0)[0], [0, 2, 0, 0, 0])
+
+
+def test_decode_periodic_timeseries():
+    ts = timeseries(**{'0': {'9999-01-01': 1, '9999-01-02': 2, '9999-12-31': 12}})
+    dates = np.array(['2000-12-31', '2001-01-01', '2001-01-02', '2001-01-03'], dtype='datetime64[D]')
+    assert_array_equal(decode_timeseries(ts, dates)[0], [12, 1, 2, np.nan])
+
+
+def test_decode_timeseries_columns():
+    ts = timeseries(**{'0': {'2000-01-01': 1, '2000-01-02': 2}, 'block': {'2000-01-02': 20, '2000-01-03': 30}})
+    result = decode_timeseries(ts, DATES)
+    assert list(result) == [0, 'block']
+    assert_array_equal(result['block'], [np.nan, 20, 30, np.nan, np.nan])
+
+    assert_array_equal(decode_timeseries(ts, DATES, flatten=True)[0], [1, 22, 30, 0, 0])
+
+
+def test_decode_empty_timeseries():
+    for ts in [None, '', '{}']:
+        result = decode_timeseries(ts, DATES, fill_value=0)
+        assert_array_equal(result[0], np.zeros(len(DATES)))
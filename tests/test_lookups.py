@@ -0,0 +1,66 @@
+import numpy as np
+import pandas as pd
+import pytest
+from numpy.testing import assert_array_equal
+from pywr.core import Model
+
+from waterlp.models.base.parameters import WaterLPParameter
+from waterlp.models.base.parameters.lookups import TimestepLookup, water_year
+
+
+def create_model(start, end):
+    model = Model(start=start, end=end)
+    model.timestepper.setup()
+    return model
+
+
+def looked_up(model, lookup):
+    model.timestepper.reset()
+    return np.array([lookup[timestep] for timestep in model.timestepper])
+
+
+def test_by_date():
+    model = create_model('2000-01-01', '2000-01-04')
+    data = pd.Series([1.0, 2.0, 4.0], index=['2000-01-01', '2000-01-02', '2000-01-04'])
+    assert_array_equal(looked_up(model, TimestepLookup(model, data)), [1.0, 2.0, np.nan, 4.0])
+
+
+def test_by_day_of_year():
+    model = create_model('2000-02-27', '2000-03-01')
+    data = pd.Series([1.0, 2.0, 3.0], index=['1900-02-27', '1900-02-28', '1900-03-01'])  # no leap day
+    assert_array_equal(looked_up(model, TimestepLookup(model, data, by='dayofyear')), [1.0, 2.0, 2.0, 3.0])
+
+    data = pd.Series([1.0, 2.0, 2.5, 3.0], index=['2000-02-27', '2000-02-28', '2000-02-29', '2000-03-01'])
+    assert_array_equal(looked_up(model, TimestepLookup(model, data, by='dayofyear')), [1.0, 2.0, 2.5, 3.0])
+
+
+def test_by_year_and_water_year():
+    model = create_model('2000-09-29', '2000-10-02')
+    data = pd.DataFrame({'a': [1.0, 2.0], 'b': [10.0, 20.0]}, index=['2000', '2001'])
+    assert_array_equal(looked_up(model, TimestepLookup(model, data, by='year', column='b')), [10.0] * 4)
+    assert_array_equal(looked_up(model, TimestepLookup(model, data, by='wateryear', column='a')), [1.0, 1.0, 2.0, 2.0])
+    assert_array_equal(looked_up(model, TimestepLookup(model, data, by='wateryear', column='a', water_year_start=9)),
+                       [2.0] * 4)
+    assert list(water_year(pd.DatetimeIndex(['2000-09-30', '2000-10-01']))) == [2000, 2001]
+
+
+def test_unknown_lookup_type():
+    model = create_model('2000-01-01', '2000-01-02')
+    with pytest.raises(Exception, match='Unknown lookup type'):
+        TimestepLookup(model, pd.Series([1.0]), by='month')
+
+
+def test_reset_with_parameter():
+    model = create_model('2000-01-01', '2000-01-02')
+    parameter = WaterLPParameter(model, name='lookup_test')
+    data = pd.Series([1.0, 2.0], index=['2000-01-01', '2000-01-02'])
+    lookup = parameter.lookup(data)
+    assert parameter.lookups == (lookup,)
+    assert_array_equal(looked_up(model, lookup), [1.0, 2.0])
+
+    # the values are calculated again (e.g., for a new time period) after the parameter is reset
+    data.iloc[0] = 5.0
+    assert_array_equal(looked_up(model, lookup), [1.0, 2.0])
+    parameter.reset()
+    assert lookup.values is None
+    assert_array_equal(looked_up(model, lookup), [5.0, 2.0])
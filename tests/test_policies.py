@@ -0,0 +1,148 @@
+import os
+import linecache
+
+import pytest
+
+from pywr.core import Model
+from pywr.parameters import parameter_registry
+
+from waterlp.models import utils
+from waterlp.models.pywr2 import load_package
+from waterlp.models.utils import parse_code, join_policies, compile_policies, rewrite_references, \
+    find_policy_references
+
+TATTR = {'properties': {}}
+
+
+def policy_source(**code):
+    return join_policies({name: parse_code(name, user_code, {}, TATTR) for name, user_code in code.items()})
+
+
+def test_compile_policies_registers_policies():
+    module = compile_policies(policy_source(CompiledA='return 1', CompiledB='return 2'))
+    assert module.CompiledA.__name__ == 'CompiledA'
+    assert parameter_registry['compileda'] is module.CompiledA
+    assert parameter_registry['compiledb'] is module.CompiledB
+
+
+def test_compile_policies_caches_bytecode_by_source(tmpdir, monkeypatch):
+    source = policy_source(CachedPolicy='return 3')
+    compile_policies(source, cache_dir=str(tmpdir))
+    assert len(os.listdir(str(tmpdir))) == 1
+
+    # the same source is loaded from disk (e.g., in a new process) rather than compiled again
+    monkeypatch.setattr(utils, '_bytecode', {})
+    monkeypatch.setattr(utils, 'compile', lambda *args: pytest.fail('policies were compiled again'), raising=False)
+    module = compile_policies(source, cache_dir=str(tmpdir))
+    assert module.CachedPolicy(Model()).value(None, None) == 3
+    monkeypatch.undo()
+
+    compile_policies(policy_source(CachedPolicy='return 4'), cache_dir=str(tmpdir))
+    assert len(os.listdir(str(tmpdir))) == 2
+
+
+def test_compiled_policies_show_source_in_tracebacks():
+    module = compile_policies(policy_source(FailingPolicy='x = 0\nreturn 1 / x'))
+    with pytest.raises(ZeroDivisionError) as err:
+        module.FailingPolicy(Model()).value(None, None)
+    frame = err.traceback[-1]
+    assert linecache.getline(str(frame.path), frame.lineno + 1).strip() == 'return 1 / x'
+
+
+@pytest.mark.parametrize('code, precompute', [
+    ('return 10 + timestep.index % 3', True),
+    ('df = self.read_csv("data.csv")\nreturn df.iloc[timestep.index, 0]', True),
+    ('return self.GET("node/1/1", timestep, scenario_index)', False),
+    ('return self.model.nodes["Reservoir"].volume[0]', False),
+    ('return 1  # no precompute', False),
+])
+def test_precompute_flag(code, precompute):
+    source = parse_code('Policy', code, {}, TATTR)
+    assert 'precompute = {}'.format(precompute) in source
+
+
+def test_rewrite_references():
+    code = '\n'.join([
+        'a = self.model.parameters["node/A/Demand"].value(timestep, scenario_index)',
+        'b = self.model.parameters[\'node/B/Demand\'].get_value(scenario_index)',
+        'c = self.model.nodes["Reservoir [node]"].volume[scenario_index.global_id]',
+        'd = self.model.parameters[name].value(timestep, scenario_index)',
+    ])
+    assert rewrite_references(code).split('\n') == [
+        'a = self.get("node/A/Demand", timestep, scenario_index)',
+        'b = self.parameter(\'node/B/Demand\').get_value(scenario_index)',
+        'c = self.node("Reservoir [node]").volume[scenario_index.global_id]',
+        'd = self.model.parameters[name].value(timestep, scenario_index)',
+    ]
+    assert find_policy_references(code) == (['node/A/Demand', 'node/B/Demand'], ['Reservoir [node]'])
+    assert find_policy_references(rewrite_references(code)) == find_policy_references(code)
+
+
+def test_rewrite_references_arguments():
+    code = '\n'.join([
+        'a = self.model.parameters["node/Lake McClure/Storage Demand"].value(timestep, scenario_index)',
+        'b = self.model.parameters[ \'node/New Melones/Demand\' ].value( )',
+        'c = self.model.parameters["node/A/Demand"].value()',
+        'd = self.model.parameters["node/B/Demand"].value(\n    timestep=timestep, scenario_index=scenario_index)',
+    ])
+    assert rewrite_references(code).split('\n') == [
+        'a = self.get("node/Lake McClure/Storage Demand", timestep, scenario_index)',
+        'b = self.get(\'node/New Melones/Demand\')',
+        'c = self.get("node/A/Demand")',
+        'd = self.get("node/B/Demand", timestep=timestep, scenario_index=scenario_index)',
+    ]
+    assert find_policy_references(rewrite_references(code)) == find_policy_references(code) == ([
+        'node/A/Demand', 'node/B/Demand', 'node/Lake McClure/Storage Demand', 'node/New Melones/Demand'
+    ], [])
+
+
+MODULE_POLICY = '''
+from parameters import WaterLPParameter
+
+
+class HalfDemand(WaterLPParameter):
+
+    def value(self, timestep, scenario_index):
+        demand = self.model.parameters["demand"].value(timestep, scenario_index)
+        return demand * 0.5 + 0 * self.model.nodes["reservoir"].volume[scenario_index.global_id]
+
+    @classmethod
+    def load(cls, model, data):
+        return cls(model, **data)
+
+
+HalfDemand.register()
+'''
+
+
+def test_module_policy_references(tmpdir):
+    folder = tmpdir.mkdir('policies')
+    folder.join('__init__.py').write('from .half_demand import HalfDemand\n')
+    folder.join('half_demand.py').write(MODULE_POLICY)
+    package = load_package('test_module_policies', str(folder))
+
+    model = Model.load({
+        'metadata': {'title': 'Module policy', 'minimum_version': '1.0.0'},
+        'timestepper': {'start': '2000-01-01', 'end': '2000-01-05', 'timestep': 1},
+        'nodes': [
+            {'name': 'inflow', 'type': 'input', 'max_flow': 10},
+            {'name': 'reservoir', 'type': 'storage', 'max_volume': 100, 'initial_volume': 50},
+            {'name': 'demand', 'type': 'output', 'max_flow': 'half demand', 'cost': -10},
+        ],
+        'edges': [['inflow', 'reservoir'], ['reservoir', 'demand']],
+        'parameters': {
+            'demand': {'type': 'constant', 'value': 4},
+            'half demand': {'type': 'HalfDemand'},
+        },
+    })
+    parameter = model.parameters['half demand']
+    parameter.bind()
+
+    # references are found in the module source and used through the bound parameters and nodes
+    assert (package.HalfDemand.references, package.HalfDemand.node_references) == (['demand'], ['reservoir'])
+    assert parameter.bound == {'demand': model.parameters['demand']}
+    assert parameter.bound_nodes == {'reservoir': model.nodes['reservoir']}
+    assert {'get', 'node'} <= set(package.HalfDemand.value.__code__.co_names)
+
+    model.run()
+    assert model.nodes['demand'].flow[0] == 2
@@ -0,0 +1,183 @@
+import os
+
+import numpy as np
+import pytest
+from attrdict import AttrDict
+from numpy.testing import assert_array_equal
+from pandas.testing import assert_frame_equal
+from pywr.core import Model, Input, Output
+from pywr.parameters import IndexParameter
+from pywr.recorders import NumpyArrayNodeRecorder
+
+from waterlp.models import pywr2
+from waterlp.models.pywr2 import PywrModel
+from waterlp.models.base.parameters import WaterLPParameter
+
+
+def resource(id, name, type_name, attributes=()):
+    return {
+        'id': id,
+        'name': name,
+        'types': [{'template_id': 1, 'id': id, 'name': type_name}],
+        'attributes': [{'id': attr_id, 'attr_id': attr_id, 'attr_name': attr_name}
+                       for attr_id, attr_name in attributes],
+    }
+
+
+def create_model(runoff='return 10 + timestep.index % 3', **kwargs):
+    """An inflow (with a policy that depends only on the time step) supplying a demand that depends on it"""
+    network = AttrDict(resource(1, 'Test Network', 'Network'))
+    network.update(description='', layout={})
+    network['nodes'] = [
+        resource(1, 'Inflow', 'Inflow Node', [(1, 'Runoff')]),
+        resource(2, 'Demand', 'Urban Demand', [(2, 'Demand'), (3, 'Value')]),
+        resource(3, 'Outflow', 'Outflow Node'),
+    ]
+    network['links'] = [
+        dict(resource(4, 'To Demand', 'Conveyance'), node_1_id=1, node_2_id=2),
+        dict(resource(5, 'To Outflow', 'Conveyance'), node_1_id=1, node_2_id=3),
+    ]
+
+    tattrs = {
+        ('node', 1, 1): {'properties': {'save': True}},
+        ('node', 2, 2): {'properties': {'save': True}},
+        ('node', 2, 3): {'properties': {}},
+    }
+    parameters = {
+        ('node', 1, 1): {'type': 'parameter', 'value': {
+            'name': 'node/Inflow/Runoff',
+            'code': runoff,
+        }},
+        ('node', 2, 2): {'type': 'parameter', 'value': {
+            'name': 'node/Demand/Demand',
+            'code': 'return self.GET("node/1/1", timestep, scenario_index) * 0.5',
+        }},
+    }
+
+    return PywrModel(
+        network, {'id': 1},
+        start='2000-01-01', end='2000-01-31', step=1,
+        tattrs=tattrs,
+        constants={('node', 2, 3): -10.0},
+        parameters=parameters,
+        **kwargs
+    )
+
+
+def run(model):
+    model.model.run()
+    results = model.model.to_dataframe()
+    model.cleanup()
+    return results
+
+
+@pytest.fixture(scope='module', autouse=True)
+def no_s3():
+    # network-specific policies are downloaded from S3
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.setattr(pywr2, 'load_from_s3', lambda *args, **kwargs: None)
+        yield
+
+
+@pytest.fixture(scope='module')
+def expected():
+    return run(create_model(use_cache=False))
+
+
+def test_results(expected):
+    assert list(expected['node/Inflow/runoff'].iloc[:4, 0]) == [10, 11, 12, 10]
+    assert list(expected['node/Demand/demand'].iloc[:4, 0]) == [5, 5.5, 6, 5]
+
+
+def test_in_memory(expected):
+    model = create_model(use_cache=False, in_memory=True)
+    assert model.root_dir is None and model.model_filename is None
+    assert_frame_equal(run(model), expected)
+
+
+def test_cached(expected):
+    model = create_model()
+    assert_frame_equal(run(model), expected)
+
+    model = create_model()
+    assert model.cache.get(model.cache_key)
+    assert_frame_equal(run(model), expected)
+
+
+def test_precompute(expected):
+    model = create_model(use_cache=False, in_memory=True, precompute=True)
+    # the demand depends on another parameter, so it is still evaluated at each time step
+    assert model.precomputed == ['node/Inflow/Runoff']
+    assert type(model.model.parameters['node/Inflow/Runoff']).__name__ == 'ArrayIndexedParameter'
+    assert_frame_equal(run(model), expected)
+
+
+def test_bound_references(expected, monkeypatch):
+    model = create_model(use_cache=False, in_memory=True)
+    inflow = model.model.parameters['node/Inflow/Runoff']
+    demand = model.model.parameters['node/Demand/Demand']
+    assert demand.bound == {'node/Inflow/Runoff': inflow}
+    assert inflow in demand.children
+    assert_frame_equal(run(model), expected)
+
+    # the same results when the reference is looked up at each time step
+    monkeypatch.setattr(WaterLPParameter, 'bind', lambda self: None)
+    model = create_model(use_cache=False, in_memory=True)
+    assert not model.model.parameters['node/Demand/Demand'].bound
+    assert_frame_equal(run(model), expected)
+
+
+def test_bound_references_with_side_effects():
+    # the counter is read, not counted again, by the demand
+    model = create_model(runoff='self.calls = getattr(self, "calls", 0) + 1\nreturn self.calls', use_cache=False)
+    results = run(model)
+    assert_array_equal(results['node/Inflow/runoff'].values[:, 0], np.arange(1, 32))
+    assert_array_equal(results['node/Demand/demand'].values[:, 0], np.arange(1, 32) * 0.5)
+
+
+class Alternating(IndexParameter):
+    def index(self, timestep, scenario_index):
+        return timestep.index % 2
+
+
+class UsesIndex(WaterLPParameter):
+    references = ['alternating']
+
+    def value(self, timestep, scenario_index):
+        # read and calculated
+        return self.get('alternating', timestep, scenario_index) + 10 * self.parameter('alternating').value(
+            timestep, scenario_index)
+
+
+def test_bound_index_parameter():
+    model = Model(start='2000-01-01', end='2000-01-05')
+    inflow = Input(model, 'inflow')
+    outflow = Output(model, 'outflow', cost=-1)
+    inflow.connect(outflow)
+    Alternating(model, name='alternating')
+    inflow.max_flow = uses = UsesIndex(model, name='uses')
+    uses.bind()
+    recorder = NumpyArrayNodeRecorder(model, inflow)
+    model.run()
+
+    # the stored value of an index parameter is its index, as when calculated
+    assert_array_equal(recorder.data[:, 0], [0, 11, 0, 11, 0])
+
+
+def test_cached_after_other_policies(expected):
+    run(create_model())
+
+    # another model registers different policies with the same names
+    other = run(create_model(runoff='return 20', use_cache=False))
+    assert list(other['node/Inflow/runoff'].iloc[:2, 0]) == [20, 20]
+
+    # the cached model's policies are registered again
+    assert_frame_equal(run(create_model()), expected)
+
+
+def test_patch_restores_root_path():
+    model = create_model(use_cache=False)
+    WaterLPParameter.root_path = 's3://openagua-networks/other/'  # e.g., another network was loaded since
+    model.patch({})
+    assert WaterLPParameter.root_path == os.environ['ROOT_S3_PATH'] == model.root_path
+    model.cleanup()
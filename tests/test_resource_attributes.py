@@ -0,0 +1,62 @@
+import numpy as np
+from attrdict import AttrDict
+
+from waterlp.utils.resource_attributes import ResourceAttributes
+
+TATTRS = {1: {'attr_name': 'Storage'}, 2: {'attr_name': 'Demand'}}
+
+
+def add(attributes, resource_type, resource_id, resource_name, res_attr_id, attr_id, attr_name):
+    resource = AttrDict(id=resource_id, name=resource_name)
+    ra = AttrDict(id=res_attr_id, attr_id=attr_id, attr_name=attr_name)
+    return attributes.add(resource_type, resource, ra, TATTRS[attr_id])
+
+
+def create_table():
+    attributes = ResourceAttributes()
+    add(attributes, 'node', 1, 'Lake McClure', 101, 1, 'Storage')
+    add(attributes, 'node', 1, 'Lake McClure', 102, 2, 'Demand')
+    add(attributes, 'link', 2, 'Canal', 103, 2, 'Demand')
+    attributes.freeze()
+    return attributes
+
+
+def test_indices():
+    attributes = create_table()
+    assert len(attributes) == 3
+    assert attributes.id(('node', 1, 2)) == attributes.res_attr_ids[102] == 1
+    assert attributes.id('node/Lake McClure/storage') == attributes.attr_names[('node', 1, 'storage')] == 0
+    assert attributes.id('link/Canal/demand') == 2
+    assert attributes.id('node/Canal/demand') is None
+    assert [attributes.key(i) for i in range(3)] == [('node', 1, 1), ('node', 1, 2), ('link', 2, 2)]
+    assert attributes.key(2) == ('link', 2, 2) and type(attributes.key(2)[1]) == int
+
+
+def test_columns():
+    attributes = create_table()
+    assert attributes.columns['resource_type'].dtype == np.int8
+    assert list(attributes.columns['res_attr_id']) == [101, 102, 103]
+    assert attributes.columns['resource_name'] == ['Lake McClure', 'Lake McClure', 'Canal']
+
+
+def test_views():
+    attributes = create_table()
+    tattrs = attributes.view('tattr')
+    assert tattrs[('node', 1, 1)] is TATTRS[1]
+    assert dict(attributes.view('res_attr_id', by='names')) == {
+        'node/Lake McClure/storage': 101, 'node/Lake McClure/demand': 102, 'link/Canal/demand': 103}
+    assert type(attributes.view('attr_id', by='attr_names')[('link', 2, 'demand')]) == int
+    assert attributes.view('resource_name', by='res_attr_ids')[103] == 'Canal'
+
+
+def test_name_collisions(capsys):
+    # two nodes with the same name
+    attributes = ResourceAttributes()
+    add(attributes, 'node', 1, 'Reservoir', 101, 1, 'Storage')
+    add(attributes, 'node', 2, 'Reservoir', 102, 1, 'Storage')
+    attributes.freeze()
+
+    assert 'More than one resource attribute is named "node/Reservoir/storage"' in capsys.readouterr().out
+    assert attributes.id('node/Reservoir/storage') == 1  # the last one
+    assert attributes.id(('node', 1, 1)) == 0 and attributes.id(('node', 2, 1)) == 1  # still found by key
+    assert len(attributes.view('tattr')) == 2 and len(attributes.view('tattr', by='names')) == 1
@@ -0,0 +1,96 @@
+import json
+import pickle
+
+import msgpack
+import numpy as np
+import pytest
+from numpy.testing import assert_array_equal
+
+from waterlp.models.evaluator import decode_timeseries
+from waterlp.utils.snapshot import export_snapshot, load_snapshot, is_snapshot, SnapshotTimeseries, \
+    STRUCTURE_FILENAME
+
+DATES = np.arange('2000-01-01', '2000-01-11', dtype='datetime64[D]')
+
+
+def dataset(id, type, value):
+    return {'id': id, 'type': type, 'value': value, 'metadata': '{}'}
+
+
+def timeseries(values, start='2000-01-01'):
+    dates = np.arange(np.datetime64(start), np.datetime64(start) + len(values))
+    return json.dumps({'0': {'{}T00:00:00.000Z'.format(d): v for d, v in zip(dates, values)}})
+
+
+@pytest.fixture
+def export(tmpdir):
+    data = {
+        'network': {
+            'name': 'Test Network',
+            'scenarios': [{'resourcescenarios': [
+                {'resource_attr_id': 1, 'dataset': dataset(1, 'timeseries', timeseries([1.5, None, 3, 4]))},
+                {'resource_attr_id': 2, 'dataset': dataset(2, 'periodic timeseries',
+                                                           timeseries([7, 8], start='9999-01-01'))},
+                {'resource_attr_id': 3, 'dataset': dataset(3, 'timeseries', json.dumps({'0': {'x': 'text'}}))},
+                {'resource_attr_id': 4, 'dataset': dataset(4, 'scalar', '10')},
+            ]}],
+        },
+        'template': {'id': 1},
+    }
+    path = str(tmpdir.join('network.json'))
+    with open(path, 'w') as f:
+        json.dump(data, f)
+    return path, data
+
+
+def datasets(data):
+    return [rs['dataset'] for rs in data['network']['scenarios'][0]['resourcescenarios']]
+
+
+def test_snapshot_round_trip(tmpdir, export):
+    path, data = export
+    dest = str(tmpdir.join('network.snapshot'))
+    assert export_snapshot(path, dest) == (2, 1)
+    assert is_snapshot(dest)
+
+    snapshot = load_snapshot(dest)
+    assert snapshot['template'] == data['template']
+
+    original, loaded = datasets(data), datasets(snapshot)
+    for before, after in zip(original, loaded):
+        assert {k: v for k, v in after.items() if k != 'value'} == {k: v for k, v in before.items() if k != 'value'}
+
+    # timeseries are decoded from the snapshot arrays, with the same results as from JSON
+    for before, after in zip(original[:2], loaded[:2]):
+        assert type(after['value']) == SnapshotTimeseries
+        assert json.loads(after['value'].to_json()) == json.loads(before['value'])
+        for column, values in decode_timeseries(before['value'], DATES).items():
+            assert_array_equal(decode_timeseries(after['value'], DATES)[column], values)
+    assert isinstance(loaded[0]['value'].arrays['values'], np.memmap)
+
+    # other values are kept as they were
+    assert loaded[2]['value'] == original[2]['value']
+    assert loaded[3]['value'] == '10'
+
+
+def test_snapshot_timeseries_pickle(tmpdir, export):
+    path, data = export
+    dest = str(tmpdir.join('network.snapshot'))
+    export_snapshot(path, dest)
+    value = datasets(load_snapshot(dest))[0]['value']
+
+    # only the timeseries itself is copied
+    copied = pickle.loads(pickle.dumps(value))
+    assert len(copied.arrays['values']) == 4 < len(value.arrays['values'])
+    assert str(copied) == str(value)
+    assert_array_equal(decode_timeseries(copied, DATES)[0], decode_timeseries(value, DATES)[0])
+
+
+def test_snapshot_version(tmpdir, export):
+    path, data = export
+    dest = str(tmpdir.join('network.snapshot'))
+    export_snapshot(path, dest)
+    with open(str(tmpdir.join('network.snapshot', STRUCTURE_FILENAME)), 'wb') as f:
+        f.write(msgpack.packb({'snapshot_version': 0}))
+    with pytest.raises(Exception, match='not supported'):
+        load_snapshot(dest)
@@ -0,0 +1,228 @@
+import os
+
+import numpy as np
+import pytest
+from numpy.testing import assert_array_equal
+from pandas.testing import assert_frame_equal
+
+from waterlp.connection import JSONObject
+from waterlp.models import pywr2, system as system_module
+from waterlp.models.cache import ModelPool, SourceDataCache
+from waterlp.models.system import WaterSystem, perturb
+from tests.networks import create_system, dataset, timeseries
+
+
+def test_perturb_scalars():
+    assert perturb(2.0, {'operator': 'multiply', 'value': 1.5}) == 3.0
+    assert perturb(2.0, {'operator': 'add', 'value': 1.5}) == 3.5
+    assert perturb(2.0, {'operator': 'other', 'value': 1.5}) == 2.0
+
+
+def test_perturb_arrays_like_dicts():
+    # timeseries are decoded to arrays, with nan for missing values, or (with pandas) to dicts with None
+    for operator in ['multiply', 'add']:
+        variation = {'operator': operator, 'value': 3.0}
+        arrays = {0: np.array([1.0, np.nan, 2.0])}
+        dicts = {0: {'a': 1.0, 'b': None, 'c': 2.0}}
+
+        assert perturb(arrays, variation) is None
+        perturb(dicts, variation)
+
+        expected = [np.nan if v is None else v for v in dicts[0].values()]
+        assert_array_equal(arrays[0], expected)
+
+    arrays = {0: np.array([1.0, np.nan, 2.0])}
+    perturb(arrays, {'operator': 'multiply', 'value': 2})
+    assert_array_equal(arrays[0], [2.0, np.nan, 4.0])
+
+
+DATA = {
+    11: dataset(101, 'timeseries', timeseries([float(v) for v in range(10)])),
+    21: dataset(102, 'scalar', '5'),
+    22: dataset(103, 'scalar', '-10'),
+    23: dataset(104, 'descriptor', 'Demand node'),
+    24: dataset(105, 'timeseries', timeseries([1.0] * 10)),
+}
+
+
+@pytest.fixture
+def no_source_data_cache(monkeypatch):
+    monkeypatch.setattr(system_module, 'source_data_cache', None)
+
+
+def collected(tmpdir, data=DATA):
+    system = create_system(tmpdir, data)
+    system.collect_source_data()
+    return system.parameters
+
+
+def check_collected(parameters):
+    assert sorted(parameters) == [('node', 1, 2), ('node', 2, 3), ('node', 2, 4), ('node', 2, 5)]
+    assert parameters[('node', 2, 3)]['value']['value'] == 5.0
+    assert parameters[('node', 2, 4)]['value']['value'] == -10.0
+    runoff = parameters[('node', 1, 2)]['value']
+    assert runoff['data_type'] == 'timeseries'
+    assert_array_equal(runoff['value'][0], np.arange(10.0))
+
+
+@pytest.mark.parametrize('workers, pool', [('1', 'process'), ('2', 'process'), ('2', 'thread')])
+def test_collect_source_data(tmpdir, no_source_data_cache, monkeypatch, workers, pool):
+    # timeseries, scalars and descriptors, in an order that mixes them
+    monkeypatch.setenv('WATERLP_SOURCE_DATA_WORKERS', workers)
+    monkeypatch.setenv('WATERLP_SOURCE_DATA_POOL', pool)
+    check_collected(collected(tmpdir))
+
+
+def test_evaluate_source_data_in_pool(tmpdir, monkeypatch):
+    system = create_system(tmpdir, DATA)
+    values = [dataset(i, 'timeseries', timeseries([float(i * v) for v in range(10)])) for i in range(8)]
+    values = [JSONObject(v) for v in values]
+
+    monkeypatch.setenv('WATERLP_SOURCE_DATA_WORKERS', '1')
+    serial = system._evaluate_source_data(values)
+
+    monkeypatch.setenv('WATERLP_SOURCE_DATA_WORKERS', '2')
+    for pool in ['process', 'thread']:
+        monkeypatch.setenv('WATERLP_SOURCE_DATA_POOL', pool)
+        results = system._evaluate_source_data(values)
+        assert len(results) == len(serial)
+        for result, expected in zip(results, serial):
+            assert_array_equal(result[0], expected[0])
+
+
+def test_source_data_cache(tmpdir, monkeypatch):
+    monkeypatch.setattr(system_module, 'source_data_cache', SourceDataCache(root=str(tmpdir.mkdir('cache'))))
+    evaluated = []
+    evaluate = WaterSystem._evaluate_source_data
+    monkeypatch.setattr(WaterSystem, '_evaluate_source_data',
+                        lambda self, values: evaluated.append(len(values)) or evaluate(self, values))
+
+    check_collected(collected(tmpdir.mkdir('first')))
+    check_collected(collected(tmpdir.mkdir('second')))  # e.g., the next run
+    data = dict(DATA)
+    data[21] = dataset(102, 'scalar', '6')
+    assert collected(tmpdir.mkdir('changed'), data)[('node', 2, 3)]['value']['value'] == 6.0
+
+    assert evaluated == [4, 0, 1]
+
+
+def test_evaluate_source_data_without_processes(tmpdir, no_source_data_cache, monkeypatch, capsys):
+    # e.g., in a daemonic Celery worker
+    def refuse(*args, **kwargs):
+        raise AssertionError('daemonic processes are not allowed to have children')
+
+    monkeypatch.setattr(system_module, 'ProcessPoolExecutor', refuse)
+    monkeypatch.setenv('WATERLP_SOURCE_DATA_WORKERS', '2')
+    check_collected(collected(tmpdir))
+    assert 'using threads instead' in capsys.readouterr().out
+
+
+# a policy with state that is kept between time steps
+STATEFUL = {
+    11: dataset(101, 'timeseries', '', input_method='function',
+                function='self.calls = getattr(self, "calls", 0) + 1\nreturn self.calls'),
+    21: dataset(102, 'scalar', '5'),
+    22: dataset(103, 'scalar', '-10'),
+}
+
+
+def variation(id, value):
+    return {'id': id, 'variation_sets': [
+        {'parent_id': 1, 'variations': {('node', 2, 3): {'operator': 'multiply', 'value': value}}}
+    ]}
+
+
+def run_variations(tmpdir, warm):
+    system = create_system(tmpdir, STATEFUL, warm=warm)
+    system.collect_source_data()
+    results = []
+    for i, value in enumerate([1, 2, 3]):
+        subsystem = system.variation_copy()
+        subsystem.initialize(variation(i + 1, value))
+        subsystem.model.model.run()
+        results.append(subsystem.model.model.to_dataframe())
+    return results
+
+
+@pytest.fixture
+def model_pool(monkeypatch):
+    # network-specific policies are downloaded from S3
+    monkeypatch.setattr(pywr2, 'load_from_s3', lambda *args, **kwargs: None)
+    monkeypatch.setattr(system_module, 'model_pool', ModelPool())
+    yield system_module.model_pool
+    system_module.model_pool.clear()
+
+
+def test_warm_variations(tmpdir, no_source_data_cache, model_pool, capsys):
+    cold = run_variations(tmpdir.mkdir('cold'), warm=False)
+    assert not model_pool.models
+
+    warm = run_variations(tmpdir.mkdir('warm'), warm=True)
+    assert model_pool.hits == 2 and len(model_pool.models) == 1
+    assert capsys.readouterr().out.count('Reusing loaded model') == 2
+
+    for i, (cold_results, warm_results) in enumerate(zip(cold, warm)):
+        assert_frame_equal(warm_results, cold_results)
+        assert_array_equal(warm_results['node/Demand/demand'], 5.0 * (i + 1))
+        assert_array_equal(warm_results['node/Inflow/runoff'].values[:, 0], np.arange(1, 11))
+
+
+def test_variation_of_scalar_variable(tmpdir, no_source_data_cache):
+    system = create_system(tmpdir, STATEFUL)
+    system.collect_source_data()
+    subsystem = system.variation_copy()
+    subsystem.prepare_params()
+    subsystem.setup_subscenario(variation(1, 2))
+
+    assert subsystem.parameters[('node', 2, 3)]['value']['value'] == 10.0
+    assert system.parameters[('node', 2, 3)]['value']['value'] == 5.0
+
+
+USED = [('node', 1, 2), ('node', 2, 3), ('node', 2, 4)]  # mapped to Pywr attributes
+PRIORITY = ('node', 2, 5)  # intermediary, so only used if referenced
+
+POLICY = '''from waterlp.models.base.parameters import WaterLPParameter
+from .utilities import scale
+
+
+class Demand_Policy(WaterLPParameter):
+    def _value(self, timestep, scenario_index):
+        return scale(self.GET("node/Demand/Priority", timestep, scenario_index))
+'''
+
+
+def policy_modules(monkeypatch, modules):
+    """Replace the download of the network's policy modules from S3"""
+    def load_from_s3(bucket, network_key, path, dest_root):
+        if modules is None:
+            raise Exception('Access denied')
+        os.makedirs(os.path.join(dest_root, path))
+        for filename, code in modules.items():
+            with open(os.path.join(dest_root, path, filename), 'w') as f:
+                f.write(code)
+
+    monkeypatch.setattr(system_module, 'load_from_s3', load_from_s3)
+
+
+@pytest.mark.parametrize('modules, expected', [
+    ({}, USED),
+    ({'utilities.py': 'import numpy as np\n\ndef scale(x):\n    return np.sqrt(x)\n'}, USED),
+    ({'demand.py': POLICY}, USED + [PRIORITY]),
+    ({'demand.py': POLICY.replace('"node/Demand/Priority"', '"node/Demand/" + name')}, USED + [PRIORITY]),
+    ({'demand.py': 'import requests\n'}, USED + [PRIORITY]),
+    (None, USED + [PRIORITY]),  # the modules can't be downloaded
+])
+def test_lazy_source_data(tmpdir, no_source_data_cache, monkeypatch, modules, expected):
+    monkeypatch.setenv('WATERLP_LAZY_SOURCE_DATA', 'Y')
+    policy_modules(monkeypatch, modules)
+    system = create_system(tmpdir, DATA, folder='test-network')
+    system.collect_source_data()
+    assert sorted(system.parameters) == expected
+
+
+def test_lazy_source_data_without_folder(tmpdir, no_source_data_cache, monkeypatch):
+    monkeypatch.setenv('WATERLP_LAZY_SOURCE_DATA', 'Y')
+    policy_modules(monkeypatch, None)  # not downloaded
+    system = create_system(tmpdir, DATA)
+    system.collect_source_data()
+    assert sorted(system.parameters) == USED
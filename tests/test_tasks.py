@@ -0,0 +1,78 @@
+import pytest
+
+fakeredis = pytest.importorskip('fakeredis')
+tasks = pytest.importorskip('waterlp.tasks')
+
+from waterlp.utils import cancellation
+from waterlp.utils.states import ProcessState
+
+
+@pytest.fixture
+def redis(monkeypatch):
+    redis = fakeredis.FakeRedis()
+    monkeypatch.setattr(tasks, 'local_redis', redis)
+    monkeypatch.setattr(cancellation, 'local_redis', redis)
+    monkeypatch.setattr(cancellation, 'listener', None)
+    return redis
+
+
+@pytest.fixture
+def sent(monkeypatch):
+    """Tasks sent to the workers, which are not run"""
+    sent = []
+    monkeypatch.setattr(tasks.run_batch, 'apply_async', lambda args, **kwargs: sent.append(('batch', args)))
+    monkeypatch.setattr(tasks.run_finished, 'apply_async', lambda args, **kwargs: sent.append(('finished', args)))
+    monkeypatch.setattr(tasks, 'queued_tasks', lambda: 0)
+    return sent
+
+
+def variations(n, sid='run'):
+    return ({'id': i + 1, 'sid': sid, 'variation_sets': (), 'system': None, 'system_key': None} for i in range(n))
+
+
+def test_batches():
+    batches = list(tasks.batches(variations(5), 2))
+    assert [[v['id'] for v in batch['variations']] for batch in batches] == [[1, 2], [3, 4], [5]]
+    assert {batch['sid'] for batch in batches} == {'run'}
+
+
+def test_run_finished_once(redis, sent):
+    assert tasks.dispatch(tasks.batches(variations(5), 2), None, False, sid='run', task=tasks.run_batch) == 3
+
+    # batches can finish in any order, and before all of them are dispatched
+    tasks.batch_finished('run', 2, 0)
+    tasks.batch_finished('run', 1, 1)
+    assert [task for task, args in sent].count('finished') == 0
+    tasks.batch_finished('run', 2, 0)
+    tasks.check_batches_finished('run')
+    assert sent[-1] == ('finished', ('run',))
+    assert [task for task, args in sent].count('finished') == 1
+
+    tasks.run_finished('run')
+    assert redis.get('run') == ProcessState.FINISHED
+    assert not redis.exists(tasks.batches_key('run'))
+
+
+def test_run_finished_states(redis, sent):
+    redis.hset(tasks.batches_key('failed'), mapping={'runs': 2, 'failed': 2})
+    tasks.run_finished('failed')
+    assert redis.get('failed') == ProcessState.ERROR
+
+    redis.set('canceled', ProcessState.CANCELED)
+    redis.hset(tasks.batches_key('canceled'), mapping={'runs': 2, 'failed': 0})
+    tasks.run_finished('canceled')
+    assert redis.get('canceled') == ProcessState.CANCELED
+
+
+def test_canceled_dispatch_finishes(redis, sent, monkeypatch):
+    # the queue is full, and the run is canceled while waiting
+    monkeypatch.setenv('WATERLP_DISPATCH_CHUNK_SIZE', '2')
+    monkeypatch.setenv('WATERLP_MAX_QUEUED_TASKS', '2')
+    queued = iter([0])
+    monkeypatch.setattr(tasks, 'queued_tasks', lambda: next(queued, 2))
+    monkeypatch.setattr(tasks, 'is_canceled', lambda sid: True)
+
+    assert tasks.dispatch(tasks.batches(variations(10), 1), None, False, sid='run', task=tasks.run_batch) == 2
+    tasks.batch_finished('run', 1, 0)
+    tasks.batch_finished('run', 1, 0)
+    assert sent[-1] == ('finished', ('run',))
@@ -1,11 +1,70 @@
+import os
 import json
+import gzip
+from time import time, sleep
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from http.cookiejar import DefaultCookiePolicy
 
-from requests import post
+from requests import Session
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError, ConnectTimeout, Timeout
+from urllib3.exceptions import NewConnectionError
+
+try:
+    from orjson import loads as orjson_loads
+except ImportError:
+    orjson_loads = None
+
+from waterlp.utils.resource_attributes import ResourceAttributes
+from waterlp.utils.snapshot import is_snapshot, load_snapshot
+
+# HTTP settings for calls to Hydra
+POOL_SIZE = int(os.environ.get('WATERLP_HYDRA_POOL_SIZE', 10))
+MAX_RETRIES = int(os.environ.get('WATERLP_HYDRA_RETRIES', 3))
+BACKOFF = float(os.environ.get('WATERLP_HYDRA_BACKOFF', 0.5))  # seconds before the first retry; doubled each time
+CONNECT_TIMEOUT = float(os.environ.get('WATERLP_HYDRA_CONNECT_TIMEOUT', 10))
+TIMEOUT = float(os.environ.get('WATERLP_HYDRA_TIMEOUT', 500))
+GZIP_REQUESTS = os.environ.get('WATERLP_HYDRA_GZIP', 'N').upper() in ['Y', 'YES', '1', 'TRUE']
+GZIP_MIN_BYTES = 1024
+RETRY_STATUSES = [502, 503, 504]
+
+
+def _get_http_session():
+    session = Session()
+    # Hydra sessions are passed explicitly with each call, so cookies from responses are not kept
+    session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+    adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+# one pool of keep-alive connections per process
+http_session = _get_http_session()
+
+
+def reset_http_session():
+    """Start a new connection pool, e.g., in a forked process, which can't share connections with its parent"""
+    global http_session
+    http_session = _get_http_session()
+
+
+def _is_idempotent(func):
+    # these calls can be repeated safely if a response is lost
+    return func == 'login' or func.startswith('get_') or func.startswith('update_')
+
+
+def _not_sent(err):
+    # the request failed before it reached the server (e.g., the connection was refused)
+    reason = getattr(err.args[0], 'reason', None) if err.args else None
+    return isinstance(err, ConnectTimeout) or isinstance(reason, NewConnectionError)
 
 
 class connection(object):
 
     def __init__(self, args=None, scenario_ids=None, log=None):
+        self.metrics = {}  # latency, etc., by Hydra function (see call)
         self.url = args.data_url
         self.filename = args.filename
         self.app_name = args.app_name
@@ -26,24 +85,31 @@ class connection(object):
             get_network_params.update({'template_id': self.template_id})
 
         if args.filename:
-            with open(args.filename) as f:
-                data = json.load(f, object_hook=JSONObject)
-                self.network = data.get('network')
-                self.template = data.get('template')
-                self.template_attributes = data.get('template_attributes')
-                self.template_id = self.template.get('id')
+            if is_snapshot(args.filename):
+                # a binary snapshot of a JSON export (see utils.snapshot)
+                data = load_snapshot(args.filename, mapping=JSONObject)
+            else:
+                with open(args.filename) as f:
+                    data = json.load(f, object_hook=JSONObject)
+            self.network = data.get('network')
+            self.template = data.get('template')
+            self.template_attributes = data.get('template_attributes')
+            self.template_id = self.template.get('id')
 
         else:
-            response = self.call('get_network', get_network_params)
+            response = self.call('get_network', get_network_params, large=True)
             if 'faultcode' in response:
                 if 'session' in response.get('faultcode', '').lower():
                     self.login(username=args.hydra_username, password=args.hydra_password)
-                response = self.call('get_network', get_network_params)
+                response = self.call('get_network', get_network_params, large=True)
 
             self.network = response
             self.template_id = self.template_id or self.network.layout.get('active_template_id')
             self.template = self.template_id and self.call('get_template', {'template_id': self.template_id})
 
+        # scenarios with data, by id, including parent scenarios downloaded later (see get_scenario)
+        self.scenarios = {sc.id: sc for sc in self.network.get('scenarios', [])}
+
         # create some useful dictionaries
         # Since pyomo doesn't know about attribute ids, etc., we need to be able to relate
         # pyomo variable names to resource attributes to be able to save data back to the database.
@@ -57,13 +123,11 @@ class connection(object):
 
         # dictionary to store resource attribute ids
         self.resource_attributes = {}
-        self.res_attr_lookup = {}
-        self.raid_to_res_name = {}
-        self.attr_id_lookup = {}
-        self.tattr_lookup = {}
         self.node_names = {}
-        self.tattrs = {}
         self.types = {}
+
+        # all resource attributes in the template
+        self.attributes = ResourceAttributes()
         ttypes = {tt.id: tt for tt in self.template.types}
 
         def process_resource(resource_type, resource):
@@ -77,17 +141,7 @@ class connection(object):
             tattrs = {ta.attr_id: ta for ta in ttype.typeattrs}
             for ra in resource.attributes:
                 if ra.attr_id in tattrs:
-
-                    key = (resource_type, resource.id, ra.attr_id)
-                    self.tattrs[key] = tattrs[ra.attr_id]
-
-                    # TODO: confirm the following doesn't overwrite attributes with a different dimension
-                    human_readable_key = '%s/%s/%s' % (resource_type, resource.name, ra.attr_name.lower())
-                    self.tattr_lookup[human_readable_key] = tattrs[ra.attr_id]
-                    self.attr_id_lookup[resource_type, resource.id, ra.attr_name.lower()] = ra.attr_id
-                    # resource attribute lookup
-                    self.res_attr_lookup[human_readable_key] = ra.id
-                    self.raid_to_res_name[ra.id] = resource.name
+                    self.attributes.add(resource_type, resource, ra, tattrs[ra.attr_id])
 
         process_resource('network', self.network)
         for node in self.network.nodes:
@@ -95,13 +149,51 @@ class connection(object):
         for link in self.network.links:
             process_resource('link', link)
 
-    def call(self, func, args):
+        self.attributes.freeze()
+
+        # lookups, by (resource_type, resource_id, attr_id), human readable key (e.g., "node/Lake McClure/storage"),
+        # (resource_type, resource_id, attribute name) or resource attribute id
+        self.tattrs = self.attributes.view('tattr')
+        self.tattr_lookup = self.attributes.view('tattr', by='names')
+        self.attr_id_lookup = self.attributes.view('attr_id', by='attr_names')
+        self.res_attr_lookup = self.attributes.view('res_attr_id', by='names')
+        self.raid_to_res_name = self.attributes.view('resource_name', by='res_attr_ids')
+
+    def call(self, func, args, large=False):
+        """
+        Call a Hydra function.
+        With large=True (e.g., for get_network with data), a successful response is decoded with decode_large_response.
+        """
 
         data = json.dumps({func: args})
 
         headers = {'Content-Type': 'application/json', 'appname': self.app_name}
         cookie = {'beaker.session.id': self.session_id if func != 'login' else None, 'appname:': self.app_name}
-        response = post(self.url, data=data, headers=headers, cookies=cookie, timeout=500)
+
+        body = data.encode()
+        if GZIP_REQUESTS and len(body) >= GZIP_MIN_BYTES:
+            body = gzip.compress(body, compresslevel=5)
+            headers['Content-Encoding'] = 'gzip'
+
+        start = time()
+        retries = 0
+        while True:
+            try:
+                response = http_session.post(self.url, data=body, headers=headers, cookies=cookie,
+                                             timeout=(CONNECT_TIMEOUT, TIMEOUT), stream=large)
+                if response.status_code not in RETRY_STATUSES or not _is_idempotent(func) or retries >= MAX_RETRIES:
+                    break
+                response.close()
+                err = 'status {}'.format(response.status_code)
+            except (ConnectionError, Timeout) as e:
+                if retries >= MAX_RETRIES or not (_is_idempotent(func) or _not_sent(e)):
+                    self.record(func, start, retries, error=True)
+                    raise
+                err = e
+            delay = BACKOFF * 2 ** retries
+            print(' [-] WARNING: {} failed ({}); retrying in {:.1f} s'.format(func, err, delay))
+            sleep(delay)
+            retries += 1
 
         if not response.ok:
             try:
@@ -117,13 +209,79 @@ class connection(object):
                     print(response.content)
                 else:
                     print("Something went wrong. An unknown server has occurred.")
+        elif large:
+            content = decode_large_response(response)
         else:
             content = json.loads(response.content.decode(), object_hook=JSONObject)
             if func == 'login':
                 self.session_id = response.cookies['beaker.session.id']
 
+        self.record(func, start, retries, error=not response.ok)
+
         return content
 
+    def record(self, func, start, retries, error=False):
+        elapsed = time() - start
+        metrics = self.metrics.setdefault(func, {'calls': 0, 'retries': 0, 'errors': 0, 'seconds': 0.0, 'max': 0.0})
+        metrics['calls'] += 1
+        metrics['retries'] += retries
+        metrics['errors'] += int(error)
+        metrics['seconds'] += elapsed
+        metrics['max'] = max(metrics['max'], elapsed)
+
+    def stats(self):
+        """Call metrics by Hydra function, with the mean latency in seconds"""
+        return {func: dict(m, mean=m['seconds'] / m['calls']) for func, m in self.metrics.items()}
+
+    def call_many(self, func, args_list):
+        """
+        Call a Hydra function once for each of a list of arguments, concurrently over the pooled connections.
+        The results are returned in order.
+        """
+        if len(args_list) < 2:
+            return [self.call(func, args) for args in args_list]
+        with ThreadPoolExecutor(min(POOL_SIZE, len(args_list))) as pool:
+            return list(pool.map(partial(self.call, func), args_list))
+
+    def get_scenario(self, scenario_id):
+        """Get a scenario with its data, which is downloaded only once"""
+        scenario = self.scenarios.get(scenario_id)
+        if scenario is None:
+            scenario = self.call('get_scenario', {'scenario_id': scenario_id})
+            if 'faultcode' not in scenario:
+                self.scenarios[scenario_id] = scenario
+        return scenario
+
+    def prefetch_scenarios(self, scenario_ids, all_scenarios):
+        """
+        Download the scenarios that the given scenarios inherit from (their parents, grandparents, etc.) all at once,
+        rather than one by one as each scenario's chain is followed.
+        :param scenario_ids: The ids of the scenarios to be run
+        :param all_scenarios: All of the network's scenarios, without data (see get_basic_network)
+        :return: The ids of the scenarios that were downloaded
+        """
+        layouts = {sc.id: sc.layout for sc in all_scenarios}
+        layouts.update({sc.id: sc.layout for sc in self.scenarios.values()})
+
+        needed = set()
+        pending = list(scenario_ids)
+        while pending:
+            scenario_id = pending.pop()
+            if scenario_id in needed:
+                continue
+            needed.add(scenario_id)
+            parent_id = (layouts.get(scenario_id) or {}).get('parent')
+            if parent_id:
+                pending.append(parent_id)
+
+        missing = sorted([scenario_id for scenario_id in needed if scenario_id not in self.scenarios])
+        results = self.call_many('get_scenario', [{'scenario_id': scenario_id} for scenario_id in missing])
+        for scenario_id, scenario in zip(missing, results):
+            if 'faultcode' not in scenario:
+                self.scenarios[scenario_id] = scenario
+
+        return missing
+
     def get_basic_network(self):
         if self.filename:
             return self.network
@@ -161,8 +319,59 @@ class connection(object):
         return self.call('update_scenario', {'scen': resource_scenario, 'return_summary': 'Y'})
 
 
+def decode_large_response(response, chunk_size=1 << 20):
+    """
+    Decode a large JSON response to JSONObjects. This is not an incremental decoder: the whole body is read into one
+    buffer and then decoded, so peak memory is the body plus the decoded objects. It avoids the copies made by
+    response.content and json.loads (the joined chunks, then the body as a string). Dataset values (e.g., timeseries)
+    are JSON strings within the response, so they stay as strings until they are evaluated.
+    """
+    buffer = bytearray()
+    for chunk in response.iter_content(chunk_size=chunk_size):
+        buffer.extend(chunk)
+
+    if orjson_loads is None:
+        return json.loads(buffer, object_hook=JSONObject)
+
+    # orjson decodes the bytes directly, without first copying them to a string
+    content = orjson_loads(buffer)
+    del buffer
+    return _to_objects(content)
+
+
+def _to_objects(obj):
+    # convert dictionaries to JSONObjects, replacing them in place and skipping values that aren't containers
+    if type(obj) == dict:
+        obj = JSONObject(obj)
+        for k, v in obj.items():
+            if type(v) == dict or type(v) == list:
+                obj[k] = _to_objects(v)
+    else:
+        for i, v in enumerate(obj):
+            if type(v) == dict or type(v) == list:
+                obj[i] = _to_objects(v)
+    return obj
+
+
 class JSONObject(dict):
-    def __init__(self, obj_dict):
-        for k, v in obj_dict.items():
-            self[k] = v
-            setattr(self, k, v)
+    """
+    A dictionary whose keys can also be used as attributes (e.g., network.nodes).
+    Values are stored only once, in the dictionary; there is no instance __dict__.
+    """
+
+    __slots__ = ()
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        self[name] = value
+
+    def __delattr__(self, name):
+        try:
+            del self[name]
+        except KeyError:
+            raise AttributeError(name)
@@ -0,0 +1,22 @@
+import sys
+
+from . import parameters, utilities
+from .domains import domains
+from .utilities import converter
+
+
+def register():
+    """
+    Make the base domains, parameters and utilities available to policies by their top-level names
+    (e.g., "from parameters import WaterLPParameter"). This only needs to be done once per process.
+    """
+
+    modules = {
+        'parameters': parameters,
+        'domains': sys.modules[__name__ + '.domains'],
+        'domains.domains': domains,
+        'utilities': utilities,
+        'utilities.converter': converter,
+    }
+    for name, module in modules.items():
+        sys.modules[name] = module
@@ -1,52 +1,135 @@
 import os
-import pandas as pd
-from hashlib import md5
+import inspect
 
 from pywr.parameters import Parameter
 
+from .datastore import _get_data_store
+from .lookups import TimestepLookup
+
+
+def depends_on(parameter, other):
+    """Check if other is a descendant of parameter"""
+    stack = list(parameter.children)
+    seen = set()
+    while stack:
+        child = stack.pop()
+        if child is other:
+            return True
+        if id(child) not in seen:
+            seen.add(id(child))
+            stack.extend(child.children)
+    return False
+
 
 class WaterLPParameter(Parameter):
-    store = {}  # TODO: create h5 store on disk (or redis?) to share between class instances
+    store = _get_data_store()  # parsed input data, shared by all models in this process and cached on disk
 
     root_path = os.environ.get('ROOT_S3_PATH', '')
 
+    # if True, the parameter depends only on the time step and can be evaluated before the model is run
+    precompute = False
+
+    # names of other parameters and nodes used by this parameter (see models.utils.parse_code); if None, they are found
+    # in the class source (e.g., for network policy modules)
+    references = None
+    node_references = None
+
+    bound = {}  # referenced parameters, by name (set by bind)
+    bound_nodes = {}  # referenced nodes, by name (set by bind)
+    lookups = ()  # data mapped onto the model's time steps (see lookup)
+
     # h5store = 'store.h5'
 
+    def bind(self):
+        """
+        Resolve references to other parameters and nodes once. Parameters are added as children, so that Pywr
+        calculates them (once) before this parameter in each time step. References that would create a cycle are left
+        unbound.
+        """
+        cls = type(self)
+        if cls.references is None:
+            from waterlp.models.utils import find_policy_references
+            try:
+                cls.references, cls.node_references = find_policy_references(inspect.getsource(cls))
+            except (OSError, TypeError):
+                cls.references, cls.node_references = [], []
+
+        self.bound = {}
+        for name in self.references:
+            try:
+                parameter = self.model.parameters[name]
+            except KeyError:
+                continue
+            if parameter is self or depends_on(parameter, self):
+                continue
+            self.children.add(parameter)
+            self.bound[name] = parameter
+
+        self.bound_nodes = {}
+        for name in self.node_references or []:
+            try:
+                self.bound_nodes[name] = self.model.nodes[name]
+            except KeyError:
+                continue
+
+    def reset(self):
+        super(WaterLPParameter, self).reset()
+        for lookup in self.lookups:
+            lookup.reset()
+
+    def lookup(self, data, by='date', column=None, water_year_start=10, **kwargs):
+        """
+        Map data onto the model's time steps, for fast lookups by time step (see TimestepLookup).
+        data can be a Series, a DataFrame (with column) or a csv file path, which is read with read_csv(**kwargs).
+        """
+        if type(data) == str:
+            data = self.read_csv(data, **kwargs)
+        lookup = TimestepLookup(self.model, data, by=by, column=column, water_year_start=water_year_start)
+        self.lookups += (lookup,)
+        return lookup
+
     def GET(self, *args, **kwargs):
         return self.get(*args, **kwargs)
 
     def get(self, param, timestep=None, scenario_index=None):
+        """
+        Get the value of another parameter. For the current time step, the value of a bound parameter (see bind) is
+        read, since Pywr has already calculated it, rather than calculated again (so any side effects of calculating it
+        happen once per time step). Other time steps are always calculated.
+        """
+        parameter = self.bound.get(param)
+        if parameter is not None and scenario_index is not None \
+                and (timestep is None or timestep.index == self.model.timestep.index):
+            # this was already calculated for this time step
+            return parameter.get_value(scenario_index)
         return self.model.parameters[param].value(timestep or self.model.timestep, scenario_index)
 
-    def read_csv(self, *args, **kwargs):
-
-        # hashval = md5((str(args) + str(kwargs)).encode()).hexdigest()
-        hashval = str(hash(str(args) + str(kwargs)))
+    def parameter(self, name):
+        parameter = self.bound.get(name)
+        return parameter if parameter is not None else self.model.parameters[name]
 
-        data = self.store.get(hashval)
+    def node(self, name):
+        node = self.bound_nodes.get(name)
+        return node if node is not None else self.model.nodes[name]
 
-        if data is None:
-
-            if not args:
-                raise Exception("No arguments passed to read_csv.")
-
-            # update args with additional path information
+    def read_csv(self, *args, **kwargs):
 
-            args = list(args)
-            file_path = args[0]
-            if '://' in file_path:
-                pass
-            elif self.root_path:
-                args[0] = self.root_path + file_path
+        if not args:
+            raise Exception("No arguments passed to read_csv.")
 
-            # modify kwargs with sensible defaults
-            # TODO: modify these depending on data type (timeseries, array, etc.)
+        # update args with additional path information
 
-            kwargs['parse_dates'] = kwargs.get('parse_dates', True)
-            kwargs['index_col'] = kwargs.get('index_col', 0)
+        args = list(args)
+        file_path = args[0]
+        if '://' in file_path:
+            pass
+        elif self.root_path:
+            args[0] = self.root_path + file_path
 
-            data = pd.read_csv(*args, **kwargs)
+        # modify kwargs with sensible defaults
+        # TODO: modify these depending on data type (timeseries, array, etc.)
 
-            self.store[hashval] = data
+        kwargs['parse_dates'] = kwargs.get('parse_dates', True)
+        kwargs['index_col'] = kwargs.get('index_col', 0)
 
-        return data
+        return self.store.read_csv(*args, **kwargs)
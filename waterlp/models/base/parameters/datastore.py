@@ -0,0 +1,222 @@
+import os
+import time
+import pickle
+from hashlib import sha1
+from collections import OrderedDict
+from tempfile import mkdtemp
+from shutil import rmtree
+
+import numpy as np
+import pandas as pd
+
+META_FILENAME = 'meta.pkl'
+
+
+def _signature(path):
+    """
+    Return something that changes when the source file changes: (mtime, size) for local files or the ETag for S3.
+    None means the source can't be checked, so it is not cached on disk.
+    """
+    try:
+        if path.startswith('s3://'):
+            import boto3
+            bucket, key = path[5:].split('/', 1)
+            return boto3.client('s3').head_object(Bucket=bucket, Key=key)['ETag']
+        elif '://' not in path:
+            stat = os.stat(path)
+            return [stat.st_mtime, stat.st_size]
+    except Exception:
+        pass
+    return None
+
+
+def _save_array(path, values):
+    np.save(path, values, allow_pickle=values.dtype == object)
+
+
+def _load_array(path):
+    try:
+        # copy-on-write, so callers can still modify the data
+        return np.load(path, mmap_mode='c')
+    except ValueError:
+        # arrays of Python objects (e.g., strings) can't be memory-mapped
+        return np.load(path, allow_pickle=True)
+
+
+def _nbytes(data):
+    try:
+        if isinstance(data, pd.Series):
+            return int(data.memory_usage(index=True))
+        return int(data.memory_usage(index=True).sum())
+    except Exception:
+        return 0
+
+
+class DataStore(object):
+    """
+    A two-level cache of parsed input data for WaterLPParameter.read_csv.
+
+    Each source csv is parsed once and saved as numpy arrays in a folder named by the hash of the path and read
+    arguments. Later reads, including from other worker processes, memory-map these arrays instead of parsing the
+    csv again. A disk entry is used only if the source's signature (mtime and size, or ETag for S3) is unchanged;
+    signatures are checked once per run (see reset). Parsed data is also kept in memory, up to max_bytes.
+    """
+
+    def __init__(self, root=None, max_bytes=None):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.data = OrderedDict()  # key: (data, size, signature), least recently used first
+        self.nbytes = 0
+        self.checked = {}  # source signatures checked in this run, by key
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        if self.root and not os.path.exists(self.root):
+            os.makedirs(self.root, exist_ok=True)
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def reset(self):
+        """Check sources again (e.g., at the start of a new run)"""
+        self.checked = {}
+
+    def clear(self):
+        self.data.clear()
+        self.nbytes = 0
+        self.checked = {}
+
+    def read_csv(self, path, *args, **kwargs):
+
+        key = sha1((path + repr(args) + repr(sorted(kwargs.items()))).encode()).hexdigest()
+
+        if key in self.checked:
+            signature = self.checked[key]
+        else:
+            signature = _signature(path) if self.root else None
+            entry = self.data.get(key)
+            if entry is not None and signature is not None and entry[2] != signature:
+                self._remove(key)
+            self.checked[key] = signature
+
+        entry = self.data.get(key)
+        if entry is not None:
+            self.hits += 1
+            self.data.move_to_end(key)
+            return entry[0]
+
+        data = None
+        if signature is not None:
+            data = self._load(key, signature)
+            if data is not None:
+                self.disk_hits += 1
+
+        if data is None:
+            self.misses += 1
+            data = pd.read_csv(path, *args, **kwargs)
+            if signature is not None:
+                self._save(key, data, signature)
+
+        self._add(key, data, signature)
+
+        return data
+
+    def _add(self, key, data, signature):
+        size = _nbytes(data)
+        self.data[key] = (data, size, signature)
+        self.nbytes += size
+        if self.max_bytes is not None:
+            while self.nbytes > self.max_bytes and len(self.data) > 1:
+                self._remove(next(iter(self.data)))
+
+    def _remove(self, key):
+        data, size, signature = self.data.pop(key)
+        self.nbytes -= size
+
+    def _load(self, key, signature):
+        folder = os.path.join(self.root, key)
+        try:
+            with open(os.path.join(folder, META_FILENAME), 'rb') as f:
+                meta = pickle.load(f)
+            if meta['signature'] != signature:
+                return None
+            index = pd.Index(_load_array(os.path.join(folder, 'index.npy')), name=meta['index_name'])
+            if meta['blocks'] == 1:
+                values = _load_array(os.path.join(folder, 'values.npy'))
+                data = pd.DataFrame(values, index=index, columns=meta['columns'], copy=False)
+            else:
+                columns = [_load_array(os.path.join(folder, 'values{}.npy'.format(i))) for i in range(meta['blocks'])]
+                data = pd.DataFrame(dict(zip(range(len(columns)), columns)), index=index)
+                data.columns = meta['columns']
+            data.columns.name = meta['columns_name']
+            if meta['series']:
+                data = data.iloc[:, 0]
+                data.name = meta['name']
+            return data
+        except Exception:
+            return None
+
+    def _save(self, key, data, signature):
+        if isinstance(data, pd.Series):
+            df = data.to_frame()
+            name = data.name
+        elif isinstance(data, pd.DataFrame):
+            df = data
+            name = None
+        else:
+            return
+        if isinstance(df.index, pd.MultiIndex) or isinstance(df.columns, pd.MultiIndex):
+            return
+
+        tmp_dir = mkdtemp(dir=self.root, prefix='.tmp-')
+        try:
+            _save_array(os.path.join(tmp_dir, 'index.npy'), np.asarray(df.index.values))
+            dtypes = set(df.dtypes)
+            if len(dtypes) == 1 and list(dtypes)[0] != object:
+                # a single block, which can be used directly without copying
+                _save_array(os.path.join(tmp_dir, 'values.npy'), df.values)
+                blocks = 1
+            else:
+                for i in range(df.shape[1]):
+                    _save_array(os.path.join(tmp_dir, 'values{}.npy'.format(i)), np.asarray(df.iloc[:, i].values))
+                blocks = df.shape[1]
+            meta = {
+                'signature': signature,
+                'series': isinstance(data, pd.Series),
+                'name': name,
+                'index_name': df.index.name,
+                'columns': list(df.columns),
+                'columns_name': df.columns.name,
+                'blocks': blocks,
+                'created': time.time(),
+            }
+            with open(os.path.join(tmp_dir, META_FILENAME), 'wb') as f:
+                pickle.dump(meta, f)
+            folder = os.path.join(self.root, key)
+            if os.path.exists(folder):
+                # the source has changed
+                rmtree(folder, ignore_errors=True)
+            os.rename(tmp_dir, folder)
+        except Exception:
+            # most likely another worker just saved the same data
+            rmtree(tmp_dir, ignore_errors=True)
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'entries': len(self.data),
+            'bytes': self.nbytes,
+        }
+
+
+def _get_data_store():
+    here = os.path.dirname(os.path.abspath(__file__))
+    root = None
+    if os.environ.get('WATERLP_DATA_CACHE', 'Y').upper() not in ['N', 'NO', '0', 'FALSE']:
+        root = os.environ.get('WATERLP_DATA_CACHE_DIR', os.path.join(here, '..', '..', 'data_cache'))
+    max_bytes = float(os.environ.get('WATERLP_DATA_CACHE_MAX_MB', 1000)) * 1e6
+
+    return DataStore(root=root and os.path.abspath(root), max_bytes=max_bytes)
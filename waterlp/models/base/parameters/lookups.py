@@ -0,0 +1,77 @@
+import numpy as np
+import pandas as pd
+
+LOOKUP_TYPES = ['date', 'dayofyear', 'year', 'wateryear']
+
+
+def water_year(dates, start_month=10):
+    return dates.year + (dates.month >= start_month).astype(int)
+
+
+class TimestepLookup(object):
+    """
+    Data mapped onto the model's time steps, so that policies can look up values by time step index rather than by
+    date strings or pandas labels. For example, instead of:
+
+        self.fish_data['1900-{:02}-{:02}'.format(timestep.month, timestep.day)]
+
+    use:
+
+        self.fish_data = self.lookup(self.fish_data, by='dayofyear')  # once, e.g. in __init__
+        self.fish_data[timestep]
+
+    The data can be keyed by date ('date'), by month and day, in any year ('dayofyear'), by calendar year ('year')
+    or by water year ('wateryear'). The values are calculated the first time they are used after the model is reset.
+    Time steps without data are nan.
+    """
+
+    def __init__(self, model, data, by='date', column=None, water_year_start=10):
+        if by not in LOOKUP_TYPES:
+            raise Exception('Unknown lookup type "{}". Lookup types are: {}'.format(by, ', '.join(LOOKUP_TYPES)))
+        if isinstance(data, pd.DataFrame) and column is not None:
+            data = data[column]
+        self.model = model
+        self.data = data
+        self.by = by
+        self.water_year_start = water_year_start
+        self.values = None
+
+    def __getitem__(self, timestep):
+        if self.values is None:
+            self.update()
+        return self.values[timestep.index]
+
+    def reset(self):
+        self.values = None
+
+    def dates(self):
+        index = self.model.timestepper.datetime_index
+        if isinstance(index, pd.PeriodIndex):
+            index = index.to_timestamp()
+        return pd.DatetimeIndex(index)
+
+    def update(self):
+        dates = self.dates()
+        data = self.data.copy(deep=False)  # the data may be shared with other parameters
+
+        if self.by == 'date':
+            data.index = pd.to_datetime(data.index)
+            keys = dates
+
+        elif self.by == 'dayofyear':
+            index = pd.to_datetime(data.index)
+            data.index = pd.MultiIndex.from_arrays([index.month, index.day])
+            data = data[~data.index.duplicated()]
+            keys = list(zip(dates.month, dates.day))
+            if (2, 29) not in data.index and (2, 28) in data.index:
+                keys = [(2, 28) if key == (2, 29) else key for key in keys]
+
+        elif self.by == 'year':
+            data.index = [int(y) for y in data.index]
+            keys = list(dates.year)
+
+        else:
+            data.index = [int(y) for y in data.index]
+            keys = list(water_year(dates, self.water_year_start))
+
+        self.values = np.asarray(data.reindex(keys).values)
@@ -0,0 +1,527 @@
+import os
+import json
+import time
+import zlib
+import pickle
+from hashlib import sha1
+from collections import OrderedDict
+from tempfile import mkdtemp
+from shutil import rmtree
+
+# bump this whenever the generated model/policy format changes, so that old entries are not reused
+CACHE_VERSION = 4
+
+MODEL_FILENAME = 'pywr_model.json'
+POLICIES_FILENAME = '_parameters.py'
+BYTECODE_FOLDER = '.bytecode'
+METADATA_FILENAME = 'cache.json'
+
+
+def _jsonable(d):
+    # resource attribute indices are tuples, which json can't use as keys
+    if not d:
+        return []
+    return sorted([('%s/%s/%s' % k if type(k) == tuple else str(k), v) for k, v in d.items()], key=lambda x: x[0])
+
+
+def _default(obj):
+    # large arrays (e.g., timeseries values) are represented by a hash of their contents
+    if hasattr(obj, 'tobytes'):
+        return [str(obj.dtype), list(obj.shape), sha1(obj.tobytes()).hexdigest()]
+    return str(obj)
+
+
+def _topology(network):
+    """Extract just the parts of the network that are used to build the model (i.e., without scenario data)"""
+
+    def resource(r, *extra):
+        return [
+            r['id'],
+            r['name'],
+            [[t['template_id'], t['id'], t['name']] for t in r['types']],
+            [[ra['id'], ra['attr_id'], ra['attr_name']] for ra in r['attributes']],
+        ] + [r[key] for key in extra]
+
+    return {
+        'name': network['name'],
+        'description': network['description'],
+        'folder': network['layout'].get('storage', {}).get('folder'),
+        'network': resource(network),
+        'nodes': [resource(n) for n in network['nodes']],
+        'links': [resource(l, 'node_1_id', 'node_2_id') for l in network['links']],
+    }
+
+
+def model_key(network, template, start=None, end=None, step=None, tattrs=None, constants=None, parameters=None,
+              initial_volumes=None, scenarios=None, patchable=None):
+    """
+    Create a content hash for a model from everything that goes into building it.
+    Policy code is included since it is part of the parameters.
+    """
+
+    content = json.dumps({
+        'version': CACHE_VERSION,
+        'network': _topology(network),
+        'template': template,
+        'timestepper': [str(start), str(end), str(step)],
+        'tattrs': _jsonable(tattrs),
+        'constants': _jsonable(constants),
+        'parameters': _jsonable(parameters),
+        'initial_volumes': _jsonable(initial_volumes),
+        'scenarios': scenarios,
+        'patchable': sorted(patchable or []),
+    }, sort_keys=True, default=_default)
+
+    return sha1(content.encode()).hexdigest()
+
+
+def source_data_context(dates, **kwargs):
+    """Create a hash of everything other than the dataset that affects evaluated source data (e.g., the dates)."""
+    content = json.dumps({
+        'version': CACHE_VERSION,
+        'dates': dates,
+        'kwargs': kwargs,
+    }, sort_keys=True, default=_default)
+
+    return sha1(content.encode()).hexdigest()
+
+
+def _folder_size(folder):
+    size = 0
+    for dirpath, dirnames, filenames in os.walk(folder):
+        for filename in filenames:
+            try:
+                size += os.path.getsize(os.path.join(dirpath, filename))
+            except OSError:
+                pass
+    return size
+
+
+class ModelCache(object):
+    """
+    A persistent, content-addressed cache of compiled Pywr models (the model JSON plus the generated policies).
+
+    Each entry is a folder named by the model key. Entries are written to a temporary folder first and then
+    renamed into place, so that several workers can share the same cache folder.
+    """
+
+    def __init__(self, root=None, max_size=None, max_age=None):
+        self.root = root
+        self.max_size = max_size  # bytes
+        self.max_age = max_age  # seconds since last use
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        if self.root and not os.path.exists(self.root):
+            os.makedirs(self.root, exist_ok=True)
+
+        # compiled policies are shared by models with the same policies (see utils.compile_policies)
+        self.bytecode_dir = self.root and os.path.join(self.root, BYTECODE_FOLDER)
+        if self.bytecode_dir and not os.path.exists(self.bytecode_dir):
+            os.makedirs(self.bytecode_dir, exist_ok=True)
+
+    def path(self, key, *args):
+        return os.path.join(self.root, key, *args)
+
+    def get(self, key):
+        """Return the folder of a cached model, or None if it is not cached."""
+        if key and os.path.exists(self.path(key, METADATA_FILENAME)):
+            self.hits += 1
+            self.touch(key)
+            return self.path(key)
+        else:
+            self.misses += 1
+            return None
+
+    def put(self, key, model, policy_source):
+        """Add a newly created model (a Pywr model dictionary plus the combined policy source code) to the cache."""
+
+        tmp_dir = mkdtemp(dir=self.root, prefix='.tmp-')
+        try:
+            with open(os.path.join(tmp_dir, MODEL_FILENAME), 'w') as f:
+                json.dump(model, f)
+            with open(os.path.join(tmp_dir, POLICIES_FILENAME), 'w') as f:
+                f.write(policy_source)
+            with open(os.path.join(tmp_dir, METADATA_FILENAME), 'w') as f:
+                json.dump({'key': key, 'created': time.time(), 'version': CACHE_VERSION}, f)
+            os.rename(tmp_dir, self.path(key))
+        except OSError:
+            # most likely another worker just added the same model
+            rmtree(tmp_dir, ignore_errors=True)
+
+        self.evict()
+
+        return self.path(key)
+
+    def touch(self, key):
+        try:
+            os.utime(self.path(key, METADATA_FILENAME))
+        except OSError:
+            pass
+
+    def entries(self):
+        """Return a list of (key, last used, size) for all entries, least recently used first."""
+        entries = []
+        for key in os.listdir(self.root):
+            if key.startswith('.'):
+                continue
+            try:
+                last_used = os.path.getmtime(self.path(key, METADATA_FILENAME))
+            except OSError:
+                continue
+            entries.append((key, last_used, _folder_size(self.path(key))))
+
+        return sorted(entries, key=lambda x: x[1])
+
+    def remove(self, key):
+        rmtree(self.path(key), ignore_errors=True)
+        self.evictions += 1
+
+    def evict(self):
+        """Remove entries that are older than max_age, then the least recently used entries above max_size."""
+
+        entries = self.entries()
+
+        if self.max_age is not None:
+            now = time.time()
+            for key, last_used, size in list(entries):
+                if now - last_used > self.max_age:
+                    self.remove(key)
+                    entries.remove((key, last_used, size))
+            for filename in os.listdir(self.bytecode_dir):
+                path = os.path.join(self.bytecode_dir, filename)
+                try:
+                    if now - os.path.getmtime(path) > self.max_age:
+                        os.remove(path)
+                except OSError:
+                    pass
+
+        if self.max_size is not None:
+            total_size = sum([e[2] for e in entries])
+            for key, last_used, size in entries:
+                if total_size <= self.max_size:
+                    break
+                self.remove(key)
+                total_size -= size
+
+    def clear(self):
+        for key, last_used, size in self.entries():
+            self.remove(key)
+
+    def stats(self):
+        entries = self.entries()
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+            'evictions': self.evictions,
+            'entries': len(entries),
+            'size': sum([e[2] for e in entries]),
+        }
+
+
+class SourceDataCache(object):
+    """
+    A persistent cache of evaluated source data (see WaterSystem.collect_source_data), so that only new or modified
+    datasets are evaluated again.
+
+    There is one file per dataset and evaluation context (the time steps, etc.), which holds a hash of the dataset's
+    content (value and metadata) together with the evaluated value. Entries for datasets that have changed are
+    replaced; the least recently used entries above max_size are removed.
+    """
+
+    def __init__(self, root=None, max_size=None):
+        self.root = root
+        self.max_size = max_size  # bytes
+        self.hits = 0
+        self.misses = 0
+        self.updates = 0  # misses for datasets that were cached, but have changed
+        self.evictions = 0
+
+        if self.root and not os.path.exists(self.root):
+            os.makedirs(self.root, exist_ok=True)
+
+    def path(self, dataset_id, context):
+        return os.path.join(self.root, '{}-{}.pkl'.format(dataset_id, context[:16]))
+
+    @staticmethod
+    def content_hash(value):
+        content = json.dumps([value.get('type'), value.get('value'), value.get('metadata')], default=_default)
+        return sha1(content.encode()).hexdigest()
+
+    def get(self, dataset_id, context, content_hash):
+        """Return (True, value) if the dataset is cached with the same content, otherwise (False, None)."""
+        path = self.path(dataset_id, context)
+        try:
+            with open(path, 'rb') as f:
+                cached_hash, value = pickle.load(f)
+        except FileNotFoundError:
+            self.misses += 1
+            return False, None
+        except Exception:
+            # e.g., an incomplete or outdated entry
+            cached_hash, value = None, None
+
+        if cached_hash != content_hash:
+            self.misses += 1
+            self.updates += 1
+            return False, None
+
+        self.hits += 1
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return True, value
+
+    def put(self, dataset_id, context, content_hash, value):
+        path = self.path(dataset_id, context)
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        try:
+            with open(tmp_path, 'wb') as f:
+                pickle.dump((content_hash, value), f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, path)
+        except Exception:
+            # the value can't be pickled, or the cache folder isn't writable
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+    def entries(self):
+        """Return a list of (path, last used, size) for all entries, least recently used first."""
+        entries = []
+        for filename in os.listdir(self.root):
+            if not filename.endswith('.pkl'):
+                continue
+            path = os.path.join(self.root, filename)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((path, stat.st_mtime, stat.st_size))
+
+        return sorted(entries, key=lambda x: x[1])
+
+    def evict(self):
+        """Remove the least recently used entries above max_size."""
+        if self.max_size is None:
+            return
+        entries = self.entries()
+        total_size = sum([e[2] for e in entries])
+        for path, last_used, size in entries:
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+                self.evictions += 1
+            except OSError:
+                pass
+            total_size -= size
+
+    def clear(self):
+        for path, last_used, size in self.entries():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def stats(self):
+        entries = self.entries()
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'updates': self.updates,
+            'hit_rate': self.hits / total if total else 0.0,
+            'evictions': self.evictions,
+            'entries': len(entries),
+            'size': sum([e[2] for e in entries]),
+        }
+
+
+class ArtifactStore(object):
+    """
+    Content-addressed artifacts (e.g., prepared WaterSystems) that are published once by the process preparing a run
+    and loaded by the Celery workers, so that tasks only need to carry the artifact key.
+
+    Artifacts are pickled and compressed, and keyed by a hash of the result. They are stored in Redis or, if root is
+    given, in a folder shared by all workers. Each process keeps the last few artifacts it loaded (or published).
+    """
+
+    prefix = 'waterlp-artifact-'
+
+    def __init__(self, root=None, redis=None, ttl=None, size=2):
+        self.root = root
+        self.redis = redis
+        self.ttl = ttl  # seconds
+        self.size = size
+        self.objects = OrderedDict()
+        self.hits = 0  # loaded in this process already
+        self.loads = 0
+        self.published = 0
+
+        if self.root and not os.path.exists(self.root):
+            os.makedirs(self.root, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.root, '{}.pkl.z'.format(key))
+
+    def _keep(self, key, obj):
+        self.objects[key] = obj
+        self.objects.move_to_end(key)
+        while len(self.objects) > self.size:
+            self.objects.popitem(last=False)
+
+    def put(self, obj):
+        """Publish an object, if it isn't published already, and return its key."""
+        blob = zlib.compress(pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL), 1)
+        key = sha1(blob).hexdigest()
+
+        if self.root:
+            path = self.path(key)
+            if os.path.exists(path):
+                os.utime(path)
+            else:
+                tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+                with open(tmp_path, 'wb') as f:
+                    f.write(blob)
+                os.replace(tmp_path, path)
+                self.published += 1
+            self.evict()
+        elif self.redis.set(self.prefix + key, blob, ex=self.ttl, nx=True):
+            self.published += 1
+        elif self.ttl:
+            self.redis.expire(self.prefix + key, self.ttl)
+
+        self._keep(key, obj)
+        return key
+
+    def get(self, key):
+        obj = self.objects.get(key)
+        if obj is not None:
+            self.hits += 1
+            self.objects.move_to_end(key)
+            return obj
+
+        if self.root:
+            with open(self.path(key), 'rb') as f:
+                blob = f.read()
+        else:
+            blob = self.redis.get(self.prefix + key)
+            if blob is None:
+                raise Exception('Artifact {} not found. It may have expired; please run the model again.'.format(key))
+
+        obj = pickle.loads(zlib.decompress(blob))
+        self.loads += 1
+        self._keep(key, obj)
+        return obj
+
+    def evict(self):
+        """Remove artifacts older than ttl from the shared folder (Redis expires them itself)."""
+        if not self.root or not self.ttl:
+            return
+        now = time.time()
+        for filename in os.listdir(self.root):
+            path = os.path.join(self.root, filename)
+            try:
+                if now - os.stat(path).st_mtime > self.ttl:
+                    os.remove(path)
+            except OSError:
+                pass
+
+    def stats(self):
+        return {'published': self.published, 'loads': self.loads, 'hits': self.hits}
+
+
+class ModelPool(object):
+    """
+    Loaded models that can be reused in this process (e.g., by a worker running many variations of the same network).
+    Models are keyed by everything except the values of the parameters that vary (see PywrModel.patch).
+    """
+
+    def __init__(self, size=2):
+        self.size = size
+        self.models = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        model = self.models.get(key)
+        if model is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.models.move_to_end(key)
+        return model
+
+    def put(self, key, model):
+        model.pooled = True
+        self.models[key] = model
+        while len(self.models) > self.size:
+            key, old_model = self.models.popitem(last=False)
+            old_model.pooled = False
+            old_model.cleanup()
+
+    def clear(self):
+        while self.models:
+            key, model = self.models.popitem()
+            model.pooled = False
+            model.cleanup()
+
+
+def _get_model_cache():
+    if os.environ.get('WATERLP_MODEL_CACHE', 'Y').upper() in ['N', 'NO', '0', 'FALSE']:
+        return None
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    root = os.environ.get('WATERLP_MODEL_CACHE_DIR', os.path.join(here, 'cache'))
+    max_size = float(os.environ.get('WATERLP_MODEL_CACHE_MAX_MB', 500)) * 1e6
+    max_age = float(os.environ.get('WATERLP_MODEL_CACHE_MAX_DAYS', 30)) * 24 * 3600
+
+    return ModelCache(root=root, max_size=max_size, max_age=max_age)
+
+
+def _get_source_data_cache():
+    if os.environ.get('WATERLP_SOURCE_DATA_CACHE', 'Y').upper() in ['N', 'NO', '0', 'FALSE']:
+        return None
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    root = os.environ.get('WATERLP_SOURCE_DATA_CACHE_DIR', os.path.join(here, 'source_cache'))
+    max_size = float(os.environ.get('WATERLP_SOURCE_DATA_CACHE_MAX_MB', 1000)) * 1e6
+
+    return SourceDataCache(root=root, max_size=max_size)
+
+
+def get_artifact_store():
+    """
+    The artifact store shared by the workers: a folder (WATERLP_ARTIFACT_DIR) or Redis (REDIS_HOST), if available.
+    None means that prepared systems are sent with each task instead.
+    """
+    global artifact_store
+
+    if artifact_store is None:
+        if os.environ.get('WATERLP_ARTIFACT_STORE', 'Y').upper() in ['N', 'NO', '0', 'FALSE']:
+            return None
+
+        root = os.environ.get('WATERLP_ARTIFACT_DIR')
+        redis = None
+        if not root:
+            from waterlp.reporters.redis import local_redis as redis
+            if redis is None:
+                return None
+        ttl = float(os.environ.get('WATERLP_ARTIFACT_TTL_HOURS', 24)) * 3600
+        size = int(os.environ.get('WATERLP_ARTIFACT_POOL_SIZE', 2))
+
+        artifact_store = ArtifactStore(root=root, redis=redis, ttl=int(ttl), size=size)
+
+    return artifact_store
+
+
+# one cache and pool per process
+model_cache = _get_model_cache()
+source_data_cache = _get_source_data_cache()
+model_pool = ModelPool(size=int(os.environ.get('WATERLP_MODEL_POOL_SIZE', 2)))
+artifact_store = None  # see get_artifact_store
@@ -1,8 +1,15 @@
 from os import environ
 import json
 from calendar import isleap
+from datetime import timedelta
+import numpy as np
 import pandas
 
+try:
+    from orjson import loads as json_loads  # much faster than json for large timeseries
+except ImportError:
+    json_loads = json.loads
+
 
 def eval_scalar(x):
     try:  # create the function
@@ -17,12 +24,102 @@ def eval_scalar(x):
     return x
 
 
+# time steps per year, for spans with a fixed number of time steps per year
+PERIODS = {'week': 52, 'month': 12, 'thricemonthly': 36}
+
+
 def eval_descriptor(s):
     return s
 
 
+def _to_datetime64(keys):
+    try:
+        # ISO dates, without fractions of a second or time zone (e.g., "2000-01-01T00:00:00.000Z")
+        return np.array([key[:19] for key in keys], dtype='datetime64[s]')
+    except ValueError:
+        return pandas.to_datetime(keys).values.astype('datetime64[s]')
+
+
+def decode_timeseries(timeseries, dates, fill_value=None, flatten=False):
+    """
+    Decode a timeseries directly to contiguous float64 arrays (one per column) aligned to dates, without pandas.
+    Periodic timeseries (in the year 9998 or 9999) are aligned by month and day. Missing values are nan, unless
+    fill_value is given.
+    """
+
+    dates = np.asarray(dates, dtype='datetime64[s]')
+
+    result = {}
+    for column, col_dates, col_values in timeseries_columns(timeseries):
+
+        if len(col_dates) and col_dates[0] >= np.datetime64('9998-01-01'):
+            # periodic: use the same values each year
+            col_dates = _month_day(col_dates)
+            targets = _month_day(dates)
+        else:
+            targets = dates
+
+        aligned = np.full(len(dates), np.nan)
+        pos = np.searchsorted(col_dates, targets)
+        pos[pos == len(col_dates)] = 0
+        found = col_dates[pos] == targets if len(col_dates) else np.zeros(len(dates), dtype=bool)
+        aligned[found] = col_values[pos[found]]
+
+        try:
+            column = int(column)
+        except ValueError:
+            pass
+        result[column] = aligned
+
+    if not result:
+        result[0] = np.full(len(dates), np.nan)
+
+    if fill_value is not None:
+        for column in result:
+            result[column][np.isnan(result[column])] = fill_value
+
+    if flatten:
+        result = {0: np.nansum(np.vstack(list(result.values())), axis=0)}
+
+    return result
+
+
+def timeseries_columns(timeseries):
+    """
+    Yield (column, dates, values) for each column of a timeseries, sorted by date. The timeseries can be a JSON string
+    (as stored in Hydra) or an object with a columns method that does the same (e.g., from a snapshot).
+    """
+    if hasattr(timeseries, 'columns'):
+        yield from timeseries.columns()
+        return
+
+    data = json_loads(timeseries) if timeseries else {}
+    for column, values in data.items():
+        col_dates = _to_datetime64(list(values))
+        col_values = np.array([np.nan if v is None else v for v in values.values()], dtype=np.float64)
+
+        order = np.argsort(col_dates, kind='stable')
+        yield column, col_dates[order], col_values[order]
+
+
+def _month_day(dates):
+    months = dates.astype('datetime64[M]')
+    days = (dates.astype('datetime64[D]') - months.astype('datetime64[D]')).astype(int)
+    return (months.astype(int) % 12) * 31 + days
+
+
 def eval_timeseries(timeseries, dates, fill_value=None, fill_method=None, flatten=False, flavor=None,
                     date_format='%Y-%m-%d %H:%M:%S'):
+
+    if flavor == 'numpy':
+        try:
+            return decode_timeseries(timeseries, dates, fill_value=fill_value, flatten=flatten)
+        except:
+            raise Exception('Error parsing timeseries data')
+
+    if hasattr(timeseries, 'to_json'):
+        timeseries = timeseries.to_json()
+
     try:
 
         df = pandas.read_json(timeseries)
@@ -62,7 +159,7 @@ def eval_array(array, flavor=None):
         array_as_list = json.loads(array)
         if flavor is None:
             result = array
-        elif flavor == 'native':
+        elif flavor in ['native', 'numpy']:
             result = array_as_list
         elif flavor == 'pandas':
             result = pandas.DataFrame(array_as_list)
@@ -117,51 +214,152 @@ def eval_function(function, data_type):
         return function
 
 
-class Timestep(object):
-    index = -1
-    periodic_timestep = 1
+class TimestepTable(object):
+    """
+    The model's time steps as numpy columns (date, index, timestep, year, month, day, water_year and
+    periodic_timestep), computed in bulk. Iterating or indexing the table gives Timestep views, and slicing it (e.g.,
+    for debugging) gives another table with views of the same columns.
+    """
 
-    def __init__(self, date, start_date, span):
-        if date == start_date:
-            type(self).index = 0
-            type(self).periodic_timestep = 1
-        else:
-            type(self).index += 1
-        self.index = type(self).index
-        self.timestep = self.index + 1
-        self.date = date
-        self.year = date.year
-        self.month = date.month
-        self.day = date.day
-        self.date_as_string = date.isoformat(' ')
+    columns = ['dates', 'index', 'timestep', 'year', 'month', 'day', 'water_year', 'periodic_timestep']
 
-        if start_date:
-            if date.month < start_date.month:
-                self.water_year = date.year
-            else:
-                self.water_year = date.year + 1
+    def __init__(self, dates=None, start_date=None, span=None, **columns):
+        self.span = span
+        if columns:
+            self.dates = dates
+            for name, values in columns.items():
+                setattr(self, name, values)
+            return
 
-        if span:
-            self.span = span
-            self.set_periodic_timestep(date, start_date, span)
+        dates = np.asarray(dates if dates is not None else [], dtype='datetime64[s]')
+        n = len(dates)
+        months = dates.astype('datetime64[M]')
+        years = dates.astype('datetime64[Y]')
 
-    def set_periodic_timestep(self, date, start_date, span):
+        self.dates = dates
+        self.index = np.arange(n)
+        self.timestep = self.index + 1
+        self.year = years.astype(int) + 1970
+        self.month = (months - years).astype(int) + 1
+        self.day = (dates.astype('datetime64[D]') - months).astype(int) + 1
+
+        if start_date is not None:
+            self.water_year = self.year + (self.month >= start_date.month)
+        else:
+            self.water_year = np.zeros(n, dtype=int)
 
         if span == 'day':
-            if (date.month, date.day) == (start_date.month, start_date.day):
-                type(self).periodic_timestep = 1
-            else:
-                type(self).periodic_timestep += 1
-            self.periodic_timestep = type(self).periodic_timestep
+            # count days since the last start of the year (the start month and day, or the first time step)
+            starts = (self.month == start_date.month) & (self.day == start_date.day)
+            starts[:1] = True
+            last_start = np.maximum.accumulate(np.where(starts, self.index, 0))
+            self.periodic_timestep = self.index - last_start + 1
+        elif span in PERIODS:
+            self.periodic_timestep = self.index % PERIODS[span] + 1
+        else:
+            self.periodic_timestep = np.ones(n, dtype=int)
 
-        elif span == 'week':
-            self.periodic_timestep = self.index % 52 + 1
+    def __len__(self):
+        return len(self.dates)
 
-        elif span == 'month':
-            self.periodic_timestep = self.index % 12 + 1
+    def __iter__(self):
+        return (Timestep(self, i) for i in range(len(self)))
 
-        elif span == 'thricemonthly':
-            self.periodic_timestep = self.index % 36 + 1
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return TimestepTable(
+                span=self.span, **{name: getattr(self, name)[item] for name in self.columns}
+            )
+        if item < 0:
+            item += len(self)
+        if not 0 <= item < len(self):
+            raise IndexError('time step index out of range')
+        return Timestep(self, item)
+
+    def since(self, date):
+        """The time steps on or after a date"""
+        return self[int(np.searchsorted(self.dates, np.datetime64(pandas.Timestamp(date), 's'))):]
+
+    def timestamps(self):
+        return list(pandas.DatetimeIndex(self.dates))
+
+    def dates_as_string(self):
+        return [d.replace('T', ' ') for d in np.datetime_as_string(self.dates, unit='s')]
+
+
+class Timestep(object):
+    """A lightweight view of one row of a TimestepTable"""
+
+    __slots__ = ('table', 'i')
+
+    def __init__(self, table, i):
+        self.table = table
+        self.i = i
+
+    def __repr__(self):
+        return 'Timestep({}, {})'.format(self.timestep, self.date_as_string)
+
+    @property
+    def index(self):
+        return int(self.table.index[self.i])
+
+    @property
+    def timestep(self):
+        return int(self.table.timestep[self.i])
+
+    @property
+    def date(self):
+        return pandas.Timestamp(self.table.dates[self.i])
+
+    @property
+    def year(self):
+        return int(self.table.year[self.i])
+
+    @property
+    def month(self):
+        return int(self.table.month[self.i])
+
+    @property
+    def day(self):
+        return int(self.table.day[self.i])
+
+    @property
+    def date_as_string(self):
+        return np.datetime_as_string(self.table.dates[self.i], unit='s').replace('T', ' ')
+
+    @property
+    def water_year(self):
+        return int(self.table.water_year[self.i])
+
+    @property
+    def span(self):
+        return self.table.span
+
+    @property
+    def periodic_timestep(self):
+        return int(self.table.periodic_timestep[self.i])
+
+
+def _weekly_dates(start_date, end_date):
+    # 52 weeks per year; the extra day in each year (two in leap years) is added to the last week
+    dates = []
+    for i in range(52 * (end_date.year - start_date.year)):
+        if i == 0:
+            date = start_date
+        else:
+            date = dates[-1] + timedelta(days=7)
+        if isleap(date.year) and date.month == 3 and date.day == 4:
+            date += timedelta(days=1)
+        if date.month == 12 and date.day == 31:
+            date += timedelta(days=1)
+        dates.append(date)
+    return dates
+
+
+def _thricemonthly_dates(start, end):
+    month_ends = pandas.date_range(start=start, end=end, freq='M').values.astype('datetime64[D]')
+    month_starts = month_ends.astype('datetime64[M]').astype('datetime64[D]')
+    return np.column_stack([month_starts + 9, month_starts + 19, month_ends]).ravel()
 
 
 def make_timesteps(data_type='timeseries', **kwargs):
@@ -171,7 +369,8 @@ def make_timesteps(data_type='timeseries', **kwargs):
     start = kwargs.get('start') or kwargs.get('start_time')
     end = kwargs.get('end') or kwargs.get('end_time')
 
-    timesteps = []
+    dates = None
+    start_date = None
 
     if start and end and span:
         start_date = pandas.to_datetime(start)
@@ -179,36 +378,19 @@ def make_timesteps(data_type='timeseries', **kwargs):
         span = span.lower()
 
         if data_type == 'periodic timeseries':
-            start_date = pandas.datetime(9998, 1, 1)
-            end_date = pandas.datetime(9998, 12, 31, 23, 59)
+            start_date = pandas.Timestamp(9998, 1, 1)
+            end_date = pandas.Timestamp(9998, 12, 31, 23, 59)
 
         if span == 'day':
-            timesteps = [Timestep(d, start_date, span) for d in pandas.date_range(start=start, end=end, freq='D')]
+            dates = pandas.date_range(start=start, end=end, freq='D').values
         elif span == 'week':
-            dates = []
-            for i in range(52 * (end_date.year - start_date.year)):
-                if i == 0:
-                    date = start_date
-                else:
-                    date = dates[-1] + pandas.DateOffset(days=7)
-                if isleap(date.year) and date.month == 3 and date.day == 4:
-                    date += pandas.DateOffset(days=1)
-                if date.month == 12 and date.day == 31:
-                    date += pandas.DateOffset(days=1)
-                dates.append(date)
-            timesteps = [Timestep(date, start_date, 'week') for date in dates]
+            dates = _weekly_dates(start_date, end_date)
         elif span == 'month':
-            timesteps = [Timestep(d, start_date, 'month') for d in pandas.date_range(start=start, end=end, freq='M')]
+            dates = pandas.date_range(start=start, end=end, freq='M').values
         elif span == 'thricemonthly':
-            dates = []
-            for date in pandas.date_range(start=start, end=end, freq='M'):
-                d1 = pandas.datetime(date.year, date.month, 10)
-                d2 = pandas.datetime(date.year, date.month, 20)
-                d3 = pandas.datetime(date.year, date.month, date.daysinmonth)
-                dates.extend([d1, d2, d3])
-            timesteps = [Timestep(d, start_date, span) for d in dates]
+            dates = _thricemonthly_dates(start, end)
 
-    return timesteps
+    return TimestepTable(dates, start_date=start_date, span=span)
 
 
 class InnerSyntaxError(SyntaxError):
@@ -237,7 +419,7 @@ class Evaluator:
 
         self.dates = []
         self.dates_as_string = []
-        self.timesteps = []
+        self.timesteps = TimestepTable()
         self.start_date = None
         self.end_date = None
 
@@ -246,14 +428,15 @@ class Evaluator:
             debug_start = kwargs.pop('debug_start', None)
             debug_ts = kwargs.pop('debug_ts', None)
             if debug_start:
-                debug_start = pandas.Timestamp(debug_start)
-                self.timesteps = [t for t in self.timesteps if t.date >= debug_start]
+                self.timesteps = self.timesteps.since(debug_start)
             self.timesteps = self.timesteps[:debug_ts]
-            self.dates = [t.date for t in self.timesteps]
-            self.dates_as_string = [t.date_as_string for t in self.timesteps]
+            self.dates = self.timesteps.timestamps()
+            self.dates_as_string = self.timesteps.dates_as_string()
             self.start_date = self.dates[0].date
             self.end_date = self.dates[-1].date
 
+        self.dates64 = self.timesteps.dates
+
         self.date_format = date_format
         self.tsi = None
         self.tsf = None
@@ -313,7 +496,7 @@ class Evaluator:
             try:
                 return eval_timeseries(
                     value.value,
-                    self.dates_as_string,
+                    self.dates64 if flavor == 'numpy' else self.dates_as_string,
                     date_format=date_format,
                     fill_value=fill_value,
                     flavor=flavor,
@@ -1,15 +1,25 @@
 import os
 import sys
 import json
+from copy import copy
 from importlib import import_module
+from importlib.abc import MetaPathFinder
+from importlib.machinery import PathFinder, SourceFileLoader
+from importlib.util import spec_from_file_location, module_from_spec, decode_source
 import boto3
 from tempfile import mkdtemp
-from shutil import rmtree, copytree
+from shutil import rmtree
 import pandas
+import numpy as np
 
 from pywr.core import Model
+from pywr.parameters import load_parameter, parameter_registry
 
-from .utils import resource_name, clean_parameter_name, create_policy, create_variable, create_control_curve
+from .base import register
+from .base.parameters import WaterLPParameter
+from .utils import resource_name, clean_parameter_name, create_policy, create_variable, create_control_curve, \
+    join_policies, compile_policies, rewrite_references
+from .cache import model_cache, model_key, MODEL_FILENAME, POLICIES_FILENAME
 
 oa_attr_to_pywr = {
     'water demand': 'base_flow',
@@ -65,6 +75,23 @@ recorders = {
     'flow': 'NumpyArrayNodeRecorder',
 }
 
+# the base domains and parameters are registered once per process, rather than once per model
+register()
+
+
+NETWORKS_BUCKET = 'openagua-networks'  # network files, including policy modules, by network storage folder
+
+
+def patch_name(res_attr_idx):
+    """The name of a constant parameter that can be updated in place (see PywrModel.patch)"""
+    return 'variation/%s/%s/%s' % res_attr_idx
+
+
+def copy_state(attributes):
+    """Copy the attributes of a parameter, including mutable containers, but not the objects they refer to"""
+    return {name: copy(value) if isinstance(value, (list, dict, set, np.ndarray)) else value
+            for name, value in attributes.items()}
+
 
 def negative(value):
     return -abs(value) if type(value) in [int, float] else value
@@ -80,6 +107,42 @@ def load_modules(folder):
         import_module(policy_module, package)
 
 
+class PolicyLoader(SourceFileLoader):
+    """Loads policy modules with references to other parameters and nodes rewritten (see rewrite_references)"""
+
+    def get_code(self, fullname):
+        # not cached as bytecode, which the default loader would also use
+        path = self.get_filename(fullname)
+        source = rewrite_references(decode_source(self.get_data(path)))
+        return compile(source, path, 'exec', dont_inherit=True)
+
+
+class PolicyFinder(MetaPathFinder):
+    """Finds the modules of a policy package, to be loaded with PolicyLoader"""
+
+    def __init__(self, name):
+        self.name = name
+
+    def find_spec(self, fullname, path, target=None):
+        if not fullname.startswith(self.name + '.'):
+            return None
+        spec = PathFinder.find_spec(fullname, path)
+        if spec and spec.origin and spec.origin.endswith('.py'):
+            spec.loader = PolicyLoader(fullname, spec.origin)
+        return spec
+
+
+def load_package(name, folder):
+    if not [finder for finder in sys.meta_path if isinstance(finder, PolicyFinder) and finder.name == name]:
+        sys.meta_path.insert(0, PolicyFinder(name))
+    path = os.path.join(folder, '__init__.py')
+    spec = spec_from_file_location(name, path, loader=PolicyLoader(name, path), submodule_search_locations=[folder])
+    module = module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
 def load_from_s3(bucket, network_key, path, dest_root):
     s3 = boto3.client('s3')
 
@@ -105,95 +168,157 @@ def load_from_s3(bucket, network_key, path, dest_root):
 class PywrModel(object):
     def __init__(self, network, template, start=None, end=None, step=None, tattrs=None,
                  constants=None, variables=None, parameters=None, urls=None, modules=None, initial_volumes=None,
-                 check_graph=False):
+                 scenarios=None, patchable=None, check_graph=False, use_cache=True, in_memory=False,
+                 precompute=False):
 
         self.model = None
         self.storage = {}
         self.non_storage = {}
         self.updated = {}  # dictionary for debugging whether or not a param has been updated
+        self.policies = {}  # generated policy code, by policy name
+        self.policy_source = None  # all generated policies, as a single module
 
         self.here = os.path.dirname(os.path.abspath(__file__))
-        tmp_dir = os.path.join(self.here, 'tmp')
-        if not os.path.exists(tmp_dir):
-            os.makedirs(tmp_dir)
-        self.root_dir = mkdtemp(dir=tmp_dir)
-        os.chdir(self.root_dir)
-
-        self.parameters_folder = os.path.join(self.root_dir, '_parameters')
-
-        if not os.path.exists(self.parameters_folder):
-            os.mkdir(self.parameters_folder)
-            with open(os.path.join(self.parameters_folder, '__init__.py'), 'w') as f:
-                f.write('\n')
-
-        self.model_filename = os.path.join(self.root_dir, 'pywr_model.json')
-
-        metadata = {
-            'title': network['name'],
-            'description': network['description'],
-            'minimum_version': '1.0.0'
-        }
+        self.in_memory = in_memory
+        self.precompute = precompute
+        self.precomputed = []  # names of policies that were evaluated ahead of time
+        self.pooled = False  # if True, the model is kept for reuse (see cache.ModelPool)
+        self.root_dir = None
+        self.root_path = None
+        self.initial_state = []  # attributes of policies as loaded, to restore when the model is reused (see patch)
+
+        if not in_memory:
+            tmp_dir = os.path.join(self.here, 'tmp')
+            if not os.path.exists(tmp_dir):
+                os.makedirs(tmp_dir)
+            self.root_dir = mkdtemp(dir=tmp_dir)
+            os.chdir(self.root_dir)
+
+        # Look for a previously compiled model
+        # NB: the key must be created before create_model, which consumes constants and parameters
+        self.cache = model_cache if use_cache else None
+        self.cache_key = None
+        cached_dir = None
+        if self.cache:
+            self.cache_key = model_key(
+                network, template,
+                start=start,
+                end=end,
+                step=step,
+                tattrs=tattrs,
+                constants=constants,
+                parameters=parameters,
+                initial_volumes=initial_volumes,
+                scenarios=scenarios,
+                patchable=patchable
+            )
+            cached_dir = self.cache.get(self.cache_key)
+
+        if cached_dir:
+            print(' [*] Using cached model {}'.format(self.cache_key))
+            self.model_filename = os.path.join(cached_dir, MODEL_FILENAME)
+            with open(os.path.join(cached_dir, POLICIES_FILENAME)) as f:
+                self.policy_source = f.read()
+            pywr_model = self.model_filename
+
+        else:
+            self.model_filename = None
+            if not in_memory:
+                self.model_filename = os.path.join(self.root_dir, MODEL_FILENAME)
+
+            metadata = {
+                'title': network['name'],
+                'description': network['description'],
+                'minimum_version': '1.0.0'
+            }
 
-        # Copy domains and parameters into temp folder
-        for folder in os.listdir(os.path.join(self.here, 'base')):
-            copytree(os.path.join(self.here, 'base', folder), os.path.join(self.root_dir, folder))
-
-        self.create_model(
-            network, template,
-            filename=self.model_filename,
-            start=start,
-            end=end,
-            step=step,
-            constants=constants,
-            parameters=parameters,
-            initial_volumes=initial_volumes,
-            metadata=metadata,
-            tattrs=tattrs
-        )
+            pywr_model = self.create_model(
+                network, template,
+                filename=self.model_filename,
+                start=start,
+                end=end,
+                step=step,
+                constants=constants,
+                parameters=parameters,
+                initial_volumes=initial_volumes,
+                metadata=metadata,
+                tattrs=tattrs,
+                scenarios=scenarios,
+                patchable=patchable
+            )
+
+            self.policy_source = join_policies(self.policies)
+
+            if self.cache:
+                self.cache.put(self.cache_key, pywr_model, self.policy_source)
+
+            if self.model_filename:
+                # keep a copy of the policies with the model, for reference
+                with open(os.path.join(self.root_dir, POLICIES_FILENAME), 'w') as f:
+                    f.write(self.policy_source)
+                pywr_model = self.model_filename
 
         # Copy policy folders from S3
+        # In memory mode, these are kept in a (persistent) network folder rather than in a temp folder
         network_key = network.layout.get('storage', {}).get('folder')
-        bucket = 'openagua-networks'
+        bucket = NETWORKS_BUCKET
+        policies_root = self.root_dir or os.path.join(self.here, 'networks', str(network_key))
         policy_folders = ['policies']
         for folder in policy_folders:
-            load_from_s3(bucket, network_key, folder, self.root_dir)
+            load_from_s3(bucket, network_key, folder, policies_root)
             # load_modules(folder)
 
-        self.load_model(self.root_dir, self.model_filename, bucket=bucket, network_key=network_key)
+        self.load_model(self.root_dir, pywr_model, bucket=bucket, network_key=network_key,
+                        policy_source=self.policy_source, policies_root=policies_root)
 
-    def load_model(self, root_dir, model_path, bucket=None, network_key=None, check_graph=False):
+    def load_model(self, root_dir, model, bucket=None, network_key=None, check_graph=False,
+                   policy_source='', policies_root=None):
+        """
+        Load the model, either from a file (model is the file path) or directly from a Pywr model dictionary.
+        If root_dir is None, the working directory is not changed.
+        """
 
-        os.chdir(root_dir)
+        if root_dir:
+            os.chdir(root_dir)
 
         # needed when loading JSON file
-        root_path = 's3://{}/{}/'.format(bucket, network_key)
+        self.root_path = root_path = 's3://{}/{}/'.format(bucket, network_key)
         os.environ['ROOT_S3_PATH'] = root_path
+        WaterLPParameter.root_path = root_path  # the parameters module is only imported once
+        WaterLPParameter.store.reset()  # check if input data has changed since the last run
 
         # Step 1: Load and register policies
-        sys.path.insert(0, os.getcwd())
-        policy_folder = '_parameters'
-        for filename in os.listdir(policy_folder):
-            if '__init__' in filename:
-                continue
-            policy_name = os.path.splitext(filename)[0]
-            policy_module = '.{policy_name}'.format(policy_name=policy_name)
-            # package = '.{}'.format(policy_folder)
-            import_module(policy_module, policy_folder)
-
-        # from domains import Hydropower, InstreamFlowRequirement
-
-        modules = [
-            ('.IFRS', 'policies'),
-            ('.domains', 'domains')
-        ]
-        for name, package in modules:
-            try:
-                import_module(name, package)
-            except:
-                print(' [-] WARNING: {} could not be imported from {}'.format(name, package))
+        # This is always done, since other models (e.g., of other networks) may have registered policies with the same
+        # names; the compiled code is reused, so this only runs the class definitions
+        module = compile_policies(policy_source, cache_dir=self.cache and self.cache.bytecode_dir)
+        npolicies = len([v for v in vars(module).values()
+                         if type(v) == type and issubclass(v, WaterLPParameter) and v is not WaterLPParameter])
+        print(' [*] {} policies successfully registered'.format(npolicies))
+
+        # network-specific policies (the domains are already registered)
+        policies_root = policies_root or root_dir
+        try:
+            load_package('policies', os.path.join(policies_root, 'policies'))
+        except:
+            print(' [-] WARNING: policies could not be imported from {}'.format(policies_root))
 
         # Step 2: Load and run model
-        self.model = Model.load(model_path, path=model_path)
+        path = None
+        if type(model) == str:
+            path = model
+            if self.precompute:
+                with open(path) as f:
+                    model = json.load(f)
+
+        if self.precompute:
+            self.precompute_policies(model)
+
+        self.model = Model.load(model, path=path)
+
+        # resolve references between policies once, rather than at every time step
+        for parameter in self.model.parameters:
+            if isinstance(parameter, WaterLPParameter):
+                parameter.bind()
 
         # check network graph
         if check_graph:
@@ -204,18 +329,46 @@ class PywrModel(object):
 
         self.setup()
 
+        self.initial_state = [(parameter, copy_state(vars(parameter))) for parameter in self.model.parameters
+                              if isinstance(parameter, WaterLPParameter)]
+
         return
 
+    def precompute_policies(self, pywr_model):
+        """
+        Evaluate policies that depend only on the time step over the whole time period, and replace them in the
+        Pywr model dictionary with array-indexed parameters, so they are not evaluated in Python at every time step.
+        """
+
+        timestepper = pywr_model['timestepper']
+        model = Model(start=timestepper['start'], end=timestepper['end'], timestep=timestepper['timestep'])
+        model.timestepper.setup()
+
+        for name, param in pywr_model['parameters'].items():
+            if type(param) != dict or not param.get('type'):
+                continue
+            policy = parameter_registry.get(param['type'].lower())
+            if not (policy and getattr(policy, 'precompute', False)):
+                continue
+            try:
+                parameter = load_parameter(model, dict(param))
+                model.timestepper.reset()
+                values = [float(parameter.value(timestep, None)) for timestep in model.timestepper]
+            except Exception as err:
+                print(' [-] WARNING: {} could not be precomputed: {}'.format(name, err))
+                continue
+            pywr_model['parameters'][name] = {'type': 'arrayindexed', 'values': values}
+            self.precomputed.append(name)
+
+        if self.precomputed:
+            print(' [*] {} policies precomputed'.format(len(self.precomputed)))
+
     def create_model(self, network, template, start=None, end=None, step=None, initial_volumes=None, filename=None, human_readable=False,
-                     metadata=None, tattrs=None, **kwargs):
+                     metadata=None, tattrs=None, scenarios=None, patchable=None, **kwargs):
 
         constants = kwargs.get('constants', {})
         parameters = kwargs.get('parameters', {})
 
-        # Create folders
-        if not os.path.exists('_parameters'):
-            os.mkdir('_parameters')
-
         timestepper = {
             'start': pandas.Timestamp(start).strftime('%Y-%m-%d'),
             'end': pandas.Timestamp(end).strftime('%Y-%m-%d'),
@@ -248,6 +401,12 @@ class PywrModel(object):
             pywr_param = None
 
             # constants
+            if patchable and res_attr_idx in patchable and res_attr_idx in constants:
+                # this is a named parameter, so that it can be found and updated
+                param_name = patch_name(res_attr_idx)
+                pywr_params[param_name] = {'type': 'constant', 'value': constants.pop(res_attr_idx)}
+                return param_name
+
             constant = constants.pop(res_attr_idx, None)
             if constant:
                 return constant
@@ -264,7 +423,7 @@ class PywrModel(object):
             if ptype == 'variable':
                 pywr_param = create_variable(pvalue)
             elif ptype == 'parameter':
-                pywr_param = create_policy(pvalue, self.parameters_folder, res_attr_lookup, tattr)
+                pywr_param = create_policy(pvalue, self.policies, res_attr_lookup, tattr)
             elif ptype == 'controlcurve':
 
                 pywr_param = create_control_curve(node_lookup=node_lookup, **pvalue)
@@ -519,8 +678,35 @@ class PywrModel(object):
             'recorders': pywr_recorders
         }
 
-        with open(filename, 'w') as f:
-            json.dump(pywr_model, f, indent=4)
+        if scenarios:
+            pywr_model['scenarios'] = scenarios
+
+        if filename:
+            with open(filename, 'w') as f:
+                json.dump(pywr_model, f, indent=4)
+
+        return pywr_model
+
+    def patch(self, values):
+        """
+        Update constant parameters in place and reset the model, so it can be run again without rebuilding it.
+        :param values: New parameter values, by parameter name
+        """
+        if self.root_dir:
+            os.chdir(self.root_dir)
+        os.environ['ROOT_S3_PATH'] = self.root_path
+        WaterLPParameter.root_path = self.root_path  # another model may have been loaded since
+        WaterLPParameter.store.reset()
+
+        # policies may keep state between time steps (e.g., counters), which would carry over into the next run
+        for parameter, state in self.initial_state:
+            attributes = vars(parameter)
+            attributes.clear()
+            attributes.update(copy_state(state))
+
+        for name, value in values.items():
+            self.model.parameters[name].set_double_variables(np.array([float(value)]))
+        self.model.reset()
 
     def setup(self):
         try:
@@ -538,5 +724,7 @@ class PywrModel(object):
         self.cleanup()
 
     def cleanup(self):
-        if os.path.exists(self.root_dir):
+        if self.pooled:
+            return
+        if self.root_dir and os.path.exists(self.root_dir):
             rmtree(self.root_dir)
@@ -1,12 +1,22 @@
 import os
 import json
+from copy import copy, deepcopy
+from tempfile import mkdtemp
+from shutil import rmtree
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import numpy as np
 from attrdict import AttrDict
 import boto3
 from datetime import datetime as dt
 from tqdm import tqdm
 
-from waterlp.models.pywr2 import PywrModel
+from waterlp.models.pywr2 import PywrModel, patch_name, oa_attr_to_pywr, load_from_s3, NETWORKS_BUCKET
+from waterlp.models.utils import timeseries_values, find_references, find_dynamic_references
+from waterlp.models.cache import model_pool, model_key, source_data_cache, source_data_context
 from waterlp.models.evaluator import Evaluator
+from waterlp.utils.scenarios import variation_keys
 from waterlp.models.base.utilities.converter import convert
 
 INITIAL_STORAGE_ATTRS = [
@@ -14,6 +24,26 @@ INITIAL_STORAGE_ATTRS = [
     ('groundwater', 'Initial Storage')
 ]
 
+# name of the Pywr scenario used to run variations together (see WaterSystem.setup_ensemble)
+ENSEMBLE_SCENARIO = 'variations'
+
+
+_evaluator = None  # the evaluator used in source data workers
+
+
+def _init_source_data_worker(evaluator):
+    global _evaluator
+    _evaluator = evaluator
+
+
+def _evaluate_source_data(value, date_format=None):
+    return _evaluator.eval_data(
+        value=value,
+        fill_value=0,
+        date_format=date_format,
+        flavor='numpy',
+    )
+
 
 def perturb(val, variation):
     # NB: this is made explicit to avoid using exec
@@ -22,6 +52,9 @@ def perturb(val, variation):
     if operator == 'multiply':
         if type(val) == dict:
             for c, vals in val.items():
+                if type(vals) == np.ndarray:
+                    vals *= value
+                    continue
                 for i, v in vals.items():
                     if val[c][i] is not None:
                         val[c][i] *= value
@@ -30,6 +63,9 @@ def perturb(val, variation):
     elif operator == 'add':
         if type(val) == dict:
             for c, vals in val.items():
+                if type(vals) == np.ndarray:
+                    vals[~np.isnan(vals)] = value
+                    continue
                 for i, v in vals.items():
                     if val[c][i] is not None:
                         val[c][i] = value
@@ -100,7 +136,8 @@ class WaterSystem(object):
         self.network = network
         self.resources = {}
         self.ttypes = {}
-        self.res_tattrs = {}
+        self.attributes = conn.attributes  # all resource attributes, shared with the connection
+        self.res_tattrs = self.attributes.view('tattr', by='res_attr_ids')
 
         self.initial_volumes = {}
         self.constants = {}
@@ -117,6 +154,11 @@ class WaterSystem(object):
 
         self.attrs_to_save = []
 
+        # variations run together as one multi-scenario Pywr model
+        self.members = []  # metadata for each variation
+        self.ensemble_size = 1
+        self.ensemble_constants = {}
+
         self.log_dir = 'log/{run_name}'.format(run_name=self.args.run_name)
 
         ttypeattrs = {}
@@ -156,7 +198,6 @@ class WaterSystem(object):
                 if ra.attr_id not in tattrs:
                     continue
                 tattr = tattrs[ra.attr_id]
-                self.res_tattrs[ra.id] = tattr
 
                 if tattr.is_var == 'Y' and tattr.properties.get('save', False):
                     self.attrs_to_save.append((resource_type, resource.id, tattr['attr_id']))
@@ -175,9 +216,6 @@ class WaterSystem(object):
         # initialize dictionary of parameters
         # self.scalars = {feature_type: {} for feature_type in ['node', 'link', 'net']}
 
-        self.ra_node = {ra.id: node.id for node in network.nodes for ra in node.attributes}  # res_attr to node lookup
-        self.ra_link = {ra.id: link.id for link in network.links for ra in link.attributes}  # res_attr to link lookup
-
     def create_exception(self, key, message):
 
         resource_type, resource_id, attr_id = key.split('/')
@@ -273,22 +311,18 @@ class WaterSystem(object):
 
             for rs in source.resourcescenarios:
 
-                if rs.resource_attr_id not in self.res_tattrs:
+                i = self.attributes.res_attr_ids.get(rs.resource_attr_id)
+                if i is None:
                     continue  # this is for a different resource type
 
-                # get identifiers
-                if rs.resource_attr_id in self.ra_node:
-                    resource_type = 'node'
-                    resource_id = self.ra_node[rs.resource_attr_id]
-                elif rs.resource_attr_id in self.ra_link:
-                    resource_type = 'link'
-                    resource_id = self.ra_link[rs.resource_attr_id]
-                else:
-                    resource_type = 'network'
-                    resource_id = self.network.id
+                resource_scenarios[i] = rs
 
-                key = '{}/{}/{}'.format(resource_type, resource_id, rs.attr_id)
-                resource_scenarios[key] = rs
+        # only evaluate resource attributes that are used by the model (opt-in)
+        if os.environ.get('WATERLP_LAZY_SOURCE_DATA', 'N').upper() in ['Y', 'YES', '1', 'TRUE']:
+            used = self.find_used_attributes(resource_scenarios)
+            if used is not None:
+                print(' [*] Using {} of {} resource attributes with data'.format(len(used), len(resource_scenarios)))
+                resource_scenarios = {i: rs for i, rs in resource_scenarios.items() if i in used}
 
         # collect/evaluate source data
         print("[*] Collecting source data")
@@ -300,30 +334,15 @@ class WaterSystem(object):
         # source = self.scenario.source_scenarios[source_id]
 
         print("[*] Collecting data")
-        for res_attr_idx in tqdm(resource_scenarios, ncols=80, disable=not self.args.verbose):
-            rs = resource_scenarios[res_attr_idx]
+        items = []
+        for i, rs in resource_scenarios.items():
             cnt += 1
 
             # get identifiers
-            if rs.resource_attr_id in self.ra_node:
-                resource_type = 'node'
-                resource_id = self.ra_node[rs.resource_attr_id]
-            elif rs.resource_attr_id in self.ra_link:
-                resource_type = 'link'
-                resource_id = self.ra_link[rs.resource_attr_id]
-            else:
-                resource_type = 'network'
-                resource_id = self.network.id
-            res_idx = (resource_type, resource_id)
-
-            resource = self.resources.get(res_idx)
-            resource_name = resource['name']
-
-            # key = '{}/{}/{}'.format(resource_type, resource_id, rs.attr_id)
+            idx = self.attributes.key(i)
 
             # get attr name
-            attr_id = rs.attr_id
-            tattr = self.conn.tattrs[(resource_type, resource_id, attr_id)]
+            tattr = self.attributes.columns['tattr'][i]
             if not tattr:
                 continue
 
@@ -350,12 +369,26 @@ class WaterSystem(object):
                 continue # TODO: resolve this somehow
 
             # update data type
-            self.res_tattrs[rs.resource_attr_id]['data_type'] = data_type
+            tattr['data_type'] = data_type
+
+            items.append((idx, rs, tattr, metadata, input_method, is_var, is_function))
+
+        # evaluate the data, which is independent for each resource attribute, so this can be done in parallel
+        evaluated = iter(self.evaluate_source_data([
+            rs for idx, rs, tattr, metadata, input_method, is_var, is_function in items
+            if not (is_var and is_function) and input_method not in ['module', 'controlcurve']
+        ]))
+
+        # merge the results, in the original order
+        for idx, rs, tattr, metadata, input_method, is_var, is_function in items:
+
+            resource_type, resource_id, attr_id = idx
+            resource = self.resources.get((resource_type, resource_id))
+            data_type = rs.value.type
 
             # default blocks
 
-            type_name = self.resources[(resource_type, resource_id)]['type']['name']
-            idx = (resource_type, resource_id, attr_id)
+            type_name = resource['type']['name']
 
             value = None
             if not (is_var and is_function):
@@ -365,12 +398,7 @@ class WaterSystem(object):
                         continue
                     value = json.loads(data)
                 else:
-                    value = self.evaluator.eval_data(
-                        value=rs.value,
-                        fill_value=0,
-                        date_format=self.date_format,
-                        flavor='native',
-                    )
+                    value = next(evaluated)
 
             if not is_var and (value is None or (type(value) == str and not value)):
                 continue
@@ -449,6 +477,204 @@ class WaterSystem(object):
 
         return
 
+    def find_used_attributes(self, resource_scenarios):
+        """
+        Find the resource attributes that are used by the model, i.e., those that are mapped to Pywr attributes,
+        saved, used as initial storage, varied or referenced by the network's policy modules or by the code or data of
+        other used resource attributes.
+        :param resource_scenarios: Resource scenarios by resource attribute id (see ResourceAttributes)
+        :return: A set of resource attribute ids, or None if this can't be determined (all are then used)
+        """
+
+        columns = self.attributes.columns
+
+        # policy modules in the network's S3 folder are all loaded with the model, so anything they use is used
+        modules = self.read_policy_modules()
+        if modules is None:
+            print(' [-] WARNING: The network\'s policy modules could not be read; using all resource attributes')
+            return None
+        for filename, code in modules.items():
+            dynamic = find_dynamic_references(code)
+            if dynamic:
+                print(' [-] WARNING: {} may use resource attributes that can\'t be found ({}); using all resource '
+                      'attributes'.format(filename, dynamic))
+                return None
+
+        # resource attributes that are varied in any variation
+        varied = set()
+        for subscenarios in self.scenario.subscenarios.values():
+            varied.update(variation_keys(subscenarios))
+
+        pending = []
+        for i in resource_scenarios:
+            tattr = columns['tattr'][i]
+            if not tattr:
+                continue
+            idx = self.attributes.key(i)
+            resource_type, resource_id, attr_id = idx
+            resource = self.resources.get((resource_type, resource_id))
+            properties = tattr['properties']
+            attr_name = tattr['attr_name']
+            is_mapped = resource_type != 'network' and attr_name.lower() in oa_attr_to_pywr \
+                and not properties.get('intermediary', False)
+            is_initial_storage = resource and (resource['type']['name'].lower(), attr_name) in INITIAL_STORAGE_ATTRS
+            if is_mapped or is_initial_storage or properties.get('save') or idx in varied:
+                pending.append(i)
+
+        for code in modules.values():
+            for reference in find_references(code):
+                j = self.find_attribute(reference)
+                if j is not None:
+                    pending.append(j)
+
+        used = set()
+        while pending:
+            i = pending.pop()
+            if i in used:
+                continue
+            used.add(i)
+
+            rs = resource_scenarios.get(i)
+            if rs is None:
+                continue
+            metadata = json.loads(rs.value.metadata)
+            for code in [metadata.get('function'), metadata.get('data'), rs.value.value]:
+                dynamic = find_dynamic_references(code)
+                if dynamic:
+                    print(' [-] WARNING: {} may use resource attributes that can\'t be found ({}); using all resource '
+                          'attributes'.format(columns['attr_name'][i], dynamic))
+                    return None
+                for reference in find_references(code):
+                    j = self.find_attribute(reference)
+                    if j is not None and j not in used:
+                        pending.append(j)
+
+        return used
+
+    def read_policy_modules(self):
+        """
+        Read the network's policy modules from its S3 folder (see PywrModel), if any.
+        :return: The code of each module, by file name, or None if they can't be downloaded
+        """
+        network_key = self.network.layout.get('storage', {}).get('folder')
+        if not network_key:
+            return {}
+
+        root = mkdtemp()
+        try:
+            load_from_s3(NETWORKS_BUCKET, network_key, 'policies', root)
+            modules = {}
+            for dirpath, dirnames, filenames in os.walk(root):
+                for filename in filenames:
+                    if filename.endswith('.py'):
+                        with open(os.path.join(dirpath, filename)) as f:
+                            modules[filename] = f.read()
+            return modules
+        except Exception as err:
+            print(' [-] WARNING: {}'.format(err))
+            return None
+        finally:
+            rmtree(root, ignore_errors=True)
+
+    def find_attribute(self, name):
+        """
+        Find a resource attribute by the name used in policy code, which can be
+        "resource_type/resource_id/attr_id", "resource_type/resource name/attribute name" or, for network
+        attributes, just the attribute name.
+        """
+        parts = name.split('/')
+        if len(parts) < 3:
+            return self.attributes.attr_names.get(('network', self.network['id'], name.lower()))
+        resource_type, resource_name, attr_name = parts[0], '/'.join(parts[1:-1]), parts[-1]
+        try:
+            return self.attributes.id((resource_type, int(resource_name), int(attr_name)))
+        except ValueError:
+            return self.attributes.id('{}/{}/{}'.format(resource_type, resource_name, attr_name.lower()))
+
+    def evaluate_source_data(self, resource_scenarios):
+        """
+        Evaluate resource scenario values, in order.
+        Values that were evaluated in a previous run are reused if their datasets haven't changed (see
+        SourceDataCache), so only new or modified datasets are evaluated.
+        """
+
+        values = [rs.value for rs in resource_scenarios]
+        cache = source_data_cache
+        if cache is None:
+            return self._evaluate_source_data(values)
+
+        context = source_data_context(self.evaluator.dates64, date_format=self.date_format, fill_value=0,
+                                      flavor='numpy')
+
+        results = [None] * len(values)
+        missing = []
+        for i, (rs, value) in enumerate(zip(resource_scenarios, values)):
+            dataset_id = rs.get('dataset_id') or value.get('id')
+            content_hash = cache.content_hash(value)
+            found, result = cache.get(dataset_id, context, content_hash)
+            if found:
+                results[i] = result
+            else:
+                missing.append((i, dataset_id, content_hash))
+
+        evaluated = self._evaluate_source_data([values[i] for i, dataset_id, content_hash in missing])
+        for (i, dataset_id, content_hash), result in zip(missing, evaluated):
+            cache.put(dataset_id, context, content_hash, result)
+            results[i] = result
+        cache.evict()
+
+        print(' [*] Source data: {} datasets reused, {} evaluated'.format(len(values) - len(missing), len(missing)))
+
+        return results
+
+    def _evaluate_source_data(self, values):
+        """
+        Evaluate resource scenario values, in order.
+        The number of workers is set by WATERLP_SOURCE_DATA_WORKERS (default 1, i.e., no pool) and the type of pool by
+        WATERLP_SOURCE_DATA_POOL ("process", the default, or "thread").
+        """
+
+        workers = int(os.environ.get('WATERLP_SOURCE_DATA_WORKERS', 1))
+        pool_type = os.environ.get('WATERLP_SOURCE_DATA_POOL', 'process')
+        evaluate = partial(_evaluate_source_data, date_format=self.date_format)
+
+        if workers <= 1 or len(values) < 2:
+            _init_source_data_worker(self.evaluator)
+            return [evaluate(value) for value in tqdm(values, ncols=80, disable=not self.args.verbose)]
+
+        # the connection and time steps are not needed to evaluate data, and are expensive to copy to each process
+        evaluator = copy(self.evaluator)
+        evaluator.conn = None
+        evaluator.timesteps = []
+
+        chunksize = max(1, len(values) // (workers * 4))
+        if pool_type == 'process':
+            try:
+                with ProcessPoolExecutor(workers, initializer=_init_source_data_worker, initargs=(evaluator,)) as pool:
+                    return list(tqdm(pool.map(evaluate, values, chunksize=chunksize), total=len(values), ncols=80,
+                                     disable=not self.args.verbose))
+            except (AssertionError, OSError, BrokenProcessPool) as err:
+                # e.g., daemonic (Celery) processes can't have children
+                print(' [-] WARNING: process pool failed ({}); using threads instead'.format(err))
+
+        with ThreadPoolExecutor(workers, initializer=_init_source_data_worker, initargs=(evaluator,)) as pool:
+            return list(tqdm(pool.map(evaluate, values), total=len(values), ncols=80, disable=not self.args.verbose))
+
+    def variation_copy(self):
+        """
+        A copy for running one variation (or ensemble), which shares the source data with this system, but has its own
+        constants, parameters, etc., since these are modified by initialize.
+        """
+        system = copy(self)
+        system.scenario = copy(self.scenario)
+        system.params = dict(self.params)
+        system.constants = dict(self.constants)
+        system.initial_volumes = dict(self.initial_volumes)
+        system.descriptors = dict(self.descriptors)
+        system.parameters = {key: copy(param) for key, param in self.parameters.items()}
+        system.ensemble_constants = {}
+        return system
+
     def initialize(self, supersubscenario):
         """A wrapper for all initialization steps."""
 
@@ -456,7 +682,11 @@ class WaterSystem(object):
         self.prepare_params()
 
         # set up subscenario
-        self.setup_subscenario(supersubscenario)
+        members = supersubscenario.get('members')
+        if members:
+            self.setup_ensemble(members)
+        else:
+            self.setup_subscenario(supersubscenario)
 
         current_dates_as_string = self.dates_as_string[:self.foresight_periods]
         step = self.dates[0].day
@@ -479,18 +709,7 @@ class WaterSystem(object):
         def convert_values(source, dest, dest_key='res_attr_idx'):
             for res_attr_idx in list(source):
                 resource_type, resource_id, attr_id = res_attr_idx
-                type_name = self.resources[(resource_type, resource_id)]['type']['name']
-                param = self.params[(resource_type, type_name, attr_id)]
-                scale = param['scale']
-                unit = param['unit']
-                dimension = param['dimension']
-                value = source.pop(res_attr_idx)
-                if dimension == 'Volumetric flow rate':
-                    val = convert(value, unit, 'hm^3 day^-1', scale_in=scale)
-                elif dimension == 'Volume':
-                    val = convert(value, unit, 'hm^3', scale_in=scale)
-                else:
-                    val = value
+                val = self.convert_value(res_attr_idx, source.pop(res_attr_idx))
                 if dest_key == 'res_attr_idx':
                     dest[res_attr_idx] = val
                 elif dest_key == 'resource_id':
@@ -499,10 +718,48 @@ class WaterSystem(object):
         convert_values(self.constants, constants)
         convert_values(self.initial_volumes, initial_volumes, dest_key='resource_id')
 
+        # constants that differ between ensemble members
+        scenarios = None
+        if members:
+            scenarios = [{'name': ENSEMBLE_SCENARIO, 'size': self.ensemble_size}]
+            for res_attr_idx, values in self.ensemble_constants.items():
+                constants[res_attr_idx] = {
+                    'type': 'constantscenario',
+                    'scenario': ENSEMBLE_SCENARIO,
+                    'values': [self.convert_value(res_attr_idx, value) for value in values]
+                }
+
         # for res_attr_idx in list(self.variables):
         #     if self.variables[res_attr_idx].get('is_ready'):
         #         variables[res_attr_idx] = self.variables.pop(res_attr_idx)
 
+        # reuse a model already loaded in this process, if only the variations are different
+        pool_key = None
+        patches = None
+        patchable = None
+        if self.args.warm and not members:
+            patchable = set()
+            for variation_set in supersubscenario.get('variation_sets'):
+                patchable.update(variation_set['variations'])
+            patches = self.get_patches(patchable, constants)
+            if patches is not None:
+                pool_key = model_key(
+                    self.network, self.template,
+                    start=start,
+                    end=end,
+                    step=step,
+                    tattrs=self.conn.tattrs,
+                    constants={k: v for k, v in constants.items() if k not in patchable},
+                    parameters={k: v for k, v in self.parameters.items() if k not in patchable},
+                    initial_volumes=initial_volumes,
+                    patchable=patchable
+                )
+                self.model = model_pool.get(pool_key)
+                if self.model:
+                    print(' [*] Reusing loaded model')
+                    self.model.patch(patches)
+                    return
+
         self.model = PywrModel(
             network=self.network,
             template=self.template,
@@ -513,10 +770,48 @@ class WaterSystem(object):
             initial_volumes=initial_volumes,
             constants=constants,
             parameters=self.parameters,
+            scenarios=scenarios,
+            patchable=pool_key and patchable,
+            in_memory=self.args.in_memory,
+            precompute=self.args.precompute,
         )
 
+        if pool_key:
+            model_pool.put(pool_key, self.model)
+
         return
 
+    def get_patches(self, patchable, constants):
+        """
+        Get the values of varied resource attributes, by Pywr parameter name, so they can be updated in a loaded model.
+        Only constants and scalars can be updated; None is returned if anything else varies.
+        """
+        patches = {}
+        for res_attr_idx in patchable:
+            parameter = self.parameters.get(res_attr_idx)
+            if res_attr_idx in constants:
+                patches[patch_name(res_attr_idx)] = constants[res_attr_idx]
+            elif parameter and parameter['type'] == 'variable' and parameter['value'].get('pywr_type') == 'constant':
+                patches[parameter['value']['name']] = parameter['value']['value']
+            else:
+                return None
+        return patches
+
+    def convert_value(self, res_attr_idx, value):
+        resource_type, resource_id, attr_id = res_attr_idx
+        type_name = self.resources[(resource_type, resource_id)]['type']['name']
+        param = self.params[(resource_type, type_name, attr_id)]
+        scale = param['scale']
+        unit = param['unit']
+        dimension = param['dimension']
+        if dimension == 'Volumetric flow rate':
+            val = convert(value, unit, 'hm^3 day^-1', scale_in=scale)
+        elif dimension == 'Volume':
+            val = convert(value, unit, 'hm^3', scale_in=scale)
+        else:
+            val = value
+        return val
+
     def prepare_params(self):
         """
         Declare parameters, based on the template type.
@@ -554,16 +849,10 @@ class WaterSystem(object):
                         self.storage_scale = param.get('scale', 1)
                         self.storage_unit = param.unit
 
-    def setup_subscenario(self, supersubscenario):
-        """
-        Add variation to all resource attributes as needed.
-        There are two variations: option variations and scenario variations.
-        If there is any conflict, scenario variations will replace option variations.
-        """
-
+    def make_metadata(self, supersubscenario):
         variation_sets = supersubscenario.get('variation_sets')
 
-        self.metadata = {'number': supersubscenario.get('id'), 'variation_sets': {}}
+        metadata = {'number': supersubscenario.get('id'), 'variation_sets': {}}
         for i, variation_set in enumerate(variation_sets):
             vs = []
             for (resource_type, resource_id, attr_id), value in variation_set['variations'].items():
@@ -579,11 +868,24 @@ class WaterSystem(object):
                     'variation': value
                 })
             scenario_type = 'option' if i == 0 else 'scenario'
-            self.metadata['variation_sets'][scenario_type] = {
+            metadata['variation_sets'][scenario_type] = {
                 'parent_id': variation_set['parent_id'],
                 'variations': vs
             }
 
+        return metadata
+
+    def setup_subscenario(self, supersubscenario):
+        """
+        Add variation to all resource attributes as needed.
+        There are two variations: option variations and scenario variations.
+        If there is any conflict, scenario variations will replace option variations.
+        """
+
+        variation_sets = supersubscenario.get('variation_sets')
+
+        self.metadata = self.make_metadata(supersubscenario)
+
         for variation_set in variation_sets:
             for key, variation in variation_set['variations'].items():
                 (resource_type, resource_id, attr_id) = key
@@ -602,8 +904,12 @@ class WaterSystem(object):
                 elif parameter and parameter['type'] == 'variable':
 
                     if not parameter.get('function'):  # functions will be handled by the evaluator
-                        self.parameter[res_attr_idx]['value']['values'] \
-                            = perturb(self.variables[res_attr_idx]['value']['values'], variation)
+                        # the value is shared with the system this was copied from (see variation_copy)
+                        value = deepcopy(parameter['value'])
+                        perturbed = perturb(value['value'], variation)
+                        if perturbed is not None:  # timeseries are perturbed in place
+                            value['value'] = perturbed
+                        self.parameters[res_attr_idx] = dict(parameter, value=value)
 
                 else:  # we need to add the variable to account for the variation
                     data_type = tattr['data_type']
@@ -620,6 +926,61 @@ class WaterSystem(object):
                             }
                         )
 
+    def setup_ensemble(self, members):
+        """
+        Set up all variations (members) as a single Pywr model, with one Pywr scenario per member.
+        Only resource attributes that are varied become scenario parameters. As in setup_subscenario,
+        scenario variations replace option variations.
+        """
+
+        self.members = [self.make_metadata(member) for member in members]
+        self.ensemble_size = len(members)
+        self.ensemble_constants = {}
+
+        # collect the variation of each resource attribute for each member
+        variations = {}
+        for i, member in enumerate(members):
+            for variation_set in member['variation_sets']:
+                for key, variation in variation_set['variations'].items():
+                    variations.setdefault(key, [None] * self.ensemble_size)[i] = variation
+
+        for res_attr_idx, member_variations in variations.items():
+            tattr = self.conn.tattrs[res_attr_idx]
+            parameter = self.parameters.get(res_attr_idx)
+
+            if res_attr_idx in self.constants or (parameter is None and tattr['data_type'] == 'scalar'):
+                value = self.constants.pop(res_attr_idx, 0)
+                self.ensemble_constants[res_attr_idx] = [
+                    perturb(value, variation) if variation else value for variation in member_variations
+                ]
+
+            elif parameter and parameter['type'] == 'variable' and parameter['value'].get('pywr_type') == 'constant':
+                value = parameter['value']['value']
+                parameter['value'] = {
+                    'name': parameter['value']['name'],
+                    'pywr_type': 'constantscenario',
+                    'scenario': ENSEMBLE_SCENARIO,
+                    'values': [perturb(value, variation) if variation else value for variation in member_variations]
+                }
+
+            elif parameter and parameter['type'] == 'variable' and parameter['value'].get('data_type') == 'timeseries':
+                # NB: perturb modifies timeseries in place
+                member_values = []
+                for variation in member_variations:
+                    values = deepcopy(parameter['value']['value'])
+                    if variation:
+                        perturb(values, variation)
+                    member_values.append(timeseries_values(values))
+                parameter['value'] = {
+                    'name': parameter['value']['name'],
+                    'pywr_type': 'arrayindexedscenario',
+                    'scenario': ENSEMBLE_SCENARIO,
+                    'values': [list(v) for v in zip(*member_values)]  # timesteps x members
+                }
+
+            else:
+                raise Exception('{} cannot be varied when running variations together'.format(tattr['attr_name']))
+
     def step(self):
         self.model.step()
 
@@ -684,8 +1045,13 @@ class WaterSystem(object):
             # =============
 
             _df = self.model.model.to_dataframe()
-            dt = self.model.model.timestepper.current.datetime
-            df = _df[_df.index <= dt]
+            if self.members:
+                # a result scenario can only hold one variation
+                if len(self.members) > 1:
+                    raise Exception('Variations run together (--ens) cannot be saved to the source scenario')
+                _df = _df.xs(0, axis=1, level=ENSEMBLE_SCENARIO)
+            current_date = self.model.model.timestepper.current.datetime
+            df = _df[_df.index <= current_date]
             cols = df.columns
             ncols = len(cols)
 
@@ -712,10 +1078,14 @@ class WaterSystem(object):
 
                 n += 1
                 res_attr_idx = col[0]
-                resource_type, resource_name, attr_name_lower = res_attr_idx.split('/')
+                i = self.attributes.id(res_attr_idx)
+                if i is None:
+                    continue
 
-                tattr = self.conn.tattr_lookup.get(res_attr_idx)
-                res_attr_id = self.conn.res_attr_lookup.get(res_attr_idx)
+                resource_type = self.attributes.key(i)[0]
+                resource_name = self.attributes.columns['resource_name'][i]
+                tattr = self.attributes.columns['tattr'][i]
+                res_attr_id = int(self.attributes.columns['res_attr_id'][i])
 
                 if not (res_attr_id and tattr and tattr['properties'].get('save')):
                     continue
@@ -788,6 +1158,18 @@ class WaterSystem(object):
 
     def save_results_to_csv(self, dest):
 
+        if not self.members:
+            self._save_results_to_csv(dest, self.model.model.to_dataframe())
+            return
+
+        # save each member of an ensemble as if it had been run by itself
+        df = self.model.model.to_dataframe()
+        for i, metadata in enumerate(self.members):
+            self.metadata = metadata
+            self._save_results_to_csv(dest, df.xs(i, axis=1, level=ENSEMBLE_SCENARIO, drop_level=False))
+
+    def _save_results_to_csv(self, dest, df):
+
         s3 = None
         if dest == 's3':
             s3 = boto3.client('s3')
@@ -844,7 +1226,6 @@ class WaterSystem(object):
             # write results
             # =============
 
-            df = self.model.model.to_dataframe()
             n = 0
             ncols = len(df.columns)
             path = base_path + '/{resource_type}/{resource_subtype}/{resource_id}'
@@ -855,16 +1236,14 @@ class WaterSystem(object):
                 n += 1
 
                 res_attr_idx = col[0]
-                resource_type, resource_id, attr_id = res_attr_idx.split('/')
-                resource_id = int(resource_id)
-                attr_id = int(attr_id)
-
-                idx = (resource_type, resource_id, attr_id)
+                i = self.attributes.id(res_attr_idx)
+                if i is None:
+                    continue
 
-                tattr = self.conn.tattrs.get(idx)
-                res_attr_id = self.conn.res_attr_lookup.get(idx)
+                resource_type, resource_id, attr_id = self.attributes.key(i)
+                tattr = self.attributes.columns['tattr'][i]
 
-                if not (res_attr_id and tattr and tattr['properties'].get('save')):
+                if not (tattr and tattr['properties'].get('save')):
                     continue
 
                 # prepare data
@@ -884,7 +1263,7 @@ class WaterSystem(object):
                 if content:
                     ttype = self.conn.types.get((resource_type, resource_id))
                     if human_readable:
-                        resource_name = self.conn.raid_to_res_name[res_attr_id]
+                        resource_name = self.attributes.columns['resource_name'][i]
                         key = path.format(
                             resource_type=resource_type,
                             resource_subtype=ttype['name'],
@@ -1,4 +1,10 @@
+import os
 import re
+import sys
+import marshal
+import linecache
+from hashlib import sha1
+from types import ModuleType
 
 
 def clean_parameter_name(s):
@@ -23,6 +29,10 @@ from utilities.converter import convert
 class {policy_name}(WaterLPParameter):
     \"\"\"{policy_description}\"\"\"
 
+    precompute = {precompute}
+    references = {references}
+    node_references = {node_references}
+
     def _value(self, timestep, scenario_index):
         {kwargs}
         {policy_code}
@@ -35,10 +45,97 @@ class {policy_name}(WaterLPParameter):
         return cls(model, **data)
         
 {policy_name}.register()
-print(" [*] {policy_name} successfully registered")
 """
 
 
+# attributes of self that policies can use and still be evaluated ahead of time
+precompute_attrs = ['read_csv']
+
+
+def is_state_independent(user_code):
+    """
+    Check if a policy depends only on the time step (e.g., a lookup from a csv file), so that it can be evaluated
+    over all time steps before the model is run. Policies can opt out with a "# no precompute" comment.
+    """
+    if re.search(r'#\s*no\s*precompute', user_code, re.IGNORECASE):
+        return False
+    if re.search(r'\b(scenario_index|kwargs|model)\b', user_code):
+        return False
+    for attr in re.findall(r'\bself\.(\w+)', user_code):
+        if attr not in precompute_attrs:
+            return False
+    return True
+
+
+def find_references(code):
+    """
+    Find quoted strings in policy code (or other data) that may be the names of other resource attributes.
+    Unlike the patterns in parse_code, names can include spaces (e.g., "node/Lake McClure/Storage").
+    """
+    if not code or type(code) != str:
+        return set()
+    return set(re.findall(r'"([^"\n]+)"', code) + re.findall(r"'([^'\n]+)'", code))
+
+
+# modules that policy code can import without hiding references to resource attributes (see find_dynamic_references)
+SAFE_MODULES = ['math', 'numpy', 'pandas', 'datetime', 'calendar', 'random', 'statistics', 'scipy', 'pywr', 'waterlp']
+
+DYNAMIC_REFERENCE_PATTERNS = [
+    # get/GET or parameters[...] with a name that is built at runtime (e.g., an f-string or concatenation)
+    r'self\.(?:GET|get)\(\s*(?!["\'][^"\'\n]*["\']\s*[,)])',
+    r'parameters\[\s*(?!["\'][^"\'\n]*["\']\s*\])',
+    r'\b(?:exec|eval|__import__)\s*\(',
+]
+
+
+def find_dynamic_references(code):
+    """
+    Find anything in policy code that may use resource attributes without naming them in a quoted string, i.e., names
+    built at runtime or imported modules (other than SAFE_MODULES). Returns a description, or None.
+    """
+    if not code or type(code) != str:
+        return None
+    for pattern in DYNAMIC_REFERENCE_PATTERNS:
+        m = re.search(pattern, code)
+        if m:
+            return code[m.start():code.find('\n', m.start()) % (len(code) + 1)].strip()
+    for m in re.finditer(r'^\s*(?:from\s+([\w.]+)\s+import|import\s+([\w., ]+))', code, re.MULTILINE):
+        modules = [name.strip().split()[0] for name in (m.group(1) or m.group(2)).split(',') if name.strip()]
+        # relative imports are of other policy modules, which are all read (see WaterSystem.find_used_attributes)
+        if [module for module in modules if module.split('.')[0] not in SAFE_MODULES and not module.startswith('.')]:
+            return m.group(0).strip()
+    return None
+
+
+LITERAL = r'(["\'][^"\'\n]+["\'])'
+
+
+def rewrite_references(code):
+    """
+    Rewrite lookups of other parameters and nodes by name (which Pywr does by searching all of them) so that they use
+    the references bound by WaterLPParameter.bind:
+        self.model.parameters["x"].value(...) -> self.get("x", ...), which reads the value if it's already calculated
+        self.model.parameters["x"] -> self.parameter("x")
+        self.model.nodes["x"] -> self.node("x")
+    Only names given as literals are rewritten. NB: as the value of a referenced parameter is read rather than
+    calculated again for the current time step, a parameter with side effects (e.g., a counter) has them once per time
+    step, no matter how many policies use it (see WaterLPParameter.get).
+    """
+    code = re.sub(r'self\.model\.parameters\[\s*' + LITERAL + r'\s*\]\.value\(\s*(\))?',
+                  lambda m: 'self.get({}{}'.format(m.group(1), ')' if m.group(2) else ', '), code)
+    code = re.sub(r'self\.model\.parameters\[\s*' + LITERAL + r'\s*\]', r'self.parameter(\1)', code)
+    code = re.sub(r'self\.model\.nodes\[\s*' + LITERAL + r'\s*\]', r'self.node(\1)', code)
+    return code
+
+
+def find_policy_references(code):
+    """Find the names of other parameters and nodes used by policy code (before or after rewrite_references)"""
+    parameters = re.findall(r'self\.(?:GET|get|parameter)\(\s*' + LITERAL, code)
+    parameters += re.findall(r'self\.model\.parameters\[\s*' + LITERAL, code)
+    nodes = re.findall(r'self\.node\(\s*' + LITERAL, code) + re.findall(r'self\.model\.nodes\[\s*' + LITERAL, code)
+    return sorted(set([name[1:-1] for name in parameters])), sorted(set([name[1:-1] for name in nodes]))
+
+
 def parse_code(policy_name, user_code, res_attr_lookup, tattr, description=''):
     """
     Parse a code snippet into a Pywr policy
@@ -80,6 +177,10 @@ def parse_code(policy_name, user_code, res_attr_lookup, tattr, description=''):
 
     new_code = spaces.join(lines)
 
+    # other parameters and nodes used by the policy (see WaterLPParameter.bind)
+    new_code = rewrite_references(new_code)
+    references, node_references = find_policy_references(new_code)
+
     # value code
     dim = tattr.get('dimension')
     unit1 = tattr.get('unit')
@@ -106,13 +207,24 @@ def parse_code(policy_name, user_code, res_attr_lookup, tattr, description=''):
         policy_name=policy_name,
         policy_description=description,
         policy_code=new_code,
-        value_code = value_code,
+        value_code=value_code,
+        precompute=is_state_independent(user_code),
+        references=references,
+        node_references=node_references,
         kwargs='kwargs = dict(timestep=timestep, scenario_index=scenario_index)' if '**kwargs' in user_code else ''
     )
 
     return policy_str
 
 
+def timeseries_values(value):
+    """Get the values of the first column of an evaluated timeseries, as a list"""
+    values = value[0]
+    if type(values) == dict:
+        return list(values.values())
+    return values.tolist()
+
+
 def create_variable(variable):
     pywr_type = variable.get('pywr_type', 'ArrayIndexed')
 
@@ -122,8 +234,12 @@ def create_variable(variable):
 
     if pywr_type == 'constant':
         parameter['value'] = variable['value']
+    elif pywr_type in ['constantscenario', 'arrayindexedscenario']:
+        # one value (or column of values) per scenario (e.g., variations run together)
+        parameter['scenario'] = variable['scenario']
+        parameter['values'] = variable['values']
     else:
-        parameter['values'] = list(variable['value'][0].values())
+        parameter['values'] = timeseries_values(variable['value'])
 
     return parameter
 
@@ -183,13 +299,10 @@ def create_control_curve(name=None, data=None, node_lookup=None):
     return control_curve
 
 
-def create_policy(policy, policies_folder, res_attr_lookup, tattr):
+def create_policy(policy, policies, res_attr_lookup, tattr):
     policy_name = clean_parameter_name(policy['name'])
-    policy_code = parse_code(policy_name, policy['code'], res_attr_lookup, tattr, policy.get('description', ''))
-    policy_path = '{}/{}.py'.format(policies_folder, policy_name)
-
-    with open(policy_path, 'w') as f:
-        f.writelines(policy_code)
+    policies[policy_name] = parse_code(policy_name, policy['code'], res_attr_lookup, tattr,
+                                       policy.get('description', ''))
 
     ret = {'type': policy_name}
 
@@ -198,3 +311,51 @@ def create_policy(policy, policies_folder, res_attr_lookup, tattr):
 
 def resource_name(rname, rtype):
     return '{} [{}]'.format(rname, rtype)
+
+
+def join_policies(policies):
+    """Combine generated policies into the source code of a single module"""
+    return '\n\n'.join([policies[policy_name] for policy_name in sorted(policies)])
+
+
+_bytecode = {}  # compiled policy modules in this process, by source hash
+
+
+def compile_policies(source, cache_dir=None, name='_parameters'):
+    """
+    Compile the combined policy source code into a single module, which registers all the policies.
+    Compiled code is cached by source hash, in memory and, if cache_dir is given, on disk.
+    """
+
+    key = sha1(source.encode()).hexdigest()
+    filename = '<{}-{}>'.format(name, key[:8])
+
+    code = _bytecode.get(key)
+    path = None
+    if code is None and cache_dir:
+        path = os.path.join(cache_dir, '{}.{}.pyc'.format(key, sys.implementation.cache_tag))
+        if os.path.exists(path):
+            try:
+                with open(path, 'rb') as f:
+                    code = marshal.load(f)
+                os.utime(path)
+            except (OSError, EOFError, ValueError, TypeError):
+                code = None
+
+    if code is None:
+        code = compile(source, filename, 'exec')
+        if path:
+            tmp_path = '{}.{}'.format(path, os.getpid())
+            with open(tmp_path, 'wb') as f:
+                marshal.dump(code, f)
+            os.replace(tmp_path, path)
+
+    _bytecode[key] = code
+
+    # this lets tracebacks show the policy code
+    linecache.cache[filename] = (len(source), None, source.splitlines(True), filename)
+
+    module = ModuleType(name)
+    exec(code, module.__dict__)
+
+    return module
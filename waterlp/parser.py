@@ -17,7 +17,9 @@ def commandline_parser():
 
     parser.add_argument('--app', dest='app_name', help='''Name of the app.''')
     parser.add_argument('--durl', dest='data_url', help='''The Hydra Server URL.''')
-    parser.add_argument('--f', dest='filename', help='''The name of the input JSON file if running locally.''')
+    parser.add_argument('--f', dest='filename',
+                        help='''The name of the input JSON file (or snapshot folder, see utils.snapshot) if running
+                        locally.''')
     parser.add_argument('--user', dest='hydra_username',
                         default=environ.get('HYDRA_USERNAME'),
                         help='''The username for logging in to Hydra Server.''')
@@ -78,6 +80,17 @@ def commandline_parser():
                         help='''Suppress input from results. This can speed up writing results.''')
     parser.add_argument('--st', dest='start_time', default=datetime.now().isoformat(), help='''Run start time.''')
     parser.add_argument('--hr', dest='human_readable', action='store_true', help='''Output should be human readable.''')
+    parser.add_argument('--inmem', dest='in_memory', action='store_true',
+                        help='''Build the Pywr model in memory, without writing it to a temporary folder.''')
+    parser.add_argument('--ens', dest='ensemble', action='store_true',
+                        help='''Run all variations together as a single multi-scenario Pywr model.''')
+    parser.add_argument('--pre', dest='precompute', action='store_true',
+                        help='''Evaluate policies that depend only on the time step before running the model.''')
+    parser.add_argument('--warm', dest='warm', action='store_true',
+                        help='''Keep loaded models in each worker, and reuse them for variations of the same network.''')
+    parser.add_argument('--batch', dest='batch_size', type=int, default=1,
+                        help='''Number of variations to run back to back in each Celery task, reusing the loaded model
+                        (as with --warm).''')
     parser.add_argument('--ds', dest='debug_start', default=None, help='''Debug start time.''')
     # parser.add_argument('--de', dest='debug_end', default=None, help='''Debug end time.''')
 
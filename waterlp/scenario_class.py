@@ -1,4 +1,4 @@
-from waterlp.utils.scenarios import create_subscenarios
+from waterlp.utils.scenarios import create_subscenarios, count_variations
 from datetime import datetime as dt
 
 statuses = {
@@ -13,8 +13,29 @@ statuses = {
 }
 
 
+def prepare_result_scenarios(conn, scenarios):
+    """
+    Create (if needed) and update the result scenarios of several scenarios, e.g., all option/scenario pairs of a run,
+    together rather than one round trip at a time.
+    """
+
+    to_add = [scenario for scenario in scenarios if scenario.result_scenario is None]
+    added = conn.call_many('add_scenario', [scenario.new_result_scenario() for scenario in to_add])
+    for scenario, result_scenario in zip(to_add, added):
+        scenario.result_scenario = result_scenario
+
+    for scenario in scenarios:
+        scenario.update_result_scenario()
+
+    conn.call_many('update_scenario', [{'scen': scenario.result_scenario} for scenario in scenarios])
+
+
 class Scenario(object):
-    def __init__(self, scenario_ids, conn, network, template, args, scenario_lookup):
+    def __init__(self, scenario_ids, conn, network, template, args, scenario_lookup, prepare_results=True):
+        """
+        Set up a scenario (an option/scenario pair) to run.
+        If prepare_results is False, the result scenario must be prepared later (see prepare_result_scenarios).
+        """
         self.base_scenarios = []
         self.source_id = args.source_id
         self.run_name = args.run_name
@@ -58,7 +79,7 @@ class Scenario(object):
 
             this_chain = [source.id]
 
-            # TODO: pull this chaining info from list of scenarios rather than hitting Hydra Platform multiple times
+            # parents are usually downloaded already (see connection.prefetch_scenarios)
             while source['layout'].get('parent'):
                 parent_id = source['layout']['parent']
                 if parent_id not in self.source_ids:  # prevent adding in Baseline twice, which would overwrite options
@@ -66,7 +87,7 @@ class Scenario(object):
                 if parent_id in loaded_scenarios:
                     source = loaded_scenarios[parent_id]
                 else:
-                    source = conn.call('get_scenario', {'scenario_id': parent_id})
+                    source = conn.get_scenario(parent_id)
 
                 self.source_scenarios[source.id] = source
 
@@ -112,37 +133,20 @@ class Scenario(object):
             'scenarios': create_subscenarios(network, template, self.scenario, 'scenario'),
         }
 
-        self.variation_count = 0
-        for sss in self.subscenarios.values():
-            for ss in sss:
-                if ss['variations']:
-                    self.variation_count += 1
+        self.variation_count = sum([count_variations(sss) for sss in self.subscenarios.values()])
 
         # ######################
         # Create result scenario
         # ######################
 
+        self.results_scenario_name = results_scenario_name
+        self.tags = tags
+        self.human_readable = args.human_readable
+
         result_scenario = scenario_lookup.get(results_scenario_name)
         if not result_scenario or result_scenario.id in self.source_ids:
-            result_scenario = conn.call(
-                'add_scenario',
-                {
-                    'network_id': network.id,
-                    'scen': {
-                        'id': None,
-                        'name': results_scenario_name,
-                        # 'cr_date': mod_date,
-                        'description': '',
-                        'network_id': network.id,
-                        'layout': {
-                            'class': 'results',
-                            'sources': self.base_ids,
-                            'value_tags': tags,
-                            'run': args.run_name,
-                        }
-                    }
-                }
-            )
+            result_scenario = None  # this will be added
+        self.result_scenario = result_scenario
 
         # where should results be saved?
         if self.variation_count == 0:
@@ -152,13 +156,43 @@ class Scenario(object):
 
         self.version_date = args.starttime.strftime('%Y-%m-%d %H:%M:%S')
 
+        self.storage = network.layout.get('storage')
+        self.base_path = None
+
+        if prepare_results:
+            prepare_result_scenarios(conn, [self])
+
+    def new_result_scenario(self):
+        """Arguments for adding the result scenario"""
+        return {
+            'network_id': self.network_id,
+            'scen': {
+                'id': None,
+                'name': self.results_scenario_name,
+                # 'cr_date': mod_date,
+                'description': '',
+                'network_id': self.network_id,
+                'layout': {
+                    'class': 'results',
+                    'sources': self.base_ids,
+                    'value_tags': self.tags,
+                    'run': self.run_name,
+                }
+            }
+        }
+
+    def update_result_scenario(self):
+        """Add this version to the result scenario, which is then saved (see prepare_result_scenarios)"""
+
+        result_scenario = self.result_scenario
+
         # update the result scenario
         versions = result_scenario['layout'].get('versions', [])
         version = {
             'number': len(versions) + 1 if self.destination != 'source' else 1,
             'date': self.version_date,
             'variations': self.variation_count,
-            'human_readable': args.human_readable
+            'human_readable': self.human_readable
         }
         if self.destination == 'source':
             versions = [version]
@@ -168,32 +202,26 @@ class Scenario(object):
             'data_location': self.destination,
             'versions': versions,
             'modified_date': self.version_date,
-            'value_tags': tags,
+            'value_tags': self.tags,
         })
 
-        result = conn.call('update_scenario', {'scen': result_scenario})
-
         # write variation info to s3
 
-        self.storage = network.layout.get('storage')
-
         if self.destination == 's3':
             self.base_path = '{folder}/.results/{run}/{date}/{scenario}'.format(
                 folder=self.storage.folder,
                 run=self.run_name,
-                scenario=result_scenario.name if args.human_readable else result_scenario.id,
+                scenario=result_scenario.name if self.human_readable else result_scenario.id,
                 date=self.version_date,
             )
         elif self.destination == 'local':
             self.base_path = '{folder}/.results/{run}/{date}/{scenario}'.format(
                 folder=self.storage.folder,
                 run=self.run_name,
-                scenario=result_scenario.name if args.human_readable else result_scenario.id,
+                scenario=result_scenario.name if self.human_readable else result_scenario.id,
                 date=self.version_date,
             )
 
-        self.result_scenario = result_scenario
-
     def update_payload(self, action=None, **payload):
         payload.update({
             'sid': self.unique_id,
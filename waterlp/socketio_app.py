@@ -1,7 +1,8 @@
 import os
 import socketio
 from waterlp.reporters.redis import local_redis
-from waterlp.utils.application import ProcessState
+from waterlp.utils.states import ProcessState
+from waterlp.utils.cancellation import set_state
 
 model_key = os.environ.get('MODEL_KEY')
 queue_name = 'model-{}'.format(model_key)
@@ -25,7 +26,7 @@ def stop_model(message):
     if local_redis and sid:
         print(" [*] Stopping {}".format(sid))
         if local_redis.get(sid):
-            local_redis.set(sid, ProcessState.CANCELED)
+            set_state(sid, ProcessState.CANCELED)
 
 
 @sio.on('disconnect')
@@ -1,14 +1,17 @@
 import os
+import csv
+import multiprocessing
 # import getpass
 from datetime import datetime
-from itertools import product
+from itertools import islice
+from time import sleep
+from tempfile import TemporaryFile
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 from copy import copy, deepcopy
 from ast import literal_eval
 from tqdm import tqdm
 
-import pandas as pd
-
-from waterlp.celery_app import app
+from waterlp.celery_app import app, queue_name
 from celery.exceptions import Ignore
 
 from waterlp.reporters.redis import local_redis
@@ -18,16 +21,21 @@ from waterlp.reporters.pubnub import PubNubReporter
 from waterlp.reporters.socketio import SocketIOReporter
 from waterlp.logger import RunLogger
 from waterlp.parser import commandline_parser
-from waterlp.connection import connection
+from waterlp.connection import connection, reset_http_session
 from waterlp.logger import create_logger
 from waterlp.models.system import WaterSystem
-from waterlp.scenario_class import Scenario
-from waterlp.utils.application import ProcessState
+from waterlp.models.cache import get_artifact_store
+from waterlp.scenario_class import Scenario, prepare_result_scenarios
+from waterlp.utils.states import ProcessState
+from waterlp.utils.cancellation import is_canceled, set_state, forget
+from waterlp.utils.scenarios import variation_keys
 
 from pathlib import Path
 
 home = str(Path.home())
 
+BATCHES_TTL = 24 * 3600  # seconds to keep the state of batched runs in Redis
+
 
 class Object(object):
     def __init__(self, values):
@@ -76,7 +84,7 @@ def run(**kwargs):
     sid = kwargs.get('sid')
     if local_redis and sid:
         print(' [*] Stopping {}'.format(sid))
-        local_redis.set(sid, ProcessState.CANCELED)
+        set_state(sid, ProcessState.CANCELED)
 
 
 def run_model(args, logs_dir, **kwargs):
@@ -165,11 +173,21 @@ def run_scenarios(args, networklog):
         args=args,
     )
 
-    all_supersubscenarios = []
+    local_runs = 0  # variations run locally, for --debug_s
+
+    # when running with Celery, each prepared system is published once, and tasks only carry its key
+    run_locally = args.debug or not os.environ.get('RABBITMQ_HOST')
+    artifact_store = None if run_locally else get_artifact_store()
+    if not run_locally and not artifact_store:
+        print(' [-] WARNING: No artifact store available; prepared systems will be sent with each task')
 
     # prepare the reporter
     post_reporter = PostReporter(args) if args.post_url else None
 
+    # download the parents of all scenarios at once; these are shared by all option/scenario pairs
+    conn.prefetch_scenarios(all_scenario_ids, network.scenarios)
+
+    scenarios = []
     for scenario_ids in args.scenario_ids:
 
         try:
@@ -180,7 +198,7 @@ def run_scenarios(args, networklog):
         sid = '-'.join([args.unique_id] + [str(s) for s in set(scenario_ids)])
 
         try:
-            if local_redis and local_redis.get(sid) == ProcessState.CANCELED:
+            if is_canceled(sid):
                 print('Canceled by user')
                 raise Ignore
         except Exception as err:
@@ -189,7 +207,13 @@ def run_scenarios(args, networklog):
 
         # create the scenario class
         scenario = Scenario(scenario_ids=scenario_ids, conn=conn, network=conn.network, template=conn.template,
-                            args=args, scenario_lookup=base_system.scenarios)
+                            args=args, scenario_lookup=base_system.scenarios, prepare_results=False)
+        scenarios.append((sid, scenario))
+
+    # create/update the result scenarios of all pairs together
+    prepare_result_scenarios(conn, [scenario for sid, scenario in scenarios])
+
+    for sid, scenario in scenarios:
 
         start_payload = scenario.update_payload(action='start')
         networklog.info(msg="Model started")
@@ -204,8 +228,7 @@ def run_scenarios(args, networklog):
             system.initialize_time_steps()
             system.collect_source_data()
 
-            # organize the subscenarios
-            flattened = product(scenario.subscenarios['options'], scenario.subscenarios['scenarios'])
+            # organize the subscenarios (these are enumerated lazily, as they are dispatched)
             subscenario_count = len(scenario.subscenarios['options']) * len(scenario.subscenarios['scenarios'])
 
             if args.debug:
@@ -217,37 +240,15 @@ def run_scenarios(args, networklog):
 
                 subscenario_count = min(subscenario_count, args.debug_s) if args.debug_s else subscenario_count
 
+            if args.ensemble and scenario.destination == 'source' and subscenario_count > 1:
+                raise Exception('Variations run together (--ens) cannot be saved to the source scenario')
+
             system.scenario.subscenario_count = subscenario_count
             system.scenario.total_steps = subscenario_count * len(system.timesteps)
 
-            supersubscenarios = []
-            scenario_key = {}
-            for i, variation_sets in enumerate(flattened):
-                supersubscenarios.append({
-                    'id': i + 1,
-                    'sid': sid,
-                    'system': copy(system),  # this is intended to be a shallow copy (TODO: verify this!)
-                    'variation_sets': variation_sets,
-                })
-
-                scenario_key[i + 1] = {}
-                for variation_set in variation_sets:
-                    variations = variation_set.get('variations')
-                    for key in variations:
-                        (t, r, a) = key
-                        scenario_key[i + 1]['{}/{}/{}'.format(t, r, a)] = variations[key]['value']
-
-            if scenario.destination != 'source':
-                # save scenario_key
-                key = '{base_path}/{filename}'.format(
-                    base_path=scenario.base_path,
-                    filename='scenario_key.csv'
-                )
-                # content = json.dumps(scenario_key, sort_keys=True, indent=4, separators=(',', ': ')).encode()
-                content = pd.DataFrame(scenario_key).transpose().to_csv().encode()
-                system.save_to_file(key, content)
-
-            all_supersubscenarios.extend(supersubscenarios[:subscenario_count])
+            system_key = artifact_store.put(system) if artifact_store else None
+            if system_key:
+                print(' [*] Published prepared system {}'.format(system_key))
 
         except Exception as err:
             err_class = err.__class__.__name__
@@ -264,31 +265,349 @@ def run_scenarios(args, networklog):
 
             raise
 
-    # ================
-    # run the scenario
-    # ================
+        supersubscenarios = islice(iter_supersubscenarios(scenario, sid), subscenario_count)
+
+        # local worker processes use the system they inherit, so the variations don't need a copy of it
+        workers = local_workers() if run_locally and not args.ensemble else 1
+        in_processes = workers > 1
+
+        if args.ensemble:
+            # run all variations together, as a single multi-scenario model
+            supersubscenarios = [{
+                'id': 1,
+                'sid': sid,
+                'system': None if system_key else system,
+                'system_key': system_key,
+                'members': [{'id': ss['id'], 'variation_sets': ss['variation_sets']} for ss in supersubscenarios]
+            }]
+        else:
+            supersubscenarios = (
+                # this is intended to be a shallow copy (TODO: verify this!)
+                dict(ss, system=None if system_key or in_processes else copy(system), system_key=system_key)
+                for ss in supersubscenarios
+            )
+
+        # ================
+        # run the scenario
+        # ================
+
+        if run_locally:
+            networklog.info("Running scenario in debug mode")
+            if args.debug_s:
+                supersubscenarios = islice(supersubscenarios, max(args.debug_s - local_runs, 0))
+            if in_processes:
+                local_runs += run_in_processes(system, supersubscenarios, args, verbose, workers)
+            else:
+                for ss in supersubscenarios:
+                    run_scenario(ss, args=args, verbose=verbose)
+                    local_runs += 1
+            forget(sid)
+        elif args.batch_size > 1 and not args.ensemble:
+            dispatch(batches(supersubscenarios, args.batch_size), args, verbose, sid=sid, task=run_batch)
+        else:
+            dispatch(supersubscenarios, args, verbose, sid=sid)
+
+        if scenario.destination != 'source':
+            # save scenario_key, with all variations (including any not run, e.g., with debug_s)
+            key = '{base_path}/{filename}'.format(
+                base_path=scenario.base_path,
+                filename='scenario_key.csv'
+            )
+            scenario_key = ScenarioKey(scenario)
+            scenario_key.write_all(iter_supersubscenarios(scenario, sid))
+            scenario_key.save(system, key)
 
-    if args.debug or not os.environ.get('RABBITMQ_HOST'):
-        networklog.info("Running scenario in debug mode")
-        for ss in all_supersubscenarios[:args.debug_s]:
-            run_scenario(ss, args=args, verbose=verbose)
-    else:
-        for ss in all_supersubscenarios:
-            result = run_scenario.apply_async((ss, args, verbose), serializer='pickle', compression='gzip')
     return
 
 
+def iter_supersubscenarios(scenario, sid):
+    """
+    Enumerate the variations of a scenario, i.e., all pairs of option and scenario subscenarios, without creating them
+    all at once.
+    """
+    i = 0
+    for option in scenario.subscenarios['options']:
+        for subscenario in scenario.subscenarios['scenarios']:
+            i += 1
+            yield {
+                'id': i,
+                'sid': sid,
+                'variation_sets': (option, subscenario),
+            }
+
+
+class ScenarioKey(object):
+    """The varied values of each variation (scenario_key.csv), written to a temporary file rather than held in memory"""
+
+    def __init__(self, scenario):
+        self.columns = sorted(
+            variation_keys(scenario.subscenarios['options']) | variation_keys(scenario.subscenarios['scenarios'])
+        )
+        self.file = TemporaryFile(mode='w+', newline='')
+        self.writer = csv.writer(self.file)
+        self.writer.writerow([''] + ['{}/{}/{}'.format(t, r, a) for (t, r, a) in self.columns])
+
+    def write_all(self, supersubscenarios):
+        for ss in supersubscenarios:
+            values = {}
+            for variation_set in ss['variation_sets']:
+                for key, variation in variation_set.get('variations').items():
+                    values[key] = variation['value']
+            self.writer.writerow([ss['id']] + [values.get(key, '') for key in self.columns])
+
+    def save(self, system, key):
+        # the file is uploaded as is, rather than read into memory
+        self.file.flush()
+        self.file.buffer.seek(0)
+        system.save_to_file(key, self.file.buffer)
+        self.file.close()
+
+
+def batches(supersubscenarios, size):
+    """Group variations of the same scenario pair, which share a prepared system, into batches (see run_batch)"""
+    while True:
+        chunk = list(islice(supersubscenarios, size))
+        if not chunk:
+            return
+        yield {
+            'id': chunk[0]['id'],
+            'sid': chunk[0]['sid'],
+            'system': chunk[0]['system'],
+            'system_key': chunk[0]['system_key'],
+            'variations': [{'id': ss['id'], 'variation_sets': ss['variation_sets']} for ss in chunk],
+        }
+
+
+def local_workers():
+    """The number of processes to run variations in locally (WATERLP_LOCAL_WORKERS; 0 for one per core)"""
+    workers = int(os.environ.get('WATERLP_LOCAL_WORKERS', 1))
+    if workers <= 0:
+        workers = os.cpu_count() or 1
+    if workers > 1 and 'fork' not in multiprocessing.get_all_start_methods():
+        print(' [-] WARNING: Local worker processes need fork; running variations one at a time')
+        return 1
+    return workers
+
+
+_local_run = {}  # the prepared system, etc., inherited by forked worker processes (see run_in_processes)
+
+
+def _init_local_worker():
+    reset_http_session()
+
+
+def _run_local_variation(supersubscenario):
+    system = _local_run['system'].variation_copy()
+    supersubscenario = dict(supersubscenario, system=system, system_key=None)
+    return run_scenario(supersubscenario, _local_run['args'], verbose=_local_run['verbose'])
+
+
+def run_in_processes(system, supersubscenarios, args, verbose, workers):
+    """
+    Run variations in local worker processes, without a broker. The workers are forked once the system is prepared, so
+    they share its data (copy-on-write) rather than each receiving a copy; only variation ids and sets are sent to
+    them. Variations are submitted a few at a time, as the workers finish them.
+    """
+
+    _local_run.update(system=system, args=args, verbose=verbose)
+
+    runs = 0
+    failed = []
+    canceled = False
+    supersubscenarios = iter(supersubscenarios)
+    progress = tqdm(total=system.scenario.subscenario_count, ncols=80, disable=not args.verbose)
+
+    print(' [*] Running variations in {} processes'.format(workers))
+    context = multiprocessing.get_context('fork')
+    with ProcessPoolExecutor(workers, mp_context=context, initializer=_init_local_worker) as pool:
+        pending = {}
+        while True:
+            while not canceled and len(pending) < workers * 2:
+                ss = next(supersubscenarios, None)
+                if ss is None:
+                    break
+                variation = {'id': ss['id'], 'sid': ss['sid'], 'variation_sets': ss['variation_sets']}
+                pending[pool.submit(_run_local_variation, variation)] = ss['id']
+            if not pending:
+                break
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                variation_id = pending.pop(future)
+                progress.update()
+                try:
+                    if not future.result():
+                        failed.append(variation_id)
+                except Ignore:
+                    canceled = True
+                    continue
+                except Exception as err:
+                    # e.g., a worker process was killed
+                    print(' [-] WARNING: Variation {} failed ({})'.format(variation_id, err))
+                    failed.append(variation_id)
+                runs += 1
+
+    progress.close()
+    _local_run.clear()
+
+    print(' [*] Finished {} variations{}'.format(runs, ' (canceled)' if canceled else ''))
+    if failed:
+        print(' [-] WARNING: {} variations failed: {}'.format(len(failed), ', '.join(map(str, sorted(failed)))))
+
+    return runs
+
+
+def dispatch(supersubscenarios, args, verbose, sid=None, task=None):
+    """
+    Send variations (or batches of them) to the Celery workers in chunks, waiting while the queue is full, so that large
+    sweeps start right away and are never held in memory all at once.
+    """
+    task = task or run_scenario
+    track = task is run_batch and local_redis and sid
+    chunk_size = int(os.environ.get('WATERLP_DISPATCH_CHUNK_SIZE', 100))
+    max_queued = int(os.environ.get('WATERLP_MAX_QUEUED_TASKS', 1000))
+
+    dispatched = 0
+    canceled = False
+    while not canceled:
+        chunk = list(islice(supersubscenarios, chunk_size))
+        if not chunk:
+            break
+
+        # backpressure: wait for the workers to take tasks from the queue
+        queued = queued_tasks()
+        while queued is not None and queued + len(chunk) > max_queued:
+            if is_canceled(sid):
+                print('Canceled by user')
+                canceled = True
+                break
+            sleep(1)
+            queued = queued_tasks()
+        if canceled:
+            break
+
+        for ss in chunk:
+            if track:
+                batch_dispatched(sid)
+            task.apply_async((ss, args, verbose), serializer='pickle', compression='gzip')
+        dispatched += len(chunk)
+
+    print(' [*] Dispatched {} tasks'.format(dispatched))
+    if track:
+        # also when canceled, so that run_finished still runs (and cleans up) once the dispatched batches finish
+        all_batches_dispatched(sid)
+    return dispatched
+
+
+def queued_tasks():
+    """The number of tasks waiting in the model queue, or None if this can't be found"""
+    try:
+        with app.connection_for_write() as broker:
+            return broker.default_channel.queue_declare(queue=queue_name, passive=True).message_count
+    except Exception:
+        return None
+
+
+def batches_key(sid):
+    return '{}-batches'.format(sid)
+
+
+def batch_dispatched(sid):
+    key = batches_key(sid)
+    local_redis.hincrby(key, 'pending', 1)
+    local_redis.expire(key, BATCHES_TTL)
+
+
+def all_batches_dispatched(sid):
+    local_redis.hset(batches_key(sid), 'dispatched', 1)
+    check_batches_finished(sid)
+
+
+def batch_finished(sid, runs, failed):
+    key = batches_key(sid)
+    local_redis.hincrby(key, 'runs', runs)
+    local_redis.hincrby(key, 'failed', failed)
+    local_redis.hincrby(key, 'pending', -1)
+    check_batches_finished(sid)
+
+
+def check_batches_finished(sid):
+    """
+    A chord-like completion callback, with counts in Redis rather than a result backend: once all batches are
+    dispatched and finished, whichever process sees this first sends run_finished.
+    """
+    key = batches_key(sid)
+    dispatched, pending = local_redis.hmget(key, 'dispatched', 'pending')
+    if dispatched and int(pending or 0) <= 0 and local_redis.hsetnx(key, 'finished', 1):
+        run_finished.apply_async((sid,))
+
+
+@app.task(name='model.finished')
+def run_finished(sid):
+    """
+    Run-level bookkeeping once all batches of a scenario pair have finished. The run state is set to FINISHED (or
+    ERROR if every variation failed), since no single batch knows when the whole run is done; otherwise it would be
+    left as the last state reported by a variation. A canceled run keeps its CANCELED state.
+    """
+    key = batches_key(sid)
+    runs, failed = [int(x or 0) for x in local_redis.hmget(key, 'runs', 'failed')]
+    print(' [*] Finished {} variations of {} ({} failed)'.format(runs, sid, failed))
+
+    if local_redis.get(sid) != ProcessState.CANCELED:
+        set_state(sid, ProcessState.ERROR if runs and failed == runs else ProcessState.FINISHED)
+    local_redis.delete(key)
+
+
+@app.task(name='model.run_batch')
+def run_batch(batch, args, verbose=False):
+    """
+    Run a batch of variations of the same scenario pair back to back, loading the prepared system once and reusing
+    the loaded model (as with --warm).
+    """
+    print("[*] Running batch of {} variations".format(len(batch['variations'])))
+
+    args = copy(args)
+    args.warm = True
+
+    sid = batch.get('sid')
+    system = batch.get('system')
+    runs = 0
+    failed = 0
+    try:
+        for variation in batch['variations']:
+            supersubscenario = dict(
+                variation,
+                sid=sid,
+                system=system and system.variation_copy(),
+                system_key=batch.get('system_key'),
+            )
+            if not run_scenario(supersubscenario, args, verbose=verbose):
+                failed += 1
+            runs += 1
+    finally:
+        forget(sid)
+        if local_redis and sid:
+            batch_finished(sid, runs, failed)
+
+
 @app.task()
 def run_scenario(supersubscenario, args, verbose=False):
     print("[*] Running scenario {}".format(supersubscenario['id']))
 
     # Check OA to see if the model request is still valid
     sid = supersubscenario.get('sid')
-    if local_redis and local_redis.get(sid) == ProcessState.CANCELED:
+    if is_canceled(sid):
         print("Canceled by user.")
         raise Ignore
 
     system = supersubscenario.get('system')
+    system_key = supersubscenario.get('system_key')
+    if system_key:
+        artifact_store = get_artifact_store()
+        if not artifact_store:
+            raise Exception('Prepared system {} cannot be loaded: no artifact store available'.format(system_key))
+        # the loaded system is kept for the following variations; initialize modifies a copy
+        system = artifact_store.get(system_key).variation_copy()
 
     # setup the reporter (ably is on a per-process basis)
     post_reporter = PostReporter(args) if args.post_url else None
@@ -326,6 +645,10 @@ def run_scenario(supersubscenario, args, verbose=False):
         if reporter:
             reporter.report(action='error', message=str(err))
 
+        return False
+
+    return True
+
 
 def _run_scenario(system=None, args=None, supersubscenario=None, reporter=None, verbose=False):
     sid = supersubscenario.get('sid')
@@ -339,7 +662,7 @@ def _run_scenario(system=None, args=None, supersubscenario=None, reporter=None,
 
     for timestep in tqdm_timesteps:
 
-        if local_redis and local_redis.get(sid) == ProcessState.CANCELED:
+        if is_canceled(sid):  # a local flag, updated by a Redis listener
             print("Canceled by user.")
             raise Ignore
 
@@ -380,7 +703,7 @@ def _run_scenario(system=None, args=None, supersubscenario=None, reporter=None,
             # 5. CALCULATE POST-PROCESSED RESULTS
 
             # 6. REPORT PROGRESS
-            system.scenario.finished += 1
+            system.scenario.finished += system.ensemble_size
             system.scenario.current_date = current_dates_as_string[0]
 
             if system.scenario.reporter:
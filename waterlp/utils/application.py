@@ -3,16 +3,8 @@ import json
 from pubnub.callbacks import SubscribeCallback
 from pubnub.enums import PNOperationType, PNStatusCategory
 
-from waterlp.reporters.redis import local_redis
-
-class ProcessState:
-    REQUESTED = b'requested'
-    STARTED = b'started'
-    RUNNING = b'running'
-    PAUSED = b'paused'
-    CANCELED = b'stopped'
-    ERROR = b'error'
-    FINISHED = b'finished'
+from waterlp.utils.states import ProcessState
+from waterlp.utils.cancellation import set_state
 
 
 def message_handler(message):
@@ -23,9 +15,7 @@ def message_handler(message):
     action = data.get('action')
     sid = data.get('sid')
     if sid and action == 'cancel':
-        if local_redis:
-            local_redis.set(sid, ProcessState.CANCELED)
-            local_redis.expire(sid, 3600 * 24)
+        set_state(sid, ProcessState.CANCELED)
 
 
 class PNSubscribeCallback(SubscribeCallback):
@@ -82,8 +72,7 @@ class PNSubscribeCallback(SubscribeCallback):
             state = message.get('state')
             sid = data.message.get('sid')
             if sid:
-                local_redis.set(sid, state)
-                local_redis.expire(sid, 3600 * 24)
+                set_state(sid, state)
                 print(sid, state)
 
         return
@@ -0,0 +1,115 @@
+"""
+Cancellation of runs, without polling Redis.
+
+Run states (see ProcessState) are stored in Redis by sid, as before, and are also published to a Redis channel. Each
+process that runs scenarios listens to the channel in a background thread and keeps the sids that were canceled, so
+checking for cancellation (e.g., at every time step) is just a set lookup. Sids are forgotten when a process is done
+with them, and only the most recently checked MAX_WATCHED are kept.
+"""
+
+import os
+import json
+import threading
+from collections import OrderedDict
+from time import sleep
+
+from waterlp.reporters.redis import local_redis
+from waterlp.utils.states import ProcessState
+
+CHANNEL = 'waterlp-states'
+STATE_TTL = 24 * 3600  # seconds
+MAX_WATCHED = int(os.environ.get('WATERLP_MAX_WATCHED_RUNS', 100))
+
+
+class CancellationListener(object):
+
+    def __init__(self, redis):
+        self.redis = redis
+        self.watched = OrderedDict()  # sids, by when they were last checked
+        self.canceled = set()
+        self.lock = threading.Lock()
+        self.pid = None
+        self.thread = None
+
+    def start(self):
+        # after a fork (e.g., Celery worker processes), the listener has to be started again in the child
+        if self.pid == os.getpid() and self.thread.is_alive():
+            return
+        if self.pid != os.getpid():
+            self.lock = threading.Lock()  # it may have been held by the parent's listener thread when forked
+        with self.lock:
+            if self.pid == os.getpid() and self.thread.is_alive():
+                return
+            self.pid = os.getpid()
+            self.thread = threading.Thread(target=self.listen, name='waterlp-cancellation', daemon=True)
+            self.thread.start()
+
+    def listen(self):
+        while True:
+            try:
+                pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(CHANNEL)
+                # states may have changed while (re)connecting
+                with self.lock:
+                    sids = list(self.watched)
+                for sid in sids:
+                    self.update(sid, self.redis.get(sid))
+                for message in pubsub.listen():
+                    data = json.loads(message['data'])
+                    self.update(data.get('sid'), data.get('state'))
+            except Exception as err:
+                print(' [-] WARNING: Cancellation listener failed ({}); reconnecting'.format(err))
+                sleep(1)
+
+    def update(self, sid, state):
+        if type(state) == str:
+            state = state.encode()
+        if sid not in self.watched:
+            return
+        if state == ProcessState.CANCELED:
+            self.canceled.add(sid)
+        else:
+            self.canceled.discard(sid)
+
+    def watch(self, sid):
+        self.start()
+        with self.lock:
+            self.watched[sid] = True
+            while len(self.watched) > MAX_WATCHED:
+                self.canceled.discard(self.watched.popitem(last=False)[0])
+        self.update(sid, self.redis.get(sid))
+
+    def forget(self, sid):
+        with self.lock:
+            self.watched.pop(sid, None)
+            self.canceled.discard(sid)
+
+    def is_canceled(self, sid):
+        if sid not in self.watched:
+            self.watch(sid)
+        elif next(reversed(self.watched)) != sid:
+            with self.lock:
+                self.watched.move_to_end(sid)
+        return sid in self.canceled
+
+
+listener = CancellationListener(local_redis) if local_redis else None
+
+
+def is_canceled(sid):
+    """Whether a run has been canceled. Only the first check of a sid calls Redis."""
+    return bool(listener and sid and listener.is_canceled(sid))
+
+
+def forget(sid):
+    """Stop watching a run, e.g., once this process has finished its variations."""
+    if listener and sid:
+        listener.forget(sid)
+
+
+def set_state(sid, state):
+    """Store the state of a run (see ProcessState), and notify the processes running it."""
+    if not local_redis or not sid:
+        return
+    local_redis.set(sid, state, ex=STATE_TTL)
+    local_redis.publish(CHANNEL, json.dumps({'sid': sid, 'state': state.decode() if type(state) == bytes else state}))
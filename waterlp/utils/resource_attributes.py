@@ -0,0 +1,99 @@
+from collections.abc import Mapping
+
+import numpy as np
+
+RESOURCE_TYPES = ['network', 'node', 'link']
+
+
+class ResourceAttributes(object):
+    """
+    A table of the network's resource attributes (those in the template), shared by the connection and the system.
+
+    Each resource attribute, i.e., (resource_type, resource_id, attr_id), has a dense integer id, which can be used to
+    index the columns, or any other array by resource attribute. Resource attributes can also be found by Hydra
+    resource attribute id or by name ("node/Lake McClure/storage"). The old lookup dictionaries are views of this
+    table (see view).
+    """
+
+    # columns that are stored as numpy arrays once the table is complete
+    numeric_columns = ['resource_type', 'resource_id', 'attr_id', 'res_attr_id']
+
+    def __init__(self):
+
+        # indices
+        self.keys = {}  # (resource_type, resource_id, attr_id): id
+        self.res_attr_ids = {}  # Hydra resource attribute id: id
+        self.names = {}  # "resource_type/resource name/attribute name (lower case)": id
+        self.attr_names = {}  # (resource_type, resource_id, attribute name (lower case)): id
+
+        # columns
+        self.columns = {name: [] for name in self.numeric_columns + ['resource_name', 'attr_name', 'tattr']}
+
+    def __len__(self):
+        return len(self.columns['tattr'])
+
+    def add(self, resource_type, resource, ra, tattr):
+        i = len(self)
+        key = (resource_type, resource.id, ra.attr_id)
+        attr_name = ra.attr_name.lower()
+
+        self.keys[key] = i
+        self.res_attr_ids[ra.id] = i
+
+        # names aren't unique in Hydra (e.g., two nodes of the same type can have the same name), in which case the
+        # resource attribute added last is found by name, whatever its dimension
+        name = '%s/%s/%s' % (resource_type, resource.name, attr_name)
+        if name in self.names:
+            print(' [-] WARNING: More than one resource attribute is named "{}"; using the last one'.format(name))
+        self.names[name] = i
+        self.attr_names[(resource_type, resource.id, attr_name)] = i
+
+        columns = self.columns
+        columns['resource_type'].append(RESOURCE_TYPES.index(resource_type))
+        columns['resource_id'].append(resource.id)
+        columns['attr_id'].append(ra.attr_id)
+        columns['res_attr_id'].append(ra.id)
+        columns['resource_name'].append(resource.name)
+        columns['attr_name'].append(ra.attr_name)
+        columns['tattr'].append(tattr)
+
+        return i
+
+    def freeze(self):
+        """Convert numeric columns to arrays, once all resource attributes are added"""
+        for name in self.numeric_columns:
+            self.columns[name] = np.array(self.columns[name], dtype=np.int8 if name == 'resource_type' else np.int64)
+
+    def id(self, key):
+        """Get the id of a resource attribute by (resource_type, resource_id, attr_id) or by name"""
+        if type(key) == str:
+            return self.names.get(key)
+        return self.keys.get(key)
+
+    def key(self, i):
+        """Get (resource_type, resource_id, attr_id) of a resource attribute"""
+        columns = self.columns
+        return RESOURCE_TYPES[columns['resource_type'][i]], int(columns['resource_id'][i]), int(columns['attr_id'][i])
+
+    def view(self, column, by='keys'):
+        """
+        A read-only dictionary of a column, by one of the indices (keys, res_attr_ids, names or attr_names).
+        """
+        return ColumnView(self, column, by)
+
+
+class ColumnView(Mapping):
+    def __init__(self, table, column, by='keys'):
+        self.table = table
+        self.column = column
+        self.index = getattr(table, by)
+
+    def __getitem__(self, key):
+        value = self.table.columns[self.column][self.index[key]]
+        return value.item() if isinstance(value, np.generic) else value
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __len__(self):
+        return len(self.index)
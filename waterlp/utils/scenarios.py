@@ -103,9 +103,51 @@ def create_independent_subscenarios(network, template, scenario, scenario_type):
     return subscenarios
 
 
-def create_crosswise_subscenarios(network, template, scenario, scenario_type):
-    subscenarios = []
+class CrosswiseSubscenarios(object):
+    """
+    The cross product of variations, as a sequence that can be iterated over (more than once) and counted, without
+    creating every subscenario.
+    """
+
+    def __init__(self, parent_id, all_variations):
+        self.parent_id = parent_id
+        self.all_variations = all_variations  # a list of subvariations for each variation
+
+    def __len__(self):
+        count = 1
+        for subvariations in self.all_variations:
+            count *= len(subvariations)
+        return count
+
+    def __iter__(self):
+        for ss in product(*self.all_variations):
+            variations = {}
+            for variation in ss:
+                variations.update(variation)
+            yield {
+                'parent_id': self.parent_id,
+                'variations': variations,
+            }
+
+    def variation_keys(self):
+        return {key for subvariations in self.all_variations for variation in subvariations for key in variation}
+
+
+def variation_keys(subscenarios):
+    """All resource attributes, i.e., (ref_key, resource id, attr id), that are varied in any subscenario"""
+    if isinstance(subscenarios, CrosswiseSubscenarios):
+        return subscenarios.variation_keys()
+    return {key for ss in subscenarios for key in ss['variations']}
+
+
+def count_variations(subscenarios):
+    """The number of subscenarios with variations"""
+    if isinstance(subscenarios, CrosswiseSubscenarios):
+        return len(subscenarios) if subscenarios.all_variations else 0
+    return len([ss for ss in subscenarios if ss['variations']])
 
+
+def create_crosswise_subscenarios(network, template, scenario, scenario_type):
     variations = scenario.layout.get('variations', [])
 
     values_lookup = {}
@@ -136,19 +178,8 @@ def create_crosswise_subscenarios(network, template, scenario, scenario_type):
 
         all_variations.append(subvariations)
 
-    # now, create cross product
-    all_subscenarios = list(product(*all_variations))
-
-    for ss in all_subscenarios:
-        variations = {}
-        for variation in ss:
-            variations.update(variation)
-        subscenarios.append({
-            'parent_id': scenario.id,
-            'variations': variations,
-        })
-
-    return subscenarios
+    # the cross product is enumerated lazily, since it can be very large
+    return CrosswiseSubscenarios(scenario.id, all_variations)
 
 
 def create_concurrent_subscenarios(network, template, scenario, scenario_type):
@@ -0,0 +1,204 @@
+"""
+Binary snapshots of Hydra JSON exports, for running networks locally (--f).
+
+A snapshot is a folder with the network structure (the network, template, etc.) in msgpack and all timeseries in an
+uncompressed npz file, as sorted dates and float64 values. Timeseries arrays are memory-mapped when a snapshot is
+loaded and are decoded by the evaluator without parsing any JSON.
+
+To create a snapshot from a Hydra JSON export:
+
+    python -m waterlp.utils.snapshot network.json network.snapshot
+"""
+
+import os
+import json
+import struct
+import zipfile
+import argparse
+from hashlib import sha1
+from shutil import rmtree
+
+import msgpack
+import numpy as np
+
+from waterlp.models.evaluator import timeseries_columns
+
+SNAPSHOT_VERSION = 1
+STRUCTURE_FILENAME = 'network.msgpack'
+TIMESERIES_FILENAME = 'timeseries.npz'
+TIMESERIES_KEY = '__timeseries__'
+TIMESERIES_TYPES = ['timeseries', 'periodic timeseries']
+
+
+class SnapshotTimeseries(object):
+    """
+    A timeseries value from a snapshot. Its columns are views of the snapshot's arrays, which are used directly by
+    evaluator.decode_timeseries.
+    """
+
+    __slots__ = ('arrays', 'slices', 'digest')
+
+    def __init__(self, arrays, slices, digest):
+        self.arrays = arrays  # dates and values of all timeseries in the snapshot
+        self.slices = slices  # [column, start, stop] for each column
+        self.digest = digest  # hash of the original JSON
+
+    def __str__(self):
+        # used as the content of the timeseries in cache keys (e.g., SourceDataCache.content_hash)
+        return self.digest
+
+    def __deepcopy__(self, memo):
+        return self  # the data is read-only
+
+    def __reduce__(self):
+        # copy only this timeseries (e.g., to send it to another process)
+        dates, values, slices, start = [], [], [], 0
+        for column, col_dates, col_values in self.columns():
+            dates.append(np.asarray(col_dates))
+            values.append(np.asarray(col_values))
+            slices.append([column, start, start + len(col_dates)])
+            start += len(col_dates)
+        arrays = {'dates': _concatenate(dates, 'datetime64[s]'), 'values': _concatenate(values, np.float64)}
+        return SnapshotTimeseries, (arrays, slices, self.digest)
+
+    def columns(self):
+        for column, start, stop in self.slices:
+            yield column, self.arrays['dates'][start:stop], self.arrays['values'][start:stop]
+
+    def to_json(self):
+        """The timeseries as stored in Hydra"""
+        data = {}
+        for column, dates, values in self.columns():
+            keys = [d + 'Z' for d in np.datetime_as_string(dates, unit='ms')]
+            data[column] = {k: None if np.isnan(v) else float(v) for k, v in zip(keys, values)}
+        return json.dumps(data)
+
+
+def _concatenate(arrays, dtype):
+    return np.concatenate(arrays).astype(dtype) if arrays else np.array([], dtype=dtype)
+
+
+def is_snapshot(path):
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, STRUCTURE_FILENAME))
+
+
+def export_snapshot(src, dest):
+    """
+    Create a snapshot from a Hydra JSON export (with network, template and template_attributes).
+    Timeseries that can't be decoded (e.g., with text values) are kept as JSON.
+    """
+
+    with open(src) as f:
+        data = json.load(f)
+
+    dates = []
+    values = []
+    counts = {'timeseries': 0, 'skipped': 0, 'start': 0}
+
+    def convert(dataset):
+        timeseries = dataset.get('value')
+        try:
+            columns = list(timeseries_columns(timeseries))
+        except Exception:
+            counts['skipped'] += 1
+            return
+        slices = []
+        for column, col_dates, col_values in columns:
+            start = counts['start']
+            slices.append([column, start, start + len(col_dates)])
+            dates.append(col_dates)
+            values.append(col_values)
+            counts['start'] += len(col_dates)
+        dataset['value'] = {TIMESERIES_KEY: slices, 'digest': sha1(timeseries.encode()).hexdigest()}
+        counts['timeseries'] += 1
+
+    def walk(obj):
+        if type(obj) == dict:
+            if obj.get('type') in TIMESERIES_TYPES and type(obj.get('value')) == str and 'metadata' in obj:
+                convert(obj)
+            for v in obj.values():
+                walk(v)
+        elif type(obj) == list:
+            for v in obj:
+                walk(v)
+
+    walk(data)
+    data['snapshot_version'] = SNAPSHOT_VERSION
+
+    if os.path.exists(dest):
+        rmtree(dest)
+    os.makedirs(dest)
+    with open(os.path.join(dest, STRUCTURE_FILENAME), 'wb') as f:
+        f.write(msgpack.packb(data, use_bin_type=True))
+    # uncompressed, so that the arrays can be memory-mapped
+    np.savez(os.path.join(dest, TIMESERIES_FILENAME),
+             dates=_concatenate(dates, 'datetime64[s]'), values=_concatenate(values, np.float64))
+
+    return counts['timeseries'], counts['skipped']
+
+
+def _load_npz(path):
+    """Load the arrays in an npz file, memory-mapping those that are stored uncompressed"""
+
+    arrays = {}
+    with zipfile.ZipFile(path) as zf, open(path, 'rb') as f:
+        for info in zf.infolist():
+            name = info.filename[:-4] if info.filename.endswith('.npy') else info.filename
+            if info.compress_type != zipfile.ZIP_STORED:
+                with zf.open(info) as member:
+                    arrays[name] = np.load(member)
+                continue
+
+            # find the array data within the zip file: after the local file header and the npy header
+            f.seek(info.header_offset)
+            header = f.read(30)
+            name_length, extra_length = struct.unpack('<HH', header[26:30])
+            f.seek(info.header_offset + 30 + name_length + extra_length)
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+
+            if not np.prod(shape):
+                arrays[name] = np.empty(shape, dtype=dtype)
+            else:
+                arrays[name] = np.memmap(path, dtype=dtype, mode='r', offset=f.tell(), shape=shape,
+                                         order='F' if fortran_order else 'C')
+
+    return arrays
+
+
+def load_snapshot(path, mapping=dict):
+    """
+    Load a snapshot, with the same contents as the Hydra JSON export it was created from, except that timeseries are
+    SnapshotTimeseries. Dictionaries are created with mapping (e.g., connection.JSONObject).
+    """
+
+    arrays = _load_npz(os.path.join(path, TIMESERIES_FILENAME))
+
+    def object_hook(obj):
+        if TIMESERIES_KEY in obj:
+            return SnapshotTimeseries(arrays, obj[TIMESERIES_KEY], obj['digest'])
+        return mapping(obj)
+
+    with open(os.path.join(path, STRUCTURE_FILENAME), 'rb') as f:
+        data = msgpack.unpackb(f.read(), raw=False, object_hook=object_hook)
+
+    if data.get('snapshot_version') != SNAPSHOT_VERSION:
+        raise Exception('Snapshot version {} is not supported. Please export the network again.'.format(
+            data.get('snapshot_version')))
+
+    return data
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Create a binary snapshot from a Hydra JSON export')
+    parser.add_argument('src', help='''The Hydra JSON export (with network, template and template_attributes).''')
+    parser.add_argument('dest', help='''The snapshot folder to create. This can then be run with --f.''')
+    args = parser.parse_args()
+
+    n, skipped = export_snapshot(args.src, args.dest)
+    print(' [*] Saved {} timeseries to {}'.format(n, args.dest))
+    if skipped:
+        print(' [-] WARNING: {} timeseries could not be decoded and were saved as JSON'.format(skipped))
@@ -0,0 +1,8 @@
+class ProcessState:
+    REQUESTED = b'requested'
+    STARTED = b'started'
+    RUNNING = b'running'
+    PAUSED = b'paused'
+    CANCELED = b'stopped'
+    ERROR = b'error'
+    FINISHED = b'finished'